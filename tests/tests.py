@@ -145,4 +145,173 @@ inp = recipe.add_input('inputs', name, use_tmp=True)
 out = recipe.add_output('outputs', name, main=True, use_tmp=True)
 recipe.add_rule(tp.dummy.DummyParamPrint(inp, out))
 
+#### subsampling (seeded by exp:seed)
+
+# ExternalShuffle, with max_memory small enough to recurse
+name = 'external_shuffle'
+inp = recipe.add_input('inputs', name)
+out = recipe.add_output('outputs', name, main=True)
+recipe.add_rule(tp.apply_component(
+    tp.components.subsampling.ExternalShuffle(
+        max_memory=500, n_buckets=3))(inp, out))
+
+# SplitDataset of parallel data, both methods
+for method, dev_size, test_size in (('sample', 5, 5), ('hash', .1, .1)):
+    name = 'split_' + method
+    inputs = [recipe.add_input('inputs', name + '_en'),
+              recipe.add_input('inputs', name + '_fi')]
+    splits = {split: [recipe.add_output('outputs',
+                                        '{}_{}_{}'.format(name, split, lang),
+                                        main=True)
+                      for lang in ('en', 'fi')]
+              for split in ('train', 'dev', 'test')}
+    recipe.add_rule(tp.components.subsampling.SplitDataset(
+        inputs, splits['train'], splits['dev'], splits['test'],
+        dev_size=dev_size, test_size=test_size, method=method))
+
+# MixCorpora: one corpus downsampled, the other upsampled and reshuffled
+name = 'mix_corpora'
+corpora = [recipe.add_input('inputs', name + '_a'),
+           recipe.add_input('inputs', name + '_b')]
+out = recipe.add_output('outputs', name, main=True)
+recipe.add_rule(tp.components.subsampling.MixCorpora(
+    corpora, out, weights=[1, 1], size=50, reshuffle=True))
+
+#### deduplication
+
+# exact, mono
+name = 'dedup_mono'
+inp = recipe.add_input('inputs', name)
+out = recipe.add_output('outputs', name, main=True)
+recipe.add_rule(tp.Deduplicate([inp], [out], partitions=4))
+
+# parallel, keyed on the source side only
+name = 'dedup_columns'
+inputs = [recipe.add_input('inputs', name + '_src'),
+          recipe.add_input('inputs', name + '_trg')]
+outputs = [recipe.add_output('outputs', name + '_src', main=True),
+           recipe.add_output('outputs', name + '_trg', main=True)]
+recipe.add_rule(tp.Deduplicate(inputs, outputs, columns=[0], partitions=4))
+
+# case, punctuation and whitespace insensitive
+name = 'dedup_normalized'
+inp = recipe.add_input('inputs', name)
+out = recipe.add_output('outputs', name, main=True)
+recipe.add_rule(tp.Deduplicate([inp], [out], key='normalized', partitions=4))
+
+#### many patterns (over the matcher threshold)
+
+# literals, groups with backreferences, and inline flags.
+# Later expressions also match the output of earlier ones.
+name = 'regex_substitution_many'
+inp = recipe.add_input('inputs', name)
+out = recipe.add_output('outputs', name, main=True)
+recipe.add_rule(tp.apply_component(tp.components.core.RegexSubstitution([
+    (r'Sibut', 'SIBUT'),
+    (r'(\d+):(\d+)', r'\2:\1'),
+    (r'(?i)the', 'THE'),
+    (r'THE central', 'the middle'),
+    (r'\.\.\.\.', '.'),
+    (r'\.\.\.', ' … '),
+    (r'dots\.\.', 'dots:'),
+    (r'http://', 'https://'),
+    (r'www\.', ''),
+    (r'\bNo\.', 'Number'),
+    (r'(\w+)@(\w+)', r'\2 at \1'),
+    (r'ä', 'a'),
+    (r'ö', 'o'),
+    (r'Ä', 'A'),
+    (r'[«»„“]', '"'),
+    (r'€', ' EUR'),
+    (r'(?i)JNE\.', 'etc.'),
+    (r'esim\.', 'e.g.'),
+    (r'\$(\d+)', r'\1 USD'),
+    (r'GDP', 'BKT'),
+    (r'militia', 'armed'),
+    (r'armed groups', 'groups'),
+    (r'Monday', 'Mon'),
+    (r'\d{4}', 'YYYY'),
+    (r'(?i:car)', 'C.A.R.'),
+    (r'a\.m\.', 'AM'),
+]))(inp, out))
+
+name = 'filter_regex_many'
+inp = recipe.add_input('inputs', name)
+out = recipe.add_output('outputs', name, main=True)
+recipe.add_rule(tp.apply_filter(tp.components.filtering.FilterRegex([
+    r'zebra', r'giraffe', r'xylophone', r'quokka', r'wombat',
+    r'platypus', r'narwhal', r'axolotl', r'pangolin', r'okapi',
+    r'tapir', r'lemur',
+    r'(?i)ääliö',
+    r'(\d)\1{2}',
+    r'http://\S+',
+    r'Two dots\.\.',
+    r'\bNo\. \d',
+    r'(?i:gdp)',
+    r'\$\d+',
+    r'[«»]',
+    r'\bzz+\b',
+    r'(?:ab)+c',
+]))(inp, out))
+
+#### filter chain (adaptive order)
+
+# each rejected line is rejected by a single filter,
+# so the logged reasons do not depend on the order
+name = 'filter_chain'
+inp = recipe.add_input('inputs', name)
+out = recipe.add_output('outputs', name, main=True)
+log = recipe.add_output('outputs', name + '_log')
+recipe.add_rule(tp.apply_filter(tp.components.filtering.FilterChain([
+    tp.components.filtering.FilterByLength(min_tokens=3),
+    tp.components.filtering.FilterAllUrls(),
+    tp.components.filtering.FilterRepetitions(min_anywhere=4,
+                                              min_consequent=3),
+    tp.components.filtering.FilterEllipsis(),
+    ], warmup=2, period=6), logfile=log)(inp, out))
+
+#### contamination with reference sets
+
+# short n for short lines. The sgm reference is read by segment.
+name = 'contaminated'
+refs = [recipe.add_input('inputs', name + '_ref'),
+        recipe.add_input('inputs', name + '_ref_sgm')]
+index = recipe.add_output('outputs', name + '_index')
+recipe.add_rule(tp.components.filtering.BuildNgramIndex(refs, index, n=4))
+inp = recipe.add_input('inputs', name)
+for suffix, threshold in (('_any', 0.), ('_half', .5)):
+    out = recipe.add_output('outputs', name + suffix, main=True)
+    recipe.add_rule(tp.apply_filter(
+        tp.components.filtering.FilterContaminated(
+            index, threshold=threshold))(inp, out))
+
+#### near-duplicates
+
+# including empty lines, which are near-duplicates of each other
+name = 'neardup'
+inp = recipe.add_input('inputs', name)
+mask = recipe.add_output('outputs', name + '_mask')
+out = recipe.add_output('outputs', name, main=True)
+recipe.add_rule(tp.NearDuplicateMask([inp], mask, partitions=4))
+recipe.add_rule(tp.apply_component(
+    tp.components.filtering.FilterUsingMask(mask))(inp, out))
+
+#### filtering by scores, text and binary
+
+name = 'lm_score'
+inp = recipe.add_input('inputs', name)
+scores = {'text': recipe.add_input('inputs', name + '_scores'),
+          'f32': recipe.add_output('outputs', name + '_scores_f32')}
+recipe.add_rule(tp.components.filtering.ScoresToBinary(
+    scores['text'], scores['f32']))
+# the same lines are kept from both formats.
+# keep is also tested with more than the number of lines.
+for fmt in ('text', 'f32'):
+    for keep in (5, 20):
+        out = recipe.add_output(
+            'outputs', '{}_keep{}_{}'.format(name, keep, fmt), main=True)
+        recipe.add_rule(tp.apply_component(
+            tp.components.filtering.FilterUsingLmScore(
+                scores[fmt], keep=keep))(inp, out))
+
 recipe.main()
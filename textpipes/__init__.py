@@ -27,9 +27,11 @@ from . import anmt_latent
 from . import translation_analysis
 from . import lmclean
 from . import sorting
+from . import sharding
 
 # Most common rules for easy access
 from .dedup import Deduplicate
+from .neardup import NearDuplicateMask
 from .dummy import Manual
 from .counting import CountTokens
 from .external import Concatenate, ReEncode
@@ -93,8 +93,7 @@ class Train(Rule):
             ' --log-file {log_file}'
             ' --save-every {save_every}'
             ' --aux-type {aux_type}'
-            ' {argstr}'
-            ' >> {pipe_file} 2>&1'.format(
+            ' {argstr}'.format(
                 model_base=model_base,
                 shard_file=self.shard_file(conf, cli_args),
                 heldout_src=self.heldout_src(conf, cli_args),
@@ -103,8 +102,8 @@ class Train(Rule):
                 log_file=self.log_file(conf, cli_args),
                 save_every=self.save_every,
                 aux_type=self.aux_type,
-                argstr=self.argstr,
-                pipe_file=self.pipe_file(conf, cli_args)))
+                argstr=self.argstr),
+            log=self.pipe_file(conf, cli_args))
         #'--validate-every 5 --translate-every 5 --backwards'
 
     def is_atomic(self, output):
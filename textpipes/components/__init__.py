@@ -5,6 +5,7 @@ Components are text processing operations expressed as Python generators.
 from .core import *
 from . import demoses
 from . import europarl
+from . import external
 from . import estonian
 from . import filtering
 from . import newscorpus
@@ -16,4 +17,4 @@ from . import segmentation
 from . import subsampling
 from . import tokenizer
 
-from .subsampling import Shuffle
+from .subsampling import Shuffle, ExternalShuffle, MixCorpora
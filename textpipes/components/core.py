@@ -5,9 +5,12 @@ Components are text processing operations expressed as Python generators.
 import collections
 import re
 import itertools
+import queue
 
 from ..core.recipe import Rule, RecipeFile, OptionalDep
 from ..core.utils import safe_zip, progress
+from ..core.lineindex import get_line_index, can_seek, read_lines
+from ..core.matcher import Matcher
 
 
 def apply_component(component, para=False, **kwargs):
@@ -67,7 +70,32 @@ class Pipe(Rule):
         self.estimated_lines = estimated_lines
         self._name = name if name is not None else self.__class__.__name__
 
-    def _make_helper(self, stream, conf, cli_args):
+    def open_selected_lines(self, conf, cli_args=None):
+        """If the first component only selects lines by their index
+        (it has a select_lines method), and the main inputs have
+        a line index, reads only the selected lines.
+        -> (readers, stream), or None if a full scan is needed"""
+        select_lines = getattr(self.components[0], 'select_lines', None)
+        if select_lines is None or len(self.main_inputs) == 0:
+            return None
+        paths = [inp(conf, cli_args) for inp in self.main_inputs]
+        indices = [get_line_index(path,
+                                  build=getattr(inp, 'line_index', False))
+                   for (inp, path) in zip(self.main_inputs, paths)]
+        if any(index is None for index in indices):
+            return None
+        n_lines = indices[0].n_lines
+        if any(index.n_lines != n_lines for index in indices):
+            # let the full scan report the mismatch
+            return None
+        lines = select_lines(n_lines, config=conf)
+        if lines is None or not all(can_seek(path, lines) for path in paths):
+            return None
+        readers = [read_lines(path, index, lines)
+                   for (path, index) in zip(paths, indices)]
+        return readers, readers
+
+    def _make_helper(self, stream, conf, cli_args, selected=False):
         # Open side inputs and outputs
         side_fobjs = {}
         for inp in self.side_inputs:
@@ -79,7 +107,8 @@ class Pipe(Rule):
         for component in self.components:
             component.pre_make(side_fobjs)
         # Actually apply components to stream
-        for component in self.components:
+        # (the lines selected by the first one may have been read already)
+        for component in self.components[1 if selected else 0:]:
             stream = component(stream,
                                side_fobjs=side_fobjs,
                                config=conf,
@@ -126,18 +155,42 @@ class MonoPipe(Pipe):
         self.auto_concat = auto_concat
 
     def make(self, conf, cli_args=None):
+        selected = None
+        if len(self.main_inputs) == 1:
+            selected = self.open_selected_lines(conf, cli_args)
+        if selected is not None:
+            readers, (stream,) = selected
+        else:
+            readers, stream = self.open_main_inputs(conf, cli_args)
+        self.make_from_stream(stream, conf, cli_args,
+                              selected=selected is not None)
+        for fobj in readers:
+            fobj.close()
+
+    def scan_key(self):
+        if type(self).make not in (MonoPipe.make, DeadEndPipe.make):
+            return None
+        if hasattr(self.components[0], 'select_lines'):
+            # reading only the selected lines may be cheaper
+            return None
+        return ('mono', tuple(self.main_inputs))
+
+    def open_main_inputs(self, conf, cli_args=None):
         if len(self.main_inputs) != 1 and not self.auto_concat:
             raise Exception('MonoPipe must have exactly 1 main input. '
                 'Received: {}'.format(self.main_inputs))
-        if len(self.main_outputs) != 1:
-            raise Exception('MonoPipe must have exactly 1 main output. '
-                'Received: {}'.format(self.main_outputs))
         # Make a tuple of generators that reads from main_inputs
         readers = [inp.open(conf, cli_args, mode='r')
                    for inp in self.main_inputs]
         stream = itertools.chain(*readers)
+        return readers, stream
 
-        stream, side_fobjs = self._make_helper(stream, conf, cli_args)
+    def make_from_stream(self, stream, conf, cli_args=None, selected=False):
+        if len(self.main_outputs) != 1:
+            raise Exception('MonoPipe must have exactly 1 main output. '
+                'Received: {}'.format(self.main_outputs))
+        stream, side_fobjs = self._make_helper(
+            stream, conf, cli_args, selected=selected)
 
         # Drain pipeline into main_output
         with self.main_outputs[0].open(conf, cli_args, mode='w') as fobj:
@@ -148,9 +201,45 @@ class MonoPipe(Pipe):
         # post_make must be done after draining
         self._post_make(side_fobjs)
         # close all file objects
-        for fobj in readers + list(side_fobjs.values()):
+        for fobj in side_fobjs.values():
             fobj.close()
 
+    def fuse(self, consumer, intermediate):
+        # only plain MonoPipes, connected by the main stream
+        if type(self).make is not MonoPipe.make:
+            return None
+        if self.outputs != (intermediate,):
+            return None
+        if not isinstance(consumer, MonoPipe) \
+                or type(consumer).make not in (MonoPipe.make, DeadEndPipe.make):
+            return None
+        if tuple(consumer.main_inputs) != (intermediate,) \
+                or intermediate in consumer.side_inputs:
+            return None
+        if self.resource_class != consumer.resource_class \
+                or self.chain_schedule != 1 or consumer.chain_schedule != 1:
+            return None
+        components = list(self.components) + list(consumer.components)
+        if sum(getattr(component, 'mp', False) for component in components) > 1:
+            # multiprocessing supports only one mp component per pipe
+            return None
+        from_components = set(rf for component in components
+                              for rf in tuple(component.side_inputs)
+                              + tuple(component.side_outputs))
+        extra_side_inputs = [inp for inp in set(self.side_inputs + consumer.side_inputs)
+                             if inp not in from_components]
+        extra_side_outputs = [out for out in consumer.side_outputs
+                              if out not in from_components]
+        kwargs = dict(
+            extra_side_inputs=extra_side_inputs,
+            extra_side_outputs=extra_side_outputs,
+            name='{}+{}'.format(self.name, consumer.name),
+            resource_class=consumer.resource_class,
+            auto_concat=self.auto_concat)
+        if isinstance(consumer, DeadEndPipe):
+            return DeadEndPipe(components, self.main_inputs, **kwargs)
+        return MonoPipe(components, self.main_inputs, consumer.main_outputs, **kwargs)
+
 
 class ParallelPipe(Pipe):
     def __init__(self, components, *args, **kwargs):
@@ -167,13 +256,36 @@ class ParallelPipe(Pipe):
         super().__init__(wrapped, *args, **kwargs)
 
     def make(self, conf, cli_args=None):
+        selected = self.open_selected_lines(conf, cli_args)
+        if selected is not None:
+            readers, columns = selected
+            stream = zip(*columns)
+        else:
+            readers, stream = self.open_main_inputs(conf, cli_args)
+        self.make_from_stream(stream, conf, cli_args,
+                              selected=selected is not None)
+        for fobj in readers:
+            fobj.close()
+
+    def scan_key(self):
+        if type(self).make is not ParallelPipe.make:
+            return None
+        if hasattr(self.components[0], 'select_lines'):
+            # reading only the selected lines may be cheaper
+            return None
+        return ('parallel', tuple(self.main_inputs))
+
+    def open_main_inputs(self, conf, cli_args=None):
         # Make a tuple of generators that reads from main_inputs
         readers = [inp.open(conf, cli_args, mode='r')
                    for inp in self.main_inputs]
         # read one line from each and yield it as a tuple
         stream = safe_zip(*readers)
+        return readers, stream
 
-        stream, side_fobjs = self._make_helper(stream, conf, cli_args)
+    def make_from_stream(self, stream, conf, cli_args=None, selected=False):
+        stream, side_fobjs = self._make_helper(
+            stream, conf, cli_args, selected=selected)
 
         # Round-robin drain pipeline into main_outputs
         writers = [out.open(conf, cli_args, mode='w')
@@ -189,7 +301,7 @@ class ParallelPipe(Pipe):
         # post_make must be done after draining
         self._post_make(side_fobjs)
         # close all file objects
-        for fobj in readers + writers + list(side_fobjs.values()):
+        for fobj in writers + list(side_fobjs.values()):
             fobj.close()
 
 
@@ -207,19 +319,22 @@ class DeadEndPipe(MonoPipe):
                     'received {}'.format(component))
         super().__init__(components, *args, main_outputs=[], **kwargs)
 
-    def make(self, conf, cli_args=None):
+    def open_main_inputs(self, conf, cli_args=None):
         if len(self.main_inputs) == 0:
             raise Exception('DeadEndPipe must have at least one main input. '
                 'Received: {}'.format(self.main_inputs))
-        if len(self.main_outputs) != 0:
-            raise Exception('DeadEndPipe cannot have a main output. '
-                'Received: {}'.format(self.main_outputs))
         # Make a tuple of generators that reads from main_inputs
         readers = [inp.open(conf, cli_args, mode='r')
                    for inp in self.main_inputs]
         stream = itertools.chain(*readers)
+        return readers, stream
 
-        stream, side_fobjs = self._make_helper(stream, conf, cli_args)
+    def make_from_stream(self, stream, conf, cli_args=None, selected=False):
+        if len(self.main_outputs) != 0:
+            raise Exception('DeadEndPipe cannot have a main output. '
+                'Received: {}'.format(self.main_outputs))
+        stream, side_fobjs = self._make_helper(
+            stream, conf, cli_args, selected=selected)
 
         # Drain pipeline, throwing the output away
         for line in stream:
@@ -227,7 +342,7 @@ class DeadEndPipe(MonoPipe):
         # post_make must be done after draining
         self._post_make(side_fobjs)
         # close all file objects
-        for fobj in readers + list(side_fobjs.values()):
+        for fobj in side_fobjs.values():
             fobj.close()
 
 
@@ -322,6 +437,58 @@ class SingleCellComponent(MonoPipeComponent):
         raise NotImplementedError()
 
 
+def _map_columns(stream, components):
+    """Applies one component to each column of a stream of tuples.
+
+    Components with map_lines (e.g. ExternalComponent) consume
+    the column as a stream of their own, the others are applied
+    using single_cell. Rows wait until all columns are done,
+    at most the smallest window of rows at a time."""
+    streams = {}
+    results = {}
+    for (i, component) in enumerate(components):
+        if hasattr(component, 'map_lines'):
+            streams[i] = queue.Queue()
+            results[i] = iter(component.map_lines(_iter_queue(streams[i])))
+    window = min(components[i].window for i in streams)
+    pending = collections.deque()
+
+    def collect(row):
+        for i in streams:
+            row[i] = next(results[i])
+        return tuple(row)
+
+    for tpl in stream:
+        assert len(tpl) == len(components)
+        row = []
+        for (i, (component, line)) in enumerate(zip(components, tpl)):
+            if i in streams:
+                streams[i].put(line)
+                row.append(None)
+            else:
+                row.append(component.single_cell(line))
+        pending.append(row)
+        if len(pending) >= window:
+            yield collect(pending.popleft())
+    for q in streams.values():
+        q.put(_END_OF_STREAM)
+    while pending:
+        yield collect(pending.popleft())
+    for i in streams:
+        # exhausting also runs the final checks
+        for _ in results[i]:
+            raise Exception('column {} produced extra lines'.format(i))
+
+_END_OF_STREAM = object()
+
+def _iter_queue(q):
+    while True:
+        line = q.get()
+        if line is _END_OF_STREAM:
+            return
+        yield line
+
+
 class ForEach(ParallelPipeComponent):
     """Wraps a SingleCellComponent for use in a ParallelPipe.
 
@@ -334,6 +501,14 @@ class ForEach(ParallelPipeComponent):
 
     def __call__(self, stream, side_fobjs=None,
                  config=None, cli_args=None):
+        if hasattr(self.mono_component, 'map_lines'):
+            # the width is known from the first tuple
+            stream = iter(stream)
+            for first in stream:
+                yield from _map_columns(
+                    itertools.chain([first], stream),
+                    [self.mono_component] * len(first))
+            return
         for tpl in stream:
             yield tuple(self.mono_component.single_cell(line)
                         for line in tpl)
@@ -366,6 +541,10 @@ class PerColumn(ParallelPipeComponent):
 
     def __call__(self, stream, side_fobjs=None,
                  config=None, cli_args=None):
+        if any(hasattr(component, 'map_lines')
+               for component in self.components):
+            yield from _map_columns(stream, self.components)
+            return
         for tpl in stream:
             assert len(tpl) == len(self.components)
             yield tuple(component.single_cell(line)
@@ -404,12 +583,19 @@ class RegexSubstitution(SingleCellComponent):
         flags = re.UNICODE
         if ignore_case:
             flags += re.IGNORECASE
+        expressions = list(expressions)
         self.expressions = [(re.compile(exp, flags=flags), repl)
                             for (exp, repl) in expressions]
+        # skips the expressions that don't match
+        self.matcher = Matcher([exp for (exp, repl) in expressions],
+                               flags=flags)
 
     def single_cell(self, line):
-        for (exp, repl) in self.expressions:
+        i = self.matcher.first_match(line)
+        while i is not None:
+            (exp, repl) = self.expressions[i]
             line = exp.sub(repl, line)
+            i = self.matcher.first_match(line, i + 1)
         return line
 
 
@@ -0,0 +1,106 @@
+"""External tools as streaming pipe components (co-processes)"""
+
+import os
+import shlex
+import subprocess
+import threading
+
+from .core import MonoPipeComponent
+
+
+def coprocess(cmd, lines, window=10000):
+    """Feeds lines to the stdin of a long-lived subprocess,
+    and yields the lines it writes to stdout.
+
+    The tool must produce exactly one output line per input line.
+    Stdin is written from a separate thread, so the pipes can not
+    deadlock. At most window lines are in flight inside the tool:
+    a tool that buffers its output must flush at least that often
+    (e.g. use the -b flag of the moses tokenizer).
+    """
+    env = dict(os.environ)
+    # python tools flush each line
+    env['PYTHONUNBUFFERED'] = '1'
+    process = subprocess.Popen(
+        cmd,
+        shell=True,
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        errors='replace',
+        bufsize=1,
+    )
+    in_flight = threading.Semaphore(window)
+    n_in = [0]
+    errors = []
+
+    def writer():
+        try:
+            for line in lines:
+                if '\n' in line:
+                    raise Exception(
+                        'newline within a line would break the alignment')
+                in_flight.acquire()
+                process.stdin.write(line)
+                process.stdin.write('\n')
+                n_in[0] += 1
+        except BrokenPipeError:
+            # the tool died, reported below
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    thread = threading.Thread(target=writer)
+    thread.daemon = True
+    thread.start()
+    n_out = 0
+    try:
+        for line in process.stdout:
+            in_flight.release()
+            n_out += 1
+            yield line.rstrip('\n')
+        thread.join()
+        process.wait()
+    finally:
+        # also reached if the consumer stops early
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    if errors:
+        raise errors[0]
+    if process.returncode != 0:
+        raise Exception('Nonzero status code {} when running {}'.format(
+            process.returncode, cmd))
+    if n_out != n_in[0]:
+        raise Exception('{}: {} lines in, {} lines out'.format(
+            cmd, n_in[0], n_out))
+
+
+class ExternalComponent(MonoPipeComponent):
+    """Runs an external line-by-line tool as a co-process,
+    without intermediary files.
+
+    E.g. ExternalComponent('morfessor-segment -l model.bin -')
+    The tool must read stdin and write one line to stdout per input line.
+    Usable in a ParallelPipe through ForEach or PerColumn:
+    each column gets its own process.
+    """
+    def __init__(self, cmd, window=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.cmd = cmd
+        self.window = window
+        program = shlex.split(cmd)[0]
+        self.add_opt_dep(program, binary=True)
+
+    def __call__(self, stream, side_fobjs=None,
+                 config=None, cli_args=None):
+        return self.map_lines(stream)
+
+    def map_lines(self, lines):
+        return coprocess(self.cmd, lines, window=self.window)
@@ -1,8 +1,16 @@
+import array
+import bisect
 import collections
+import hashlib
 import re
+import time
+import weakref
 
 from .core import MonoPipeComponent, ParallelPipeComponent, PipeComponent, apply_component
 from .preprocessing import Clean
+from ..core.matcher import Matcher
+from ..core.scores import ScoreWriter, read_scores, iter_scores, kth_smallest, \
+    is_binary as is_binary_scores
 from ..core.utils import safe_zip
 from ..core.recipe import Rule, OptionalDep
 
@@ -35,20 +43,35 @@ class MonoFilter(MonoPipeComponent):
             if self.filtr(line, side_fobjs=side_fobjs):
                 # filter out this line
                 if logfile is not None:
-                    # FIXME: not possible to log the reason
+                    # only a FilterChain knows the reason
+                    reason = getattr(self.filtr, 'reason', None)
+                    if reason is not None:
+                        logfile.write(reason)
+                        logfile.write('\t')
                     logfile.write(line)
                     logfile.write('\n')
             else:
                 # keep this line
                 yield line
 
+    def pre_make(self, side_fobjs):
+        self.filtr.pre_make(side_fobjs)
+
     @property
     def opt_deps(self):
         return self.filtr.opt_deps
 
 
 class ParallelFilter(ParallelPipeComponent):
-    def __init__(self, filters, logfile=None):
+    """Filters out tuples in which any line is rejected
+    by the filter of its stream.
+
+    adaptive: evaluate the streams in the order minimizing
+        the expected cost (see AdaptiveOrder), instead of in order.
+        The removed tuples are logged with the rejecting filter.
+    """
+    def __init__(self, filters, logfile=None, adaptive=False,
+                 warmup=1000, period=100000):
         side_inputs = []
         side_outputs = [logfile]
         if isinstance(filters, Filter):
@@ -61,26 +84,45 @@ class ParallelFilter(ParallelPipeComponent):
         super().__init__(side_inputs=side_inputs, side_outputs=side_outputs)
         self.filters = filters
         self.logfile = logfile
+        self.adaptive = adaptive
+        self.warmup = warmup
+        self.period = period
 
     def __call__(self, stream, side_fobjs=None,
                  config=None, cli_args=None):
         filters = self.filters
         logfile = side_fobjs.get(self.logfile, None)
+        order = None
         for tpl in stream:
             if isinstance(filters, Filter):
                 # use same filter for all streams
                 filters = [filters] * len(tpl)
-            if any(filtr(line, side_fobjs=side_fobjs)
-                   for (filtr, line)
-                   in zip(filters, tpl)):
+            if self.adaptive:
+                if order is None:
+                    order = AdaptiveOrder(len(filters),
+                                          self.warmup, self.period)
+                rejected = order.first_rejecting(
+                    lambda i: filters[i](tpl[i], side_fobjs=side_fobjs))
+                remove = rejected is not None
+            else:
+                remove = any(filtr(line, side_fobjs=side_fobjs)
+                             for (filtr, line)
+                             in zip(filters, tpl))
+            if remove:
                 # filter out this line
                 if logfile is not None:
+                    if self.adaptive:
+                        logfile.write(_reason(rejected, filters[rejected]))
+                        logfile.write('\t')
                     logfile.write(' ||| '.join(tpl))
                     logfile.write('\n')
             else:
                 # keep this line
                 yield tpl
 
+    def pre_make(self, side_fobjs):
+        _pre_make_filters(self.filters, side_fobjs)
+
     @property
     def opt_deps(self):
         all_deps = set()
@@ -103,9 +145,111 @@ class Filter(object):
         """Returns True if the line should be filtered out"""
         raise NotImplementedError()
 
+    def pre_make(self, side_fobjs):
+        """Called once before filtering, e.g. to load side inputs
+        (before any worker processes are forked)"""
+        pass
+
     def add_opt_dep(self, name, binary=False):
         self.opt_deps.add(OptionalDep(name, binary, self.__class__.__name__))
 
+
+def _pre_make_filters(filters, side_fobjs):
+    if isinstance(filters, Filter):
+        filters = [filters]
+    for filtr in set(filters):
+        filtr.pre_make(side_fobjs)
+
+
+### Shared per-line features
+
+class _lazy(object):
+    """Attribute computed on first access, then stored in the instance"""
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        value = self.func(obj)
+        obj.__dict__[self.func.__name__] = value
+        return value
+
+
+class LineFeatures(object):
+    """Features of a line used by several filters.
+    Each feature is computed on first use only,
+    and shared by all the filters reading the same line."""
+    def __init__(self, line):
+        self.line = line
+
+    @_lazy
+    def tokens(self):
+        return self.line.split()
+
+    @_lazy
+    def n_tokens(self):
+        return len(self.tokens)
+
+    @_lazy
+    def n_chars(self):
+        return len(self.line)
+
+    @_lazy
+    def n_chars_stripped(self):
+        return len(self.line.strip())
+
+    @_lazy
+    def max_token_chars(self):
+        return max((len(tok) for tok in self.tokens), default=0)
+
+    @_lazy
+    def alpha(self):
+        """lowercased, only FILTER_ALPHA characters"""
+        return alpha_only(self.line)
+
+    @_lazy
+    def char_counts(self):
+        return collections.Counter(self.line)
+
+    @_lazy
+    def token_counts(self):
+        return collections.Counter(self.tokens)
+
+    @_lazy
+    def n_numpunc_tokens(self):
+        return sum(1 for token in self.tokens
+                   if RE_NUMPUNC.match(token))
+
+
+# the lines of a tuple, passing through a chain of filters
+FEATURE_CACHE_SIZE = 16
+_feature_cache = {}
+
+
+def line_features(line):
+    """The shared LineFeatures of the line.
+    Filters are applied one line (tuple) at a time,
+    so a small cache of the most recent lines suffices."""
+    features = _feature_cache.get(line, None)
+    if features is None:
+        if len(_feature_cache) >= FEATURE_CACHE_SIZE:
+            _feature_cache.clear()
+        features = LineFeatures(line)
+        _feature_cache[line] = features
+    return features
+
+
+RE_NOT_ALPHA = re.compile('[^{}]'.format(''.join(sorted(FILTER_ALPHA))))
+
+
+def alpha_only(line):
+    """Lowercased line with all but FILTER_ALPHA characters removed,
+    for rough comparisons"""
+    return RE_NOT_ALPHA.sub('', line.lower())
+
+
 class FilterOovs(Filter):
     def __init__(self, vocabulary):
         super().__init__(side_inputs=[vocabulary])
@@ -166,6 +310,108 @@ class InverseFilter(Filter):
         return not self.filtr(line, side_fobjs=side_fobjs)
 
 
+class FilterChain(Filter):
+    """Filters out lines rejected by any of the filters,
+    evaluating them in the order minimizing the expected cost
+    (see AdaptiveOrder). The result does not depend on the order,
+    as long as the filters do not keep state between lines.
+
+    After a line is filtered out, reason names the rejecting filter,
+    as its index in filters and its class name.
+    """
+    def __init__(self, filters, warmup=1000, period=100000):
+        side_inputs = []
+        side_outputs = []
+        for filtr in filters:
+            side_inputs.extend(filtr.side_inputs)
+            side_outputs.extend(filtr.side_outputs)
+        super().__init__(side_inputs=side_inputs, side_outputs=side_outputs)
+        self.filters = list(filters)
+        for filtr in self.filters:
+            self.opt_deps.update(filtr.opt_deps)
+        self.order = AdaptiveOrder(len(self.filters), warmup, period)
+        self.reason = None
+
+    def __call__(self, line, side_fobjs=None):
+        filters = self.filters
+        rejected = self.order.first_rejecting(
+            lambda i: filters[i](line, side_fobjs=side_fobjs))
+        if rejected is None:
+            self.reason = None
+            return False
+        self.reason = _reason(rejected, filters[rejected])
+        return True
+
+    def pre_make(self, side_fobjs):
+        _pre_make_filters(self.filters, side_fobjs)
+
+
+class AdaptiveOrder(object):
+    """Evaluation order for a disjunction of filters.
+
+    At the start, and then once every period lines,
+    all filters are evaluated for a sample of warmup lines,
+    measuring their cost (time per line) and rejection rate.
+    The shared line features are recomputed for each filter,
+    so that the measured costs do not depend on the current order.
+    The filters are then sorted by cost divided by rejection rate:
+    cheap filters that reject a lot are evaluated first.
+    Outside the samples, evaluation stops at the first rejection.
+    """
+    def __init__(self, n_filters, warmup=1000, period=100000):
+        self.warmup = max(warmup, 1)
+        self.period = max(period, self.warmup)
+        self.order = list(range(n_filters))
+        self._n_lines = 0
+        self._reset()
+
+    def _reset(self):
+        self._sampled = 0
+        self._costs = [0.] * len(self.order)
+        self._rejections = [0] * len(self.order)
+
+    def first_rejecting(self, evaluate):
+        """Index of a filter rejecting the line, or None if kept.
+        evaluate(i) applies the ith filter to the line"""
+        measure = self._n_lines % self.period < self.warmup
+        self._n_lines += 1
+        if not measure:
+            for i in self.order:
+                if evaluate(i):
+                    return i
+            return None
+        rejected = None
+        costs = self._costs
+        for i in self.order:
+            # each filter pays for the line features it uses,
+            # regardless of which filter computed them first
+            _feature_cache.clear()
+            start = time.perf_counter()
+            reject = evaluate(i)
+            costs[i] += time.perf_counter() - start
+            if reject:
+                self._rejections[i] += 1
+                if rejected is None:
+                    rejected = i
+        self._sampled += 1
+        if self._sampled == self.warmup:
+            self._reorder()
+        return rejected
+
+    def _reorder(self):
+        def expected_cost(i):
+            # never rejecting: last, cheapest first
+            if self._rejections[i] == 0:
+                return (1, self._costs[i])
+            return (0, self._costs[i] / self._rejections[i])
+        self.order = sorted(self.order, key=expected_cost)
+        self._reset()
+
+
+def _reason(i, filtr):
+    return '{}:{}'.format(i, filtr.__class__.__name__)
+
+
 class FilterRegex(Filter):
     """Filters out any lines matching the expressions"""
     def __init__(self, expressions, ignore_case=False):
@@ -173,11 +419,11 @@ class FilterRegex(Filter):
         flags = re.UNICODE
         if ignore_case:
             flags += re.IGNORECASE
-        self.expressions = [re.compile(exp, flags=flags)
-                            for exp in expressions]
+        self.matcher = Matcher(expressions, flags=flags)
+        self.expressions = self.matcher.compiled
 
     def __call__(self, line, side_fobjs=None):
-        return any(exp.search(line) for exp in self.expressions)
+        return self.matcher.search(line)
 
 
 class FilterUnclean(Filter):
@@ -213,17 +459,17 @@ class FilterByLength(Filter):
         self.max_chars_per_token = max_chars_per_token
 
     def __call__(self, line, side_fobjs=None):
-        if self.min_chars and len(line.strip()) < self.min_chars:
+        features = line_features(line)
+        if self.min_chars and features.n_chars_stripped < self.min_chars:
             return True
-        if self.max_chars and len(line) > self.max_chars:
+        if self.max_chars and features.n_chars > self.max_chars:
             return True
-        tokens = line.split()
-        if self.min_tokens and len(tokens) < self.min_tokens:
+        if self.min_tokens and features.n_tokens < self.min_tokens:
             return True
-        if self.max_tokens and len(tokens) > self.max_tokens:
+        if self.max_tokens and features.n_tokens > self.max_tokens:
             return True
         if (self.max_chars_per_token and
-                any(len(tok) > self.max_chars_per_token for tok in tokens)):
+                features.max_token_chars > self.max_chars_per_token):
             return True
         return False
 
@@ -241,15 +487,16 @@ class ComparisonFilterByLengthRatio(ComparisonFilter):
         assert not (tokens and only_alpha)
 
     def __call__(self, tpl, side_fobjs=None):
-        left, right = tpl
+        left, right = (line_features(line) for line in tpl)
         if self.only_alpha:
-            left = ''.join([x for x in left.lower() if x in FILTER_ALPHA])
-            right = ''.join([x for x in right.lower() if x in FILTER_ALPHA])
-        if self.tokens:
-            left = left.split()
-            right = right.split()
-        llen = float(len(left))
-        rlen = float(len(right))
+            llen = float(len(left.alpha))
+            rlen = float(len(right.alpha))
+        elif self.tokens:
+            llen = float(left.n_tokens)
+            rlen = float(right.n_tokens)
+        else:
+            llen = float(left.n_chars)
+            rlen = float(right.n_chars)
         if llen < self.threshold and rlen < self.threshold:
             # don't filter very short lines
             return False
@@ -286,8 +533,8 @@ class FilterByLengthRatio(ParallelPipeComponent):
         for tpl in stream:
             left, right = tpl
             if self.only_alpha:
-                left = ''.join([x for x in left.lower() if x in FILTER_ALPHA])
-                right = ''.join([x for x in right.lower() if x in FILTER_ALPHA])
+                left = line_features(left).alpha
+                right = line_features(right).alpha
             llen = float(len(left))
             rlen = float(len(right))
             if llen < self.threshold and rlen < self.threshold:
@@ -323,8 +570,8 @@ class FilterLongUntranslated(ParallelPipeComponent):
         logfile = side_fobjs.get(self.logfile, None)
         for tpl in stream:
             left, right = tpl
-            left = ''.join([x for x in left.lower() if x in FILTER_ALPHA])
-            right = ''.join([x for x in right.lower() if x in FILTER_ALPHA])
+            left = line_features(left).alpha
+            right = line_features(right).alpha
             llen = float(len(left))
             rlen = float(len(right))
             if llen < self.threshold or rlen < self.threshold:
@@ -349,6 +596,10 @@ class FilterUsingLmScore(PipeComponent):
     Alternatively a fixed number of best entries can be kept
     (dynamically sets the threshold to achieve this).
     Can also be used with other scores than Language Model.
+
+    The scores can be text, or binary float32 (*.f32, see core.scores).
+    Binary scores are memory-mapped, and the threshold for keep
+    is selected without sorting: prefer them for large corpora.
     """
     def __init__(self, scores, threshold=None, keep=None, logfile=None):
         super().__init__(side_inputs=[scores], side_outputs=[logfile])
@@ -361,19 +612,23 @@ class FilterUsingLmScore(PipeComponent):
         # does not care if the data is mono or parallel
         self._is_mono_pipe_component = True
         self._is_parallel_pipe_component = True
+        self.add_opt_dep('numpy', binary=False)
 
-    def pre_make(self, side_fobjs):
-        if self.keep is None and self.threshold is not None:
+    def _load_scores(self, side_fobjs, config, cli_args):
+        path = self.scores_file(config, cli_args)
+        if self.keep is None and not is_binary_scores(path):
+            # text scores can be streamed
             self.scores = (float(x) for x in side_fobjs[self.scores_file])
-        elif self.threshold is None and self.keep is not None:
-            # need to cache the whole list of scores
-            self.scores = [float(x) for x in side_fobjs[self.scores_file]]
-            sorted_scores = sorted(self.scores)
-            keep = min(self.keep, len(sorted_scores))
-            self.threshold = sorted_scores[keep]
+            return
+        scores = read_scores(path)
+        self.scores = iter_scores(scores)
+        if self.keep is not None and len(scores) > 0:
+            keep = min(self.keep, len(scores) - 1)
+            self.threshold = kth_smallest(scores, keep)
 
     def __call__(self, stream, side_fobjs=None, 
                  config=None, cli_args=None):
+        self._load_scores(side_fobjs, config, cli_args)
         logfile = side_fobjs.get(self.logfile, None)
         kept = 0
         for (line, score) in safe_zip(stream, self.scores):
@@ -387,6 +642,19 @@ class FilterUsingLmScore(PipeComponent):
                 break
 
 
+class ScoresToBinary(Rule):
+    """Converts text scores (e.g. written by an external tool)
+    into binary float32 scores (*.f32)"""
+    def __init__(self, inp, output, **kwargs):
+        super().__init__([inp], [output], **kwargs)
+
+    def make(self, conf, cli_args=None):
+        reader = self.inputs[0].open(conf, cli_args, mode='r')
+        with ScoreWriter(self.outputs[0](conf, cli_args)) as writer:
+            for line in reader:
+                writer.write(float(line))
+
+
 class OnlyNames(Filter):
     """Only keep tokens that would be segmented by LetterizeNames"""
     def __call__(self, token, side_fobjs=None):
@@ -419,15 +687,14 @@ class FilterBureaucratic(Filter):
         self.chars = chars
 
     def __call__(self, line, side_fobjs=None):
+        features = line_features(line)
         total = 0
-        n_numeric = sum(1 for token in line.split()
-                        if RE_NUMPUNC.match(token))
+        n_numeric = features.n_numpunc_tokens
         for limit in self.numeric:
             if n_numeric >= limit:
                 total += 1
         for char, limits in self.chars.items():
-            n_char = sum(1 for c in line
-                         if c == char)
+            n_char = features.char_counts[char]
             for limit in limits:
                 if n_char >= limit:
                     total += 1
@@ -445,8 +712,9 @@ class FilterRepetitions(Filter):
         self.min_consequent = min_consequent
 
     def __call__(self, line, side_fobjs=None):
-        tokens = line.split()
-        counts = collections.Counter(tokens)
+        features = line_features(line)
+        tokens = features.tokens
+        counts = features.token_counts
         for word, count in counts.most_common():
             if count >= self.min_anywhere:
                 return True
@@ -484,6 +752,97 @@ class FilterEllipsis(FilterRegex):
         super().__init__((r'\.\.\.',))
 
 
+class BuildNgramIndex(Rule):
+    """Index of the long n-grams in reference sets (e.g. dev and test),
+    for FilterContaminated. Built once, shared by all filtering jobs.
+
+    References can be plain text, or WMT sgm files (.sgm).
+    The index is a sorted list of 64-bit n-gram hashes, one per line.
+    """
+    def __init__(self, references, index, n=8, **kwargs):
+        super().__init__(references, [index], **kwargs)
+        self.n = n
+
+    def make(self, conf, cli_args=None):
+        from ..wmt_sgm import read_sgm
+        hashes = set()
+        for ref in self.inputs:
+            lines = ref.open(conf, cli_args, mode='r')
+            if ref(conf, cli_args).endswith('.sgm'):
+                lines = (seg.text for seg in read_sgm(lines))
+            for line in lines:
+                hashes.update(ngram_hashes(line, self.n))
+        with self.outputs[0].open(conf, cli_args, mode='w') as fobj:
+            fobj.write('{}\t{}\n'.format(NGRAM_INDEX_HEADER, self.n))
+            for h in sorted(hashes):
+                fobj.write('{}\n'.format(h))
+
+
+class FilterContaminated(Filter):
+    """Filters out lines sharing long n-grams with reference sets.
+    index: made by BuildNgramIndex.
+    threshold: a line is removed if more than this proportion
+        of its n-grams occur in the references (0: any overlap).
+    Matching ignores case, punctuation and tokenization.
+    Lines shorter than n tokens match if identical to a short reference.
+    """
+    def __init__(self, index, threshold=0.):
+        super().__init__(side_inputs=[index])
+        self.index = index
+        self.threshold = threshold
+        self.n = None
+        self._hashes = None
+
+    def pre_make(self, side_fobjs):
+        fobj = side_fobjs[self.index]
+        if fobj not in _loaded_indices:
+            lines = iter(fobj)
+            header, n = next(lines).split('\t')
+            if header != NGRAM_INDEX_HEADER:
+                raise Exception('{} is not an n-gram index'.format(self.index))
+            # a flat sorted array: compact, and shared with forked workers
+            _loaded_indices[fobj] = (
+                int(n), array.array('Q', (int(line) for line in lines)))
+        self.n, self._hashes = _loaded_indices[fobj]
+
+    def __call__(self, line, side_fobjs=None):
+        if self._hashes is None:
+            self.pre_make(side_fobjs)
+        hashes = ngram_hashes(line, self.n)
+        if len(hashes) == 0:
+            return False
+        index = self._hashes
+        n_index = len(index)
+        hits = 0
+        for h in hashes:
+            i = bisect.bisect_left(index, h)
+            if i < n_index and index[i] == h:
+                hits += 1
+        return hits > self.threshold * len(hashes)
+
+
+NGRAM_INDEX_HEADER = '#ngram-index'
+# the same index file may be used by several filters
+_loaded_indices = weakref.WeakKeyDictionary()
+RE_WORD = re.compile(r'\w+')
+
+
+def ngram_hashes(line, n):
+    """Stable 64-bit hashes of the token n-grams of a line,
+    or of the whole line if it has fewer than n tokens"""
+    tokens = RE_WORD.findall(line.casefold())
+    if len(tokens) == 0:
+        return []
+    if len(tokens) < n:
+        ngrams = [tokens]
+    else:
+        ngrams = (tokens[i:i + n] for i in range(len(tokens) - n + 1))
+    return [int.from_bytes(hashlib.blake2b(
+                ' '.join(ngram).encode('utf-8'), digest_size=8).digest(),
+                'little')
+            for ngram in ngrams]
+
+
 ### Delayed filtering using mask
 
 class MonoFilterMask(MonoPipeComponent):
@@ -504,6 +863,9 @@ class MonoFilterMask(MonoPipeComponent):
                 # keep this line
                 yield "0"
 
+    def pre_make(self, side_fobjs):
+        self.filtr.pre_make(side_fobjs)
+
 # FIXME clunky: produces two identical outputs
 class ParallelFilterMask(ParallelPipeComponent):
     def __init__(self, filters):
@@ -540,6 +902,9 @@ class ParallelFilterMask(ParallelPipeComponent):
                 # keep this line
                 yield tuple("0" for _ in range(len(tpl)))
 
+    def pre_make(self, side_fobjs):
+        _pre_make_filters(self.filters, side_fobjs)
+
 
 class CombineFilterMasks(Rule):
     def __init__(self, inputs, output, func=None, **kwargs):
@@ -1,16 +1,30 @@
+import array
 import collections
+import hashlib
+import itertools
+import logging
+import os
 import random
+import shutil
+import tempfile
 
 from .core import PipeComponent, MonoPipeComponent, DeadEndPipe, \
-                  apply_component
-from ..core.recipe import Rule
+                  apply_component, Pipe, MonoPipe, ForEach, \
+                  SingleCellComponent
+from ..core.recipe import Rule, RecipeFile
+from ..core.utils import safe_zip, external_linecount
+
+logger = logging.getLogger('textpipes')
 
 def split_dataset(inputs, train_file,
                   dev_file=None, test_file=None,
                   dev_size=0, test_size=0, train_size=None,
                   resource_class='make_immediately',
+                  shuffle_memory=None,
                   **kwargs):
-    components = [Shuffle()]
+    """shuffle_memory: shuffle on disk, using at most this many bytes
+    of memory (see ExternalShuffle)"""
+    components = [_shuffler(shuffle_memory)]
     used_lines = 0
     if dev_size:
         assert dev_file is not None
@@ -38,8 +52,9 @@ def split_dataset_para(recipe,
                        inputs, tmp_files, train_files,
                        dev_files=None, test_files=None,
                        dev_size=0, test_size=0,
+                       shuffle_memory=None,
                        **kwargs):
-    recipe.add_rule(apply_component(Shuffle(), para=True, **kwargs)(inputs, tmp_files))
+    recipe.add_rule(apply_component(_shuffler(shuffle_memory), para=True, **kwargs)(inputs, tmp_files))
     used_lines = 0
     if dev_size:
         assert dev_files is not None
@@ -51,6 +66,148 @@ def split_dataset_para(recipe,
         used_lines += test_size
     recipe.add_rule(apply_component(Tail(used_lines), para=True, **kwargs)(tmp_files, train_files))
 
+class SplitDataset(Rule):
+    """Splits (parallel) inputs into train, dev and test sets
+    in a single streaming pass, without a shuffled tmp copy.
+
+    method='sample': dev and test are an exact size uniform random sample
+        (reservoir sampling, only dev_size + test_size lines in memory).
+        Train gets the rest, in roughly the original order.
+    method='hash': each line (tuple) is assigned by a seeded hash of
+        its content, dev_size and test_size are fractions.
+        Each line is written as soon as it is assigned.
+        The split is stable when the data grows, and duplicates
+        always end up in the same set.
+    train_size: optional limit on the number of train lines.
+    """
+    def __init__(self, inputs, train_files,
+                 dev_files=None, test_files=None,
+                 dev_size=0, test_size=0, train_size=None,
+                 method='sample',
+                 resource_class='make_immediately',
+                 **kwargs):
+        if isinstance(inputs, RecipeFile):
+            inputs = [inputs]
+        train_files = _as_list(train_files)
+        dev_files = _as_list(dev_files)
+        test_files = _as_list(test_files)
+        if method not in ('sample', 'hash'):
+            raise Exception('Unknown split method {}'.format(method))
+        for (files, size) in ((dev_files, dev_size), (test_files, test_size)):
+            if size and len(files) != len(inputs):
+                raise Exception('SplitDataset needs one output per input')
+        if len(train_files) != len(inputs):
+            raise Exception('SplitDataset needs one output per input')
+        super().__init__(inputs, train_files + dev_files + test_files,
+                         resource_class=resource_class, **kwargs)
+        self.train_files = train_files
+        self.dev_files = dev_files
+        self.test_files = test_files
+        self.dev_size = dev_size
+        self.test_size = test_size
+        self.train_size = train_size
+        self.method = method
+
+    def make(self, conf, cli_args=None):
+        readers = [inp.open(conf, cli_args, mode='r')
+                   for inp in self.inputs]
+        stream = safe_zip(*readers)
+        train = _SplitWriter(self.train_files, conf, cli_args,
+                             limit=self.train_size)
+        seed = _get_seed(conf)
+        if self.method == 'sample':
+            # the sample is known only after the whole pass
+            sample = self._reservoir(stream, train, seed)
+            heldout = self._heldout_writers(conf, cli_args)
+            for (writer, records) in zip(heldout, sample):
+                for record in records:
+                    writer.write(record)
+        else:
+            heldout = self._heldout_writers(conf, cli_args)
+            self._hash_split(stream, train, heldout, seed)
+        for writer in [train] + heldout:
+            writer.close()
+        for reader in readers:
+            reader.close()
+
+    def _heldout_writers(self, conf, cli_args):
+        return [_SplitWriter(files, conf, cli_args)
+                for files in (self.dev_files, self.test_files)]
+
+    def _reservoir(self, stream, train, seed):
+        rng = random.Random(seed)
+        dev_size = int(self.dev_size)
+        n_sample = dev_size + int(self.test_size)
+        reservoir = []
+        for (i, record) in enumerate(stream):
+            if i < n_sample:
+                reservoir.append(record)
+                continue
+            j = rng.randint(0, i)
+            if j < n_sample:
+                # the evicted record goes to train
+                record, reservoir[j] = reservoir[j], record
+            train.write(record)
+        if len(reservoir) < n_sample:
+            logger.warning('SplitDataset: only {} lines, '
+                           'expected more than {}'.format(
+                               len(reservoir), n_sample))
+        rng.shuffle(reservoir)
+        return reservoir[:dev_size], reservoir[dev_size:]
+
+    def _hash_split(self, stream, train, heldout, seed):
+        key = '{}'.format(seed).encode('utf-8')
+        dev_limit = float(self.dev_size)
+        test_limit = dev_limit + float(self.test_size)
+        if test_limit > 1:
+            raise Exception('with method=hash, dev_size and test_size '
+                            'are fractions')
+        (dev, test) = heldout
+        for record in stream:
+            digest = hashlib.blake2b(
+                '\t'.join(record).encode('utf-8'),
+                key=key, digest_size=8).digest()
+            point = int.from_bytes(digest, 'big') / (1 << 64)
+            if point < dev_limit:
+                dev.write(record)
+            elif point < test_limit:
+                test.write(record)
+            else:
+                train.write(record)
+
+
+class _SplitWriter(object):
+    def __init__(self, files, conf, cli_args, limit=None):
+        self.writers = [out.open(conf, cli_args, mode='w') for out in files]
+        self.limit = limit
+        self.n_written = 0
+
+    def write(self, record):
+        if self.limit is not None and self.n_written >= self.limit:
+            return
+        for (writer, line) in zip(self.writers, record):
+            writer.write(line)
+            writer.write('\n')
+        self.n_written += 1
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def _as_list(files):
+    if files is None:
+        return []
+    if isinstance(files, RecipeFile):
+        return [files]
+    return list(files)
+
+
+def _shuffler(shuffle_memory):
+    if shuffle_memory is None:
+        return Shuffle()
+    return ExternalShuffle(max_memory=shuffle_memory)
+
 
 class Head(PipeComponent):
     """Removes from the stream everything except for
@@ -69,6 +226,9 @@ class Head(PipeComponent):
                 break
             yield line
 
+    def select_lines(self, n_lines, config=None):
+        return range(min(self.limit, n_lines))
+
 class Tail(PipeComponent):
     """Skips the specified number of lines/tuples from the
     beginning, then outputs the rest."""
@@ -86,6 +246,9 @@ class Tail(PipeComponent):
                 continue
             yield line
 
+    def select_lines(self, n_lines, config=None):
+        return range(min(self.skip, n_lines), n_lines)
+
 class Slice(PipeComponent):
     """Yields the specified number of lines from the middle"""
     def __init__(self, start, end):
@@ -102,6 +265,9 @@ class Slice(PipeComponent):
             if self.start <= i < self.end:
                 yield line
 
+    def select_lines(self, n_lines, config=None):
+        return range(min(self.start, n_lines), min(self.end, n_lines))
+
 class RealTail(PipeComponent):
     """Removes from the stream everything except for
     the specified number of lines/tuples from the end"""
@@ -121,6 +287,9 @@ class RealTail(PipeComponent):
             yield line
         del self.deque
 
+    def select_lines(self, n_lines, config=None):
+        return range(max(n_lines - self.keep, 0), n_lines)
+
 class HeadTee(MonoPipeComponent):
     """Passes the stream unchanged, while copying
     the specified number of lines from the begining
@@ -194,6 +363,9 @@ class RoundRobin(PipeComponent):
             if i % self.num_shards == self.shard_idx:
                 yield line
 
+    def select_lines(self, n_lines, config=None):
+        return range(self.shard_idx, n_lines, self.num_shards)
+
 
 class DeRoundRobin(Rule):
     def __init__(self, inputs, output, multipliers=None):
@@ -242,17 +414,193 @@ class Shuffle(PipeComponent):
     def __call__(self, stream, side_fobjs=None,
                  config=None, cli_args=None):
         stream = list(stream)
-        try:
-            random.seed(config['exp']['seed'])
-        except KeyError:
-            pass
+        _seed(config)
         random.shuffle(stream)
         for line in stream:
             yield line
 
+    def select_lines(self, n_lines, config=None):
+        # same permutation as shuffling the lines themselves
+        order = array.array('Q', range(n_lines))
+        _seed(config)
+        random.shuffle(order)
+        return order
+
+
+class ExternalShuffle(PipeComponent):
+    """Full uniform shuffle within a bounded amount of memory.
+
+    The lines (or tuples) are scattered randomly into buckets on disk,
+    and each bucket is shuffled in memory. Buckets too large for
+    max_memory (bytes, roughly) are scattered again recursively.
+    Deterministic under exp:seed.
+
+    by_offset: if the main inputs have a line index (see lineindex),
+    shuffle the line offsets instead, and read the lines in random order
+    (needs 8 bytes of memory per line, and random reads are only fast
+    on SSDs). Gives a different (equally random) order than scattering.
+    """
+    def __init__(self, max_memory=1 << 30, n_buckets=64,
+                 tmp_dir=None, by_offset=False):
+        super().__init__()
+        self.max_memory = int(max_memory)
+        self.n_buckets = int(n_buckets)
+        self.tmp_dir = tmp_dir
+        self.by_offset = by_offset
+        # does not care if the data is mono or parallel
+        self._is_mono_pipe_component = True
+        self._is_parallel_pipe_component = True
+
+    def __call__(self, stream, side_fobjs=None,
+                 config=None, cli_args=None):
+        rng = random.Random(_get_seed(config))
+        buf = []
+        size = 0
+        stream = iter(stream)
+        for record in stream:
+            buf.append(record)
+            size += _record_size(record)
+            if size > self.max_memory:
+                break
+        else:
+            # fits in memory
+            rng.shuffle(buf)
+            yield from buf
+            return
+        tmp_dir = tempfile.mkdtemp(prefix='.shuffle.', dir=self.tmp_dir)
+        try:
+            yield from self._shuffle_external(
+                itertools.chain(buf, stream), rng, tmp_dir, 0)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _shuffle_external(self, records, rng, tmp_dir, depth):
+        n_cols = None
+        paths = [os.path.join(tmp_dir, '{}.{}'.format(depth, i))
+                 for i in range(self.n_buckets)]
+        sizes = [0] * self.n_buckets
+        counts = [0] * self.n_buckets
+        writers = [open(path, 'w', encoding='utf-8', newline='\n')
+                   for path in paths]
+        # scatter
+        for record in records:
+            if n_cols is None:
+                n_cols = len(record) if isinstance(record, tuple) else 0
+            i = rng.randrange(self.n_buckets)
+            if n_cols:
+                for cell in record:
+                    writers[i].write(cell)
+                    writers[i].write('\n')
+            else:
+                writers[i].write(record)
+                writers[i].write('\n')
+            sizes[i] += _record_size(record)
+            counts[i] += 1
+        for writer in writers:
+            writer.close()
+        # gather
+        for (path, size, count) in zip(paths, sizes, counts):
+            if size > self.max_memory and count > 1:
+                yield from self._shuffle_external(
+                    _read_records(path, n_cols), rng, tmp_dir, depth + 1)
+            else:
+                bucket = list(_read_records(path, n_cols))
+                rng.shuffle(bucket)
+                yield from bucket
+            os.remove(path)
+
+    def select_lines(self, n_lines, config=None):
+        if not self.by_offset or 8 * n_lines > self.max_memory:
+            return None
+        order = array.array('Q', range(n_lines))
+        random.Random(_get_seed(config)).shuffle(order)
+        return order
+
+
+def _record_size(record):
+    # roughly the memory use of the strs and containers
+    if isinstance(record, tuple):
+        return 56 + sum(_record_size(cell) for cell in record)
+    return 50 + len(record)
+
+
+def _read_records(path, n_cols):
+    with open(path, 'r', encoding='utf-8', newline='\n') as fobj:
+        lines = (line[:-1] for line in fobj)
+        if not n_cols:
+            yield from lines
+            return
+        while True:
+            record = tuple(itertools.islice(lines, n_cols))
+            if not record:
+                break
+            yield record
+
+
+def _get_seed(config):
+    try:
+        return config['exp']['seed']
+    except (KeyError, TypeError):
+        return None
+
+
+def _seed(config):
+    seed = _get_seed(config)
+    if seed is not None:
+        random.seed(seed)
+
+
+class Sample(PipeComponent):
+    """Uniform random sample of the specified number of lines/tuples,
+    without replacement, in their original order.
+
+    Reads only the sampled lines if the input has a line index,
+    otherwise keeps a reservoir of size lines in memory.
+    The two paths choose different (equally uniform) samples.
+
+    match_stream: with a line index, choose the same sample as
+        without one. This walks over all the line numbers,
+        instead of drawing only size of them.
+    """
+    def __init__(self, size, match_stream=False):
+        super().__init__()
+        self.size = int(size)
+        self.match_stream = match_stream
+        # does not care if the data is mono or parallel
+        self._is_mono_pipe_component = True
+        self._is_parallel_pipe_component = True
+
+    def __call__(self, stream, side_fobjs=None,
+                 config=None, cli_args=None):
+        _seed(config)
+        reservoir = _reservoir(enumerate(stream), self.size)
+        reservoir.sort(key=lambda pair: pair[0])
+        for (_, line) in reservoir:
+            yield line
+
+    def select_lines(self, n_lines, config=None):
+        _seed(config)
+        if self.match_stream:
+            return sorted(_reservoir(range(n_lines), self.size))
+        return sorted(random.sample(range(n_lines), min(self.size, n_lines)))
+
+
+def _reservoir(items, size):
+    """Algorithm R: uniform sample of size items"""
+    reservoir = []
+    for (i, item) in enumerate(items):
+        if i < size:
+            reservoir.append(item)
+            continue
+        j = random.randint(0, i)
+        if j < size:
+            reservoir[j] = item
+    return reservoir
+
 
 class Upsample(PipeComponent):
     """Repeats each line in the data n times.
+    See MixCorpora for upsampling without writing copies.
     """
     def __init__(self, n):
         super().__init__()
@@ -268,6 +616,203 @@ class Upsample(PipeComponent):
                 yield line
 
 
+class MixCorpora(Pipe):
+    """Interleaves several corpora in the requested proportions,
+    in a single stream. Upsampling is virtual: a corpus is re-read
+    as many times as needed, instead of writing copies.
+
+    corpora: list of corpora, each a RecipeFile,
+        or a tuple of RecipeFiles for parallel data.
+    outputs: a RecipeFile, or one for each column of parallel data.
+    weights: relative proportion of each corpus in the output.
+    temperature: alternatively, proportions are (line count)^(1/T).
+        T=1 keeps the natural proportions, higher T flattens them.
+    size: number of output lines. By default, the largest corpus
+        relative to its proportion is used exactly once (no downsampling).
+    reshuffle: shuffle each epoch of an upsampled corpus differently
+        (keeps the corpus in memory while it is read).
+    components: applied to the mixed stream before writing,
+        as in a MonoPipe or ParallelPipe.
+    If the output is ephemeral, and read only by a MonoPipe,
+    the mixing is fused into that pipe.
+    """
+    def __init__(self, corpora, outputs,
+                 weights=None, temperature=None, size=None,
+                 reshuffle=False, components=None, **kwargs):
+        corpora = [(corpus,) if isinstance(corpus, RecipeFile)
+                   else tuple(corpus) for corpus in corpora]
+        n_cols = len(corpora[0])
+        if any(len(corpus) != n_cols for corpus in corpora):
+            raise Exception('All corpora must have the same number of columns')
+        if isinstance(outputs, RecipeFile):
+            outputs = [outputs]
+        if len(outputs) != n_cols:
+            raise Exception('MixCorpora needs one output per column')
+        if weights is not None and temperature is not None:
+            raise Exception('Give either weights or temperature')
+        if weights is not None and len(weights) != len(corpora):
+            raise Exception('MixCorpora needs one weight per corpus')
+        self.parallel = n_cols > 1
+        components = list(components) if components is not None else []
+        if self.parallel:
+            components = [ForEach(component)
+                          if isinstance(component, SingleCellComponent)
+                          else component for component in components]
+        flag = '_is_parallel_pipe_component' if self.parallel \
+            else '_is_mono_pipe_component'
+        for component in components:
+            if not hasattr(component, flag):
+                raise Exception('MixCorpora received incompatible '
+                                'component {}'.format(component))
+        main_inputs = [inp for corpus in corpora for inp in corpus]
+        super().__init__(components, main_inputs, outputs, **kwargs)
+        self.corpora = corpora
+        self.weights = weights
+        self.temperature = temperature
+        self.size = size
+        self.reshuffle = reshuffle
+
+    def quotas(self, counts):
+        """Number of lines to take from each corpus"""
+        if self.weights is not None:
+            weights = [float(w) for w in self.weights]
+        elif self.temperature is not None:
+            weights = [count ** (1. / float(self.temperature))
+                       for count in counts]
+        else:
+            weights = [float(count) for count in counts]
+        total = sum(weights)
+        if total <= 0:
+            raise Exception('MixCorpora: nothing to mix')
+        probs = [w / total for w in weights]
+        size = self.size
+        if size is None:
+            size = max(count / prob for (count, prob)
+                       in zip(counts, probs) if prob > 0)
+        exact = [size * prob for prob in probs]
+        quotas = [int(x) for x in exact]
+        # largest remainder rounding to the exact size
+        missing = int(round(size)) - sum(quotas)
+        by_remainder = sorted(range(len(exact)),
+                              key=lambda i: quotas[i] - exact[i])
+        for i in by_remainder[:missing]:
+            quotas[i] += 1
+        for (i, count) in enumerate(counts):
+            if quotas[i] > 0 and count == 0:
+                raise Exception('MixCorpora: corpus {} is empty'.format(
+                    self.corpora[i]))
+        return quotas
+
+    def make(self, conf, cli_args=None):
+        seed = _get_seed(conf)
+        counts = [external_linecount(corpus[0](conf, cli_args))
+                  for corpus in self.corpora]
+        quotas = self.quotas(counts)
+        for (corpus, count, quota) in zip(self.corpora, counts, quotas):
+            logger.info('{}: {} lines, using {} ({:.2f} epochs)'.format(
+                corpus[0].sec_key(), count, quota,
+                quota / count if count else 0))
+        streams = [self._corpus_stream(corpus, count, quota,
+                                       random.Random('{}:{}'.format(seed, i)),
+                                       conf, cli_args)
+                   for (i, (corpus, count, quota))
+                   in enumerate(zip(self.corpora, counts, quotas))]
+        stream = mix_streams(streams, quotas, random.Random(seed))
+        stream, side_fobjs = self._make_helper(stream, conf, cli_args)
+        writers = [out.open(conf, cli_args, mode='w')
+                   for out in self.main_outputs]
+        for record in stream:
+            if not self.parallel:
+                record = (record,)
+            for (writer, line) in zip(writers, record):
+                writer.write(line)
+                writer.write('\n')
+        self._post_make(side_fobjs)
+        for fobj in writers + list(side_fobjs.values()):
+            fobj.close()
+
+    def _corpus_stream(self, corpus, count, quota, rng, conf, cli_args):
+        full, part = divmod(quota, count) if count else (0, 0)
+        for epoch in range(full + (1 if part else 0)):
+            n_take = count if epoch < full else part
+            readers = [inp.open(conf, cli_args, mode='r') for inp in corpus]
+            try:
+                records = safe_zip(*readers) if self.parallel else readers[0]
+                if self.reshuffle:
+                    records = list(records)
+                    rng.shuffle(records)
+                    records = records[:n_take]
+                elif n_take < count:
+                    records = _selection_sample(records, count, n_take, rng)
+                yield from records
+            finally:
+                # also when the consumer stops at the end of the quota
+                for reader in readers:
+                    reader.close()
+
+    def fuse(self, consumer, intermediate):
+        if self.parallel or self.outputs != (intermediate,):
+            return None
+        if not isinstance(consumer, MonoPipe) \
+                or isinstance(consumer, DeadEndPipe) \
+                or type(consumer).make is not MonoPipe.make:
+            return None
+        if tuple(consumer.main_inputs) != (intermediate,) \
+                or intermediate in consumer.side_inputs:
+            return None
+        if self.resource_class != consumer.resource_class \
+                or self.chain_schedule != 1 or consumer.chain_schedule != 1:
+            return None
+        components = list(self.components) + list(consumer.components)
+        if sum(getattr(component, 'mp', False) for component in components) > 1:
+            # multiprocessing supports only one mp component per pipe
+            return None
+        from_components = set(rf for component in components
+                              for rf in tuple(component.side_inputs)
+                              + tuple(component.side_outputs))
+        return MixCorpora(
+            self.corpora, consumer.main_outputs,
+            weights=self.weights, temperature=self.temperature,
+            size=self.size, reshuffle=self.reshuffle,
+            components=components,
+            extra_side_inputs=[inp for inp
+                               in set(self.side_inputs + consumer.side_inputs)
+                               if inp not in from_components],
+            extra_side_outputs=[out for out in consumer.side_outputs
+                                if out not in from_components],
+            name='{}+{}'.format(self.name, consumer.name),
+            resource_class=consumer.resource_class)
+
+
+def mix_streams(streams, quotas, rng):
+    """Random interleaving, taking exactly quotas[i] items from streams[i]"""
+    streams = [iter(stream) for stream in streams]
+    remaining = list(quotas)
+    total = sum(remaining)
+    while total > 0:
+        r = rng.randrange(total)
+        for (i, rem) in enumerate(remaining):
+            if r < rem:
+                break
+            r -= rem
+        remaining[i] -= 1
+        total -= 1
+        try:
+            yield next(streams[i])
+        except StopIteration:
+            raise Exception('stream {} ended before its quota'.format(i))
+
+
+def _selection_sample(records, count, n_take, rng):
+    """Uniform sample of exactly n_take of count records, in order"""
+    for (i, record) in enumerate(records):
+        if n_take == 0:
+            break
+        if rng.random() * (count - i) < n_take:
+            n_take -= 1
+            yield record
+
+
 class ChunkSplit(Rule):
     def __init__(self, inp, outputs, lines_per_chunk):
         super().__init__([inp], outputs)
@@ -5,6 +5,7 @@ import logging
 
 logger = logging.getLogger('textpipes')
 
+from ..core.matcher import Matcher
 from ..core.utils import read_lang_file, FIVEDOT
 from .core import SingleCellComponent, RegexSubstitution
 
@@ -207,10 +208,14 @@ class Tokenize(SingleCellComponent):
         # recombine protected
         for (src, tgt) in self.protected_str:
             out = out.replace(src, tgt)
-        for pattern in self.protected_re:
+        # only the matching patterns, in order
+        i = self.protected_re.first_match(out)
+        while i is not None:
+            pattern = self.protected_re.compiled[i]
             for src in self._unique(pattern.findall(out)):
                 tgt = src.replace(' ', '')
                 out = out.replace(src, tgt)
+            i = self.protected_re.first_match(out, i + 1)
         # do mappings
         for (src, tgt) in self.map_re:
             out = src.sub(tgt, out)
@@ -236,7 +241,7 @@ class Tokenize(SingleCellComponent):
         return result
 
     def _compile_re(self, patterns):
-        return [re.compile(pattern, flags=re.UNICODE) for pattern in patterns]
+        return Matcher(patterns, flags=re.UNICODE)
 
     def _compile_map(self, patterns):
         return [(re.compile(pattern, flags=re.UNICODE), tgt)
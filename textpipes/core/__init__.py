@@ -1,4 +1,5 @@
 from .recipe import Recipe, LoopRecipeFile, IndirectRecipeFile, WildcardLoopRecipeFile
+from .recipe import ShardRecipeFile, ShardedRecipeFile
 from .configuration import Config
 from .utils import safe_zip, progress
 from . import utils, platform
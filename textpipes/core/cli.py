@@ -3,12 +3,16 @@ import collections
 import importlib
 import itertools
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import re
+import time
+import traceback
 from datetime import datetime, timedelta
 
 from .configuration import Config, GridConfig
-from .platform import run, parse_override_string
+from .platform import run, parse_override_string, read_array_task, read_task_file, job_id_key
 from .recipe import *
 from .utils import *
 
@@ -73,6 +77,21 @@ def get_parser(recipe):
     parser.add_argument('--ingest-manual', default=False, action='store_true',
                         help='Mark all files of unknown origin as ok. '
                         '(if logs are out of sync for some reason)')
+    parser.add_argument('--pack', default=None, type=str, metavar='CLASSES',
+                        help='Pack the steps with one of these resource classes '
+                        'into a single job per class, '
+                        'running them in dependency order. '
+                        'Comma separated list of strings.')
+    parser.add_argument('--shared-scan', default=False, action='store_true',
+                        help='Run the jobs reading the same main inputs '
+                        'as a single job, reading the inputs only once.')
+    parser.add_argument('--daemon', default=False, action='store_true',
+                        help='Keep running, scheduling jobs as soon as '
+                        'their inputs are done. Status is written to '
+                        'logs/daemon.CONF.status')
+    parser.add_argument('--poll-interval', default=60, type=int, metavar='SECONDS',
+                        help='How often the daemon polls job statuses. '
+                        'Default: 60 seconds.')
 
     parser.add_argument('--make', default=None, type=str, metavar='OUTPUT',
                         help='Output to make, in section:key format. '
@@ -80,6 +99,12 @@ def get_parser(recipe):
     parser.add_argument('--overrides', default=None, type=str, metavar='str',
                         help='Overridden params in grid search. '
                         'You should NOT call this directly')
+    parser.add_argument('--make-array', default=None, type=str, metavar='TASKS',
+                        help='Make the output of the current job array task. '
+                        'You should NOT call this directly')
+    parser.add_argument('--make-packed', default=None, type=str, metavar='TASKS',
+                        help='Make all the outputs packed into this job. '
+                        'You should NOT call this directly')
 
     return parser
 
@@ -95,11 +120,21 @@ class CLI(object):
             patch_conf = Config()
             patch_conf.read(patch_conf_file, self.args)
             self.conf = GridConfig.apply_override(self.conf, patch_conf)
+        if self.args.make_array is not None:
+            # a task of a job array: the task file tells what to make
+            self.args.make, self.args.overrides = read_array_task(
+                self.args.make_array)
+        if self.args.make_packed is not None:
+            # all steps of a pack share the same overrides
+            self.packed_tasks = read_task_file(self.args.make_packed)
+            self.args.overrides = self.packed_tasks[0][1]
         if self.args.grid is not None:
             self.grid_conf = GridConfig(self.args.grid, self.args)
         else:
             self.grid_conf = None
-            if self.args.make is not None and self.args.overrides is not None:
+            making = self.args.make is not None \
+                or self.args.make_packed is not None
+            if making and self.args.overrides is not None:
                 # when in making mode,
                 # apply overrides before constructing recipe
                 # to enable e.g. conf-based control flow
@@ -128,6 +163,9 @@ class CLI(object):
     def main(self):
         """Called after building the recipe,
         when we are ready for action"""
+        # the recipe is complete: validate it once.
+        # in --check the problems are reported instead of raised
+        self.recipe.validate(raise_on_error=not self.args.check)
         if self.args.check:
             self.check_validity()
             return  # don't do anything more
@@ -143,30 +181,17 @@ class CLI(object):
         if self.args.make is not None:
             self.make(self.args.make, self.args.overrides)
             return  # don't do anything more
+        if self.args.make_packed is not None:
+            self.make_packed(self.packed_tasks)
+            return  # don't do anything more
+        if self.args.daemon:
+            self.daemon()
+            return  # don't do anything more
         # implicit else 
 
-        if self.grid_conf is None:
-            nextsteps = self.recipe.get_next_steps_for(
-                outputs=self.args.output,
-                cli_args=self.cli_args,
-                recursive=self.args.recursive)
-        else:
-            nextsteps = self.recipe.grid_next_steps(
-                grid=self.grid_conf.get_overrides(self.conf),
-                outputs=self.args.output,
-                cli_args=self.cli_args,
-                recursive=self.args.recursive)
-
-        if self.args.resource_classes is not None:
-            if self.args.recursive:
-                print('WARNING: recursive with filtered is experimental')
-            nextsteps = self._filter_by_resource(nextsteps,
-                                                 self.args.resource_classes.split(','))
-        if self.args.only_rules is not None:
-            if self.args.recursive:
-                print('WARNING: recursive with filtered is experimental')
-            nextsteps = self._filter_by_rule(nextsteps,
-                                             self.args.only_rules.split(','))
+        nextsteps = self._next_steps()
+        if not self.args.shared_scan:
+            self._hint_shared_scan(nextsteps)
 
         if self.args.fail_running:
             for step in nextsteps.running:
@@ -191,6 +216,104 @@ class CLI(object):
                                  verbose=self.args.verbose,
                                  show_all=self.args.show_all)
 
+    def _next_steps(self, quiet=False):
+        if self.grid_conf is None:
+            nextsteps = self.recipe.get_next_steps_for(
+                outputs=self.args.output,
+                cli_args=self.cli_args,
+                recursive=self.args.recursive)
+        else:
+            nextsteps = self.recipe.grid_next_steps(
+                grid=self.grid_conf.get_overrides(self.conf),
+                outputs=self.args.output,
+                cli_args=self.cli_args,
+                recursive=self.args.recursive)
+
+        if self.args.resource_classes is not None:
+            if self.args.recursive and not quiet:
+                print('WARNING: recursive with filtered is experimental')
+            nextsteps = self._filter_by_resource(nextsteps,
+                                                 self.args.resource_classes.split(','))
+        if self.args.only_rules is not None:
+            if self.args.recursive and not quiet:
+                print('WARNING: recursive with filtered is experimental')
+            nextsteps = self._filter_by_rule(nextsteps,
+                                             self.args.only_rules.split(','))
+        return nextsteps
+
+    def daemon(self):
+        """Keeps the recipe and logs in memory,
+        scheduling newly available jobs as their inputs become done.
+        Exits when nothing is left to wait for."""
+        status_file = os.path.join(
+            'logs', 'daemon.{}.status'.format(self.conf.name))
+        # job ids that have been seen waiting or running
+        active = set()
+        iteration = 0
+        print('Daemon started, polling every {} seconds. '
+              'Status in {}'.format(self.args.poll_interval, status_file))
+        try:
+            while True:
+                iteration += 1
+                # only reread what may have changed since last round
+                self.log.refresh()
+                self.platform.poll(sorted(active))
+                self.recipe.status_of.clear()
+                nextsteps = self._next_steps(quiet=iteration > 1)
+                if not self.args.dryrun:
+                    self.schedule(nextsteps)
+                    if len(nextsteps.available) + len(nextsteps.delayed) > 0:
+                        self.show_next_steps(
+                            NextSteps([], [], [],
+                                      nextsteps.available, nextsteps.delayed),
+                            immediate=self.platform.make_immediately,
+                            verbose=self.args.verbose,
+                            show_all=self.args.show_all)
+                active = set(step.job_id
+                             for step in itertools.chain(
+                                nextsteps.waiting, nextsteps.running,
+                                nextsteps.available, nextsteps.delayed)
+                             if step.job_id not in ('-', 'None'))
+                self._write_daemon_status(status_file, iteration, nextsteps)
+                if self.args.dryrun or len(active) == 0:
+                    break
+                if not self.platform.make_immediately:
+                    # local jobs have already finished
+                    time.sleep(self.args.poll_interval)
+        except KeyboardInterrupt:
+            print('Daemon interrupted. Scheduled jobs are not affected.')
+            return
+        # nothing is running: either everything is done, or something failed
+        self.recipe.status_of.clear()
+        nextsteps = self._next_steps(quiet=True)
+        self._write_daemon_status(status_file, iteration, nextsteps, final=True)
+        if len(self.recipe.status_of.failed()) > 0:
+            print('Daemon stopped: some jobs failed. '
+                  'See {}'.format(status_file))
+        elif len(nextsteps.available) > 0:
+            print('Daemon stopped with jobs available but not scheduled')
+        else:
+            print('Daemon finished: nothing more to schedule')
+
+    def _write_daemon_status(self, status_file, iteration, nextsteps, final=False):
+        timestamp = datetime.now().strftime(TIMESTAMP)
+        lines = ['{} iteration {} {}'.format(
+            timestamp, iteration, 'stopped' if final else 'polling')]
+        for step in itertools.chain(*nextsteps):
+            lines.append('{}\t{}\t{}\t{}'.format(
+                step.status, step.job_id, step.sec_key,
+                step.concrete[0] if step.concrete else '-'))
+        for rf in sorted(self.recipe.status_of.failed()):
+            lines.append('failed\t-\t{}\t{}'.format(
+                rf.sec_key(), rf(self.conf, self.cli_args)))
+        os.makedirs('logs', exist_ok=True)
+        # replace atomically, so that readers never see a partial file
+        tmp_file = status_file + '.tmp'
+        with open_text_file(tmp_file, mode='w') as fobj:
+            fobj.write('\n'.join(lines))
+            fobj.write('\n')
+        os.replace(tmp_file, status_file)
+
     def check_validity(self):
         # check that script is correctly named
         try:
@@ -266,11 +389,24 @@ class CLI(object):
                 print('WARNING: {} all point to {}'.format(
                     ', '.join('{}:{}'.format(sec, key) for sec, key in sec_keys),
                     path))
+        # check consistency of the DAG
+        validation = self.recipe.validate()
+        for cycle in validation.cycles:
+            print('********** CIRCULAR DEPENDENCY: {}'.format(
+                ' -> '.join(rf.sec_key() for rf in cycle)))
+        for (rule, rf) in validation.dangling:
+            print('dangling input: {} (used by {})'.format(
+                rf.sec_key(), rule.name))
+        for rf in validation.unbound:
+            print('unbound output: {}'.format(rf.sec_key()))
+        if len(validation.cycles) + len(validation.dangling) == 0:
+            print('Recipe DAG OK')
+        for (rf, rule) in self.recipe.fused:
+            print('streamed, not written: {} (in {})'.format(
+                rf.sec_key(), rule.name))
         # check that output paths are in config
         warn = []
         for (rf, rule) in self.recipe.files.items():
-            if rule == UNBOUND_OUTPUT:
-                print('unbound output: {}:{}'.format(rf.section, rf.key))
             try:
                 fname = rf(self.conf, self.cli_args)
                 if fname == '':
@@ -386,13 +522,32 @@ class CLI(object):
                 for output in step.outputs:
                     wait_ids[output] = step.job_id
 
-        for step in nextsteps.available + nextsteps.delayed:
-            wait_for_jobs = []
-            unk_deps = False
+        # steps with the same rule, resource class and dependencies
+        # are collected, to be scheduled together as a job array.
+        # steps to pack are collected by resource class
+        arrays = collections.OrderedDict()
+        packs = collections.OrderedDict()
+        # outputs of collected steps, not yet scheduled -> pack key
+        pending = {}
+        for step in self._order_by_depth(nextsteps.available + nextsteps.delayed):
             if step.rule.blocks_recursion:
                 print('Not scheduling manual job "{}"'.format(step))
                 continue
+            pack_key = self._pack_key(step)
+            if any(inp in pending and (pack_key is None or pending[inp] != pack_key)
+                   for inp in step.inputs):
+                # the job ids of the collected steps are needed
+                self._schedule_arrays(arrays, wait_ids)
+                self._schedule_packs(packs, wait_ids)
+                arrays = collections.OrderedDict()
+                packs = collections.OrderedDict()
+                pending = {}
+            wait_for_jobs = []
+            unk_deps = False
             for inp in step.inputs:
+                if inp in pending:
+                    # made earlier in the same pack
+                    continue
                 if inp not in wait_ids:
                     if not self.platform.make_immediately:
                         print('Dont know what id to wait on for ', inp)
@@ -407,32 +562,149 @@ class CLI(object):
                 conf = self.conf
             output_files = [(output.sec_key(), output(conf, self.cli_args))
                             for output in sorted(step.outputs)]
-            job_id = self.platform.schedule(
-                self.recipe, conf, step.rule, step.sec_key,
+            if pack_key is not None:
+                packs.setdefault(pack_key, []).append(
+                    (step, conf, output_files, wait_for_jobs))
+                for output in step.outputs:
+                    pending[output] = pack_key
+                continue
+            if self.platform.can_array(step.rule):
+                key = self._array_key(step, wait_for_jobs, arrays)
+                arrays.setdefault(key, []).append(
+                    (step, conf, output_files, wait_for_jobs))
+                for output in step.outputs:
+                    pending[output] = None
+                continue
+            self._schedule_step(step, conf, output_files, wait_for_jobs, wait_ids)
+        self._schedule_arrays(arrays, wait_ids)
+        self._schedule_packs(packs, wait_ids)
+
+    def _pack_key(self, step):
+        # the recipe is built once per pack, so overrides must match
+        overrides = tuple(sorted(step.overrides.items()))
+        if self.args.shared_scan:
+            scan_key = step.rule.scan_key()
+            if scan_key is not None and self.platform.can_pack(step.rule):
+                return ('shared_scan', step.rule.resource_class, overrides, scan_key)
+        if self.args.pack is None or self.platform.make_immediately:
+            return None
+        if step.rule.resource_class not in self.args.pack.split(','):
+            return None
+        if not self.platform.can_pack(step.rule):
+            return None
+        return ('pack', step.rule.resource_class, overrides, None)
+
+    def _hint_shared_scan(self, nextsteps):
+        scans = collections.defaultdict(list)
+        for step in nextsteps.available + nextsteps.delayed:
+            scan_key = step.rule.scan_key()
+            if scan_key is not None:
+                scans[(scan_key, tuple(sorted(step.overrides.items())))].append(step)
+        for ((scan_key, _), steps) in sorted(scans.items()):
+            if len(steps) > 1:
+                print('HINT: {} jobs read {}. '
+                      'Use --shared-scan to read it only once.'.format(
+                        len(steps), ', '.join(rf.sec_key() for rf in scan_key[1])))
+
+    def _array_key(self, step, wait_for_jobs, arrays):
+        deps = tuple(sorted(set(wait_for_jobs), key=job_id_key))
+        if len(deps) == 1 and '_' in deps[0]:
+            # depends only on one task of another array.
+            # If it is the corresponding task, the whole array
+            # can be scheduled with a single aftercorr dependency
+            array_id, task_id = deps[0].split('_')
+            key = (step.rule.name, step.rule.resource_class, 'aftercorr', array_id)
+            if len(arrays.get(key, [])) == int(task_id):
+                return key
+        return (step.rule.name, step.rule.resource_class, deps)
+
+    def _order_by_depth(self, steps):
+        """Stable sort of (topologically ordered) steps,
+        by the number of steps in the plan that they must wait for.
+        Allows collecting job arrays across independent chains."""
+        depth = {}
+        for step in steps:
+            step_depth = max([0] + [depth[inp] + 1 for inp in step.inputs
+                                    if inp in depth])
+            for output in step.outputs:
+                depth[output] = step_depth
+        return sorted(steps, key=lambda step: depth[step.outputs[0]])
+
+    def _schedule_step(self, step, conf, output_files, wait_for_jobs, wait_ids):
+        job_id = self.platform.schedule(
+            self.recipe, conf, step.rule, step.sec_key,
+            output_files, self.cli_args, deps=wait_for_jobs,
+            overrides=step.overrides, patches=self.args.patch_conf)
+        if job_id is None:
+            # not scheduled for some reason
+            return
+        step.job_id = job_id
+        self.log.scheduled(step.rule.name, step.sec_key, job_id, output_files)
+        if step.job_id is not None and step.job_id != '-':
+            for output in step.outputs:
+                wait_ids[output] = step.job_id
+        try:
+            self.platform.post_schedule(
+                job_id, self.recipe, self.conf, step.rule, step.sec_key,
                 output_files, self.cli_args, deps=wait_for_jobs,
                 overrides=step.overrides, patches=self.args.patch_conf)
-            if job_id is None:
-                # not scheduled for some reason
+        except Exception as e:
+            self.log.failed(job_id)
+            raise e
+        except KeyboardInterrupt as ki:
+            self.log.failed(job_id)
+            raise ki
+
+    def _schedule_arrays(self, arrays, wait_ids):
+        for (key, group) in arrays.items():
+            if len(group) == 1:
+                self._schedule_step(*group[0], wait_ids)
                 continue
-            step.job_id = job_id
-            self.log.scheduled(step.rule.name, step.sec_key, job_id, output_files)
-            if step.job_id is not None and step.job_id != '-':
+            step, conf, output_files, wait_for_jobs = group[0]
+            tasks = [(step.sec_key, step.overrides)
+                     for (step, _, _, _) in group]
+            if 'aftercorr' in key:
+                job_ids = self.platform.schedule_array(
+                    self.recipe, self.conf, step.rule, tasks, self.cli_args,
+                    corr=key[-1], patches=self.args.patch_conf)
+            else:
+                job_ids = self.platform.schedule_array(
+                    self.recipe, self.conf, step.rule, tasks, self.cli_args,
+                    deps=wait_for_jobs, patches=self.args.patch_conf)
+            for ((step, conf, output_files, _), job_id) in zip(group, job_ids):
+                step.job_id = job_id
+                self.log.scheduled(step.rule.name, step.sec_key, job_id, output_files)
                 for output in step.outputs:
                     wait_ids[output] = step.job_id
-            try:
-                self.platform.post_schedule(
-                    job_id, self.recipe, self.conf, step.rule, step.sec_key,
-                    output_files, self.cli_args, deps=wait_for_jobs,
-                    overrides=step.overrides, patches=self.args.patch_conf)
-            except Exception as e:
-                self.log.failed(job_id)
-                raise e
-            except KeyboardInterrupt as ki:
-                self.log.failed(job_id)
-                raise ki
+
+    def _schedule_packs(self, packs, wait_ids):
+        for (key, group) in packs.items():
+            if len(group) == 1:
+                self._schedule_step(*group[0], wait_ids)
+                continue
+            (mode, resource_class, _, _) = key
+            tasks = [(step.sec_key, step.overrides)
+                     for (step, _, _, _) in group]
+            deps = []
+            for (_, _, _, wait_for_jobs) in group:
+                deps.extend(dep for dep in wait_for_jobs if dep not in deps)
+            job_ids = self.platform.schedule_pack(
+                self.recipe, self.conf, resource_class, tasks, self.cli_args,
+                deps=deps, shared_scan=(mode == 'shared_scan'),
+                patches=self.args.patch_conf)
+            for ((step, conf, output_files, _), job_id) in zip(group, job_ids):
+                step.job_id = job_id
+                self.log.scheduled(step.rule.name, step.sec_key, job_id, output_files)
+                for output in step.outputs:
+                    wait_ids[output] = step.job_id
+            self.platform.post_schedule_pack(job_ids)
 
     def make(self, output, override_str):
         overrides = parse_override_string(override_str)
+        next_step, job_id = self._next_step_to_make(output, overrides)
+        self._make_helper(output, next_step, job_id, overrides=overrides)
+
+    def _next_step_to_make(self, output, overrides):
         next_steps = self.recipe.get_next_steps_for(
             outputs=[output], cli_args=self.cli_args, overrides=overrides)
         concat = next_steps.waiting + next_steps.running + next_steps.available
@@ -444,7 +716,116 @@ class CLI(object):
         if job_id is None:
             raise Exception('No scheduled job id for {}'.format(
                 next_step.concrete[0]))
-        self._make_helper(output, next_step, job_id, overrides=overrides)
+        return next_step, job_id
+
+    def make_packed(self, tasks):
+        """Makes several outputs within one job, in dependency order.
+        Independent steps are run in parallel, if the platform
+        gives more than one core.
+        A failed step only prevents the steps depending on it."""
+        if self.args.shared_scan:
+            self.make_shared_scan(tasks)
+            return
+        outputs = [self.recipe._rf(sec_key) for (sec_key, _) in tasks]
+        index_of = {}
+        for (i, output) in enumerate(outputs):
+            for rf in self.recipe.files[output].outputs:
+                index_of[rf] = i
+        # index -> indices of packed steps it depends on
+        deps = [set(index_of[inp] for inp in self.recipe.files[output].inputs
+                    if inp in index_of)
+                for output in outputs]
+        cores = max(1, self.platform.pack_cores())
+        remaining = list(range(len(tasks)))
+        done = set()
+        failed = set()
+        # process sentinel -> (index, process)
+        running = {}
+        ctx = multiprocessing.get_context('fork')
+        while len(remaining) > 0 or len(running) > 0:
+            for i in list(remaining):
+                if len(running) >= cores:
+                    break
+                if len(deps[i] & failed) > 0:
+                    print('Not making {}: depends on a failed step'.format(tasks[i][0]))
+                    self._fail_packed(outputs[i])
+                    failed.add(i)
+                    remaining.remove(i)
+                    continue
+                if len(deps[i] - done) > 0:
+                    continue
+                remaining.remove(i)
+                if cores == 1:
+                    # no need to fork
+                    try:
+                        self._make_packed_step(*tasks[i])
+                        done.add(i)
+                    except Exception:
+                        traceback.print_exc()
+                        self._fail_packed(outputs[i])
+                        failed.add(i)
+                    continue
+                process = ctx.Process(target=self._make_packed_step, args=tasks[i])
+                process.start()
+                running[process.sentinel] = (i, process)
+            if len(running) == 0:
+                continue
+            for sentinel in multiprocessing.connection.wait(list(running.keys())):
+                i, process = running.pop(sentinel)
+                process.join()
+                if process.exitcode == 0:
+                    done.add(i)
+                else:
+                    self._fail_packed(outputs[i])
+                    failed.add(i)
+        if len(failed) > 0:
+            raise Exception('{} of {} packed steps failed: {}'.format(
+                len(failed), len(tasks),
+                ', '.join(tasks[i][0] for i in sorted(failed))))
+
+    def make_shared_scan(self, tasks):
+        """Makes several outputs, reading their common main input once.
+        Each step is logged separately."""
+        overrides = parse_override_string(tasks[0][1])
+        if overrides:
+            conf = GridConfig.apply_override(self.conf, overrides)
+        else:
+            conf = self.conf
+        steps = []
+        for (sec_key, _) in tasks:
+            next_step, job_id = self._next_step_to_make(sec_key, overrides)
+            rule = self.recipe.files.get(next_step.outputs[0], None)
+            self.log.started_running(next_step, job_id, rule.name)
+            steps.append((next_step, job_id, rule))
+        errors = self.recipe.make_shared_scan(
+            [sec_key for (sec_key, _) in tasks],
+            conf=conf, cli_args=self.cli_args)
+        failed = []
+        for ((next_step, job_id, rule), error) in zip(steps, errors):
+            if error is None:
+                self.log.finished_running(next_step, job_id, rule.name)
+            else:
+                print('{} failed: {}'.format(next_step.sec_key, error))
+                self._fail_packed(next_step.outputs[0])
+                failed.append(next_step.sec_key)
+        if len(failed) > 0:
+            raise Exception('{} of {} steps failed: {}'.format(
+                len(failed), len(tasks), ', '.join(failed)))
+
+    def _make_packed_step(self, sec_key, override_str):
+        # earlier steps have changed the files and logs
+        self.recipe.status_of.clear()
+        self.log.refresh()
+        self.make(sec_key, override_str)
+
+    def _fail_packed(self, output):
+        rule = self.recipe.files[output]
+        concrete = [rf(self.conf, self.cli_args) for rf in rule.outputs]
+        job_id = self.log.job_id_from_outputs(concrete)
+        if job_id is not None:
+            # parse the job log, to fill in the fields
+            self.log.get_status_of_output(concrete[0])
+            self.log.failed(job_id)
 
     def _make_helper(self, output, next_step, job_id, overrides=None):
         rule = self.recipe.files.get(next_step.outputs[0], None)
@@ -647,19 +1028,33 @@ class ExperimentLog(object):
         logitem = self.failed(job_id)
         self.parsed_job_logs[job_id] = logitem
 
+    def refresh(self):
+        """Rereads the logs, to see changes made by running jobs.
+        Items of finished or failed jobs are kept,
+        as they will not change anymore."""
+        self.now = datetime.now()
+        self.log_file_to_jobid_current = os.path.join(
+            'logs', 'file_to_jobid.{date}.log'.format(
+                date=self.now.strftime(LOG_HISTORY)))
+        self.parsed_job_logs = {
+            job_id: logitem
+            for (job_id, logitem) in self.parsed_job_logs.items()
+            if logitem.status in ('done', 'failed')}
+        self._parse_log(self.log_file_to_jobid_current)
+
     @property
     def last_job_id(self):
-        return max([0] + list(int(x) for x in self.outputs.values()
+        return max([0] + list(job_id_key(x)[0] for x in self.outputs.values()
                               if x != 'IngestedManual'))
 
     def job_id_from_outputs(self, concrete):
         job_ids = [self.outputs[out] for out in concrete
                    if out in self.outputs]
-        job_ids = [int(x) for x in job_ids 
+        job_ids = [x for x in job_ids 
                    if x not in ('-', 'IngestedManual')]
         if len(job_ids) == 0:
             return None
-        return max(job_ids)
+        return max(job_ids, key=job_id_key)
 
     def status(self):
         """Status summary from deeply parsing log"""
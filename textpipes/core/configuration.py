@@ -28,6 +28,7 @@ class Config(object):
         self.platform = platform
         self.conf = conf
         self.current_autolog_path = None
+        self.current_progress_path = None
         self.force = False
         self.ingest_manual = False
 
@@ -101,6 +102,8 @@ class Config(object):
     def autolog_for_jobid(self, job_id, sec_key):
         self.current_autolog_path = self.platform.autolog_for_jobid(
             job_id, self, sec_key)
+        self.current_progress_path = self.platform.progress_for(
+            self, sec_key)
         return self.current_autolog_path
 
     def __getitem__(self, key):
@@ -0,0 +1,243 @@
+"""Random access into gzip files, using a sidecar index.
+
+The index (cached next to the file as FILE.gzidx) contains
+checkpoints mapping line numbers to uncompressed byte offsets,
+and the compressed offsets of the gzip members.
+Decompression can start at any member, so files consisting of
+many members (bgzip, pigz -i, concatenated gzips) are fully seekable.
+Single member files are seekable if the optional indexed_gzip package
+(zran checkpoints of the decompressor state) is installed,
+otherwise seeking falls back to decompressing from the start.
+"""
+
+import bisect
+import io
+import json
+import logging
+import os
+import zlib
+
+logger = logging.getLogger('textpipes')
+
+INDEX_SUFFIX = '.gzidx'
+ZRAN_SUFFIX = '.gzidx.zran'
+READ_SIZE = 1 << 20
+
+
+class GzipIndex(object):
+    def __init__(self, path, size, mtime_ns,
+                 lines, members, n_lines, n_bytes, zran=False):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        # [line number, uncompressed offset of its start]
+        self.lines = lines
+        self._line_keys = [line for (line, _) in lines]
+        self._offset_keys = [offset for (_, offset) in lines]
+        # [uncompressed offset, compressed offset] of members
+        self.members = members
+        self._member_keys = [offset for (offset, _) in members]
+        self.n_lines = n_lines
+        self.n_bytes = n_bytes
+        self.zran = zran
+
+    def is_fresh(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (self.size, self.mtime_ns)
+
+    def checkpoint_for_line(self, line):
+        """Last checkpoint at or before the line -> (line, offset)"""
+        i = bisect.bisect_right(self._line_keys, line) - 1
+        return tuple(self.lines[max(i, 0)])
+
+    def checkpoint_for_offset(self, offset):
+        """Last line start at or before the offset -> (line, offset)"""
+        i = bisect.bisect_right(self._offset_keys, offset) - 1
+        return tuple(self.lines[max(i, 0)])
+
+    def member_for_offset(self, offset):
+        """Last member start at or before the offset
+        -> (uncompressed offset, compressed offset)"""
+        i = bisect.bisect_right(self._member_keys, offset) - 1
+        return tuple(self.members[max(i, 0)])
+
+    def save(self, index_path):
+        data = {
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'lines': self.lines,
+            'members': self.members,
+            'n_lines': self.n_lines,
+            'n_bytes': self.n_bytes,
+            'zran': self.zran,
+        }
+        tmp = '{}.tmp{}'.format(index_path, os.getpid())
+        with open(tmp, 'w') as fobj:
+            json.dump(data, fobj)
+        os.replace(tmp, index_path)
+
+    @classmethod
+    def load(cls, path, index_path):
+        with open(index_path, 'r') as fobj:
+            data = json.load(fobj)
+        return cls(path, **data)
+
+
+def build_index(path, spacing=4 << 20):
+    """Scans a gzip file, placing a checkpoint
+    at the first line start after every spacing bytes."""
+    stat = os.stat(path)
+    lines = [[0, 0]]
+    members = [[0, 0]]
+    n_lines = 0
+    n_bytes = 0
+    next_checkpoint = spacing
+    compressed_pos = 0
+    decomp = zlib.decompressobj(wbits=31)
+    prev_byte = b'\n'
+    with open(path, 'rb') as fobj:
+        pending = b''
+        while True:
+            if not pending:
+                pending = fobj.read(READ_SIZE)
+                if not pending:
+                    break
+            data = decomp.decompress(pending)
+            member_ended = decomp.eof
+            if member_ended:
+                # a new member starts after the unused data
+                unused = decomp.unused_data
+                compressed_pos += len(pending) - len(unused)
+                pending = unused
+                decomp = zlib.decompressobj(wbits=31)
+            else:
+                compressed_pos += len(pending)
+                pending = b''
+            if data:
+                while n_bytes + len(data) > next_checkpoint:
+                    pos = data.find(b'\n', max(next_checkpoint - n_bytes - 1, 0))
+                    if pos < 0:
+                        break
+                    # the line starting after this newline
+                    lines.append([n_lines + data.count(b'\n', 0, pos + 1),
+                                  n_bytes + pos + 1])
+                    next_checkpoint = lines[-1][1] + spacing
+                n_lines += data.count(b'\n')
+                n_bytes += len(data)
+                prev_byte = data[-1:]
+            # record member starts spaced at least spacing bytes apart
+            if member_ended and n_bytes - members[-1][0] >= spacing:
+                members.append([n_bytes, compressed_pos])
+    if len(members) > 1 and members[-1][1] >= stat.st_size:
+        # no member starts at the end of the file
+        members.pop()
+    if prev_byte != b'\n':
+        # last line lacks a newline
+        n_lines += 1
+    # checkpoints past the end are useless
+    lines = [cp for cp in lines if cp[1] < n_bytes or cp == [0, 0]]
+    zran = False
+    if len(members) == 1 and n_bytes > spacing:
+        zran = _build_zran(path, spacing)
+    return GzipIndex(path, stat.st_size, stat.st_mtime_ns,
+                     lines, members, n_lines, n_bytes, zran=zran)
+
+
+def _build_zran(path, spacing):
+    try:
+        import indexed_gzip
+    except ImportError:
+        logger.info('indexed_gzip not installed: '
+                    'seeking in {} will be slow'.format(path))
+        return False
+    with indexed_gzip.IndexedGzipFile(path, spacing=spacing) as fobj:
+        fobj.build_full_index()
+        fobj.export_index(path + ZRAN_SUFFIX)
+    return True
+
+
+def get_index(path, build=True):
+    """Loads the cached index, (re)building it if necessary"""
+    index_path = path + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        try:
+            index = GzipIndex.load(path, index_path)
+            if index.is_fresh():
+                return index
+        except (ValueError, KeyError, TypeError):
+            pass
+    if not build:
+        return None
+    index = build_index(path)
+    try:
+        index.save(index_path)
+    except OSError:
+        logger.warning('could not cache index {}'.format(index_path))
+    return index
+
+
+def _open_binary_at(path, index, offset):
+    """Binary stream of the decompressed data, starting at offset"""
+    if index.zran:
+        import indexed_gzip
+        fobj = indexed_gzip.IndexedGzipFile(
+            path, index_file=path + ZRAN_SUFFIX)
+        fobj.seek(offset)
+        return fobj
+    import gzip
+    member_offset, compressed_offset = index.member_for_offset(offset)
+    raw = open(path, 'rb')
+    raw.seek(compressed_offset)
+    fobj = gzip.GzipFile(fileobj=raw, mode='rb')
+    # closing the GzipFile does not close a given fileobj
+    fobj.myfileobj = raw
+    _skip_bytes(fobj, offset - member_offset)
+    return fobj
+
+
+def _skip_bytes(fobj, n_bytes):
+    while n_bytes > 0:
+        data = fobj.read(min(n_bytes, READ_SIZE))
+        if not data:
+            break
+        n_bytes -= len(data)
+
+
+def open_gzip_at(path, line=None, offset=None, encoding='utf-8',
+                 build=True):
+    """Opens a gzip file for reading, starting at
+    the given line number (counting from 0),
+    or the start of the first line at or after the given
+    uncompressed byte offset.
+    Without build, a missing index is not built:
+    the file is decompressed up to the start instead."""
+    import gzip
+    if not line and not offset:
+        # reading from the start needs no index
+        return gzip.open(path, 'rt', encoding=encoding)
+    index = get_index(path, build=build)
+    if index is None:
+        fobj = gzip.open(path, 'rb')
+        if line is not None:
+            to_skip = line
+        else:
+            _skip_bytes(fobj, offset - 1)
+            to_skip = 0
+    elif line is not None:
+        cp_line, cp_offset = index.checkpoint_for_line(line)
+        to_skip = line - cp_line
+        fobj = _open_binary_at(path, index, cp_offset)
+    else:
+        # the previous byte tells if offset is at a line start
+        to_skip = 0
+        fobj = _open_binary_at(path, index, offset - 1)
+    if line is None:
+        if fobj.read(1) != b'\n':
+            fobj.readline()
+    for _ in range(to_skip):
+        if not fobj.readline():
+            break
+    return io.TextIOWrapper(fobj, encoding=encoding)
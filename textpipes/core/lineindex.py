@@ -0,0 +1,142 @@
+"""Line offset index, for reading selected lines without a full scan.
+
+The index is a sidecar file FILE.lidx: a header followed by
+an array of uint64 byte offsets (in the uncompressed data)
+of the start of each line.
+Plain files can be read in any order. In gzip files
+only contiguous ranges are cheap (see gzindex).
+"""
+
+import array
+import bz2
+import gzip
+import itertools
+import lzma
+import os
+
+from .utils import open_text_file_at
+
+INDEX_SUFFIX = '.lidx'
+MAGIC = int.from_bytes(b'tp-lidx1', 'little')
+READ_SIZE = 1 << 20
+
+
+class LineIndex(object):
+    def __init__(self, path, size, mtime_ns, offsets):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.offsets = offsets
+
+    @property
+    def n_lines(self):
+        return len(self.offsets)
+
+    def is_fresh(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (self.size, self.mtime_ns)
+
+    def save(self, index_path):
+        header = array.array('Q', [MAGIC, self.size, self.mtime_ns,
+                                   len(self.offsets)])
+        tmp = '{}.tmp{}'.format(index_path, os.getpid())
+        with open(tmp, 'wb') as fobj:
+            header.tofile(fobj)
+            self.offsets.tofile(fobj)
+        os.replace(tmp, index_path)
+
+    @classmethod
+    def load(cls, path, index_path):
+        header = array.array('Q')
+        offsets = array.array('Q')
+        with open(index_path, 'rb') as fobj:
+            header.fromfile(fobj, 4)
+            if header[0] != MAGIC:
+                raise ValueError('not a line index: {}'.format(index_path))
+            offsets.fromfile(fobj, header[3])
+        return cls(path, header[1], header[2], offsets)
+
+
+def build_line_index(path):
+    """Scans the file, recording the offset of each line start"""
+    stat = os.stat(path)
+    offsets = array.array('Q', [0])
+    pos = 0
+    with _open_binary(path) as fobj:
+        while True:
+            data = fobj.read(READ_SIZE)
+            if not data:
+                break
+            # the lines starting after each newline in this block
+            starts = itertools.accumulate(
+                (len(piece) + 1 for piece in data.split(b'\n')[:-1]),
+                initial=pos)
+            offsets.extend(itertools.islice(starts, 1, None))
+            pos += len(data)
+    if offsets[-1] == pos:
+        # nothing after the last newline
+        offsets.pop()
+    return LineIndex(path, stat.st_size, stat.st_mtime_ns, offsets)
+
+
+def get_line_index(path, build=False):
+    """Loads the index, if it exists and is up to date.
+    If build is True, a missing or stale index is (re)built."""
+    index_path = path + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        try:
+            index = LineIndex.load(path, index_path)
+            if index.is_fresh():
+                return index
+        except (ValueError, EOFError):
+            pass
+    if not build:
+        return None
+    index = build_line_index(path)
+    index.save(index_path)
+    return index
+
+
+def is_contiguous(lines):
+    return isinstance(lines, range) and lines.step == 1
+
+
+def can_seek(path, lines):
+    """Random order reads are only cheap in plain files"""
+    return is_contiguous(lines) or not compressed(path)
+
+
+def read_lines(path, index, lines):
+    """Yields the selected lines (by index, in the given order),
+    without newlines."""
+    if len(lines) == 0:
+        return
+    if is_contiguous(lines):
+        # a missing gzip index is not worth building for one range
+        with open_text_file_at(path, offset=index.offsets[lines[0]],
+                               build_index=False) as fobj:
+            for line in itertools.islice(fobj, len(lines)):
+                yield line.rstrip('\n')
+        return
+    offsets = index.offsets
+    with open(path, 'rb') as fobj:
+        for i in lines:
+            fobj.seek(offsets[i])
+            yield fobj.readline().decode('utf-8').rstrip('\n')
+
+
+def compressed(path):
+    return path.endswith(('.gz', '.bz2', '.xz'))
+
+
+def _open_binary(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
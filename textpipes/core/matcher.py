@@ -0,0 +1,184 @@
+"""Matching a large set of patterns against a line in a single pass.
+
+Literal patterns (e.g. re.escape'd word lists) are compiled into
+an Aho-Corasick automaton, the rest into a single combined alternation
+(or checked one by one, if they can not be combined).
+Small pattern sets are simply checked one by one.
+"""
+
+import bisect
+import collections
+import re
+
+# patterns checked one by one up to this many
+MATCHER_THRESHOLD = 20
+
+# characters with a special meaning, when not escaped
+RE_SPECIAL = set('.^$*+?{}[]|()\\')
+
+
+class Matcher(object):
+    """Which of a list of regular expressions match a line.
+
+    The result is the same as checking the expressions one by one,
+    so components applying the patterns in order can skip the ones
+    that don't match: see first_match.
+    """
+    def __init__(self, patterns, flags=re.UNICODE, threshold=None):
+        threshold = threshold if threshold is not None else MATCHER_THRESHOLD
+        self.patterns = list(patterns)
+        self.compiled = [re.compile(pattern, flags=flags)
+                         for pattern in self.patterns]
+        self.plain = len(self.patterns) <= threshold
+        self._automaton = None
+        self._literal_indices = []
+        self._combined = None
+        self._combined_indices = []
+        self._separate_indices = []
+        self._last = (None, 0, [])
+        if self.plain:
+            return
+        literals = []
+        combinable = []
+        base_flags = re.compile('', flags=flags).flags
+        for (i, (pattern, exp)) in enumerate(zip(self.patterns, self.compiled)):
+            literal = None
+            if not flags & (re.IGNORECASE | re.VERBOSE):
+                literal = unescape_literal(pattern)
+            if literal is not None:
+                self._literal_indices.append(i)
+                literals.append(literal)
+            elif exp.groups == 0 and exp.flags == base_flags:
+                # (groups could break backreferences, inline flags the syntax)
+                self._combined_indices.append(i)
+                combinable.append(pattern)
+            else:
+                self._separate_indices.append(i)
+        if literals:
+            self._automaton = AhoCorasick(literals)
+        if combinable:
+            self._combined = re.compile(
+                '|'.join('(?:{})'.format(pattern) for pattern in combinable),
+                flags=flags)
+
+    def search(self, line):
+        """True if any of the patterns matches the line"""
+        if self.plain:
+            return any(exp.search(line) for exp in self.compiled)
+        if self._automaton is not None and self._automaton.occurring(line):
+            return True
+        if self._combined is not None and self._combined.search(line):
+            return True
+        return any(self.compiled[i].search(line)
+                   for i in self._separate_indices)
+
+    def matching(self, line, start=0):
+        """Sorted indices of the patterns (starting from start)
+        matching the line"""
+        if self.plain:
+            return [i for i in range(start, len(self.compiled))
+                    if self.compiled[i].search(line)]
+        last_line, last_start, last_result = self._last
+        if line == last_line and last_start <= start:
+            return last_result[bisect.bisect_left(last_result, start):]
+        result = []
+        if self._automaton is not None:
+            result.extend(i for i in (self._literal_indices[j] for j
+                                      in self._automaton.occurring(line))
+                          if i >= start)
+        combined = self._combined_indices[
+            bisect.bisect_left(self._combined_indices, start):]
+        if combined and self._combined.search(line):
+            # at least one of them matches, find out which
+            result.extend(i for i in combined
+                          if self.compiled[i].search(line))
+        result.extend(i for i in self._separate_indices
+                      if i >= start and self.compiled[i].search(line))
+        result.sort()
+        self._last = (line, start, result)
+        return result
+
+    def first_match(self, line, start=0):
+        """Index of the first pattern (starting from start)
+        matching the line, or None"""
+        if self.plain:
+            for i in range(start, len(self.compiled)):
+                if self.compiled[i].search(line):
+                    return i
+            return None
+        result = self.matching(line, start)
+        if len(result) == 0:
+            return None
+        return result[0]
+
+
+class AhoCorasick(object):
+    """Finds which of a set of strings occur in a text,
+    including overlapping occurrences, in one pass over the text."""
+    def __init__(self, strings):
+        # state 0 is the root
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for (j, string) in enumerate(strings):
+            state = 0
+            for char in string:
+                nxt = self.goto[state].get(char, None)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = nxt
+                state = nxt
+            self.output[state].append(j)
+        # breadth first: fail links of shallower states are ready
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for (char, nxt) in self.goto[state].items():
+                queue.append(nxt)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def occurring(self, text):
+        """Set of indices of the strings occurring in the text"""
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        found = set(output[0])
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+def unescape_literal(pattern):
+    """The string matched by the pattern, if it is a literal
+    (only escaped special characters), otherwise None"""
+    chars = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            if char.isalnum() or char == '_':
+                # character classes, anchors, backreferences
+                return None
+            chars.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in RE_SPECIAL:
+            return None
+        else:
+            chars.append(char)
+    if escaped:
+        return None
+    return ''.join(chars)
@@ -1,10 +1,14 @@
+import collections
 import logging
 import os
 import re
 import shlex
+import signal
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 
 logger = logging.getLogger('textpipes')
 
@@ -42,6 +46,58 @@ def patch_conf_string(patch_confs):
         return ''
     return ' '.join('--patch-conf {}'.format(patch_conf) for patch_conf in patch_confs)
 
+def job_id_key(job_id):
+    """Sort key for job ids. Job array tasks have ids like 123_7,
+    steps packed into one allocation ids like 123.7"""
+    return tuple(int(x) for x in re.split(r'[_.]', str(job_id)))
+
+def platform_job_id(job_id):
+    """The id known by the platform: the allocation of a packed step"""
+    return str(job_id).split('.')[0]
+
+def dependency_string(deps):
+    if not deps:
+        return ''
+    dep_ids = []
+    for dep in deps:
+        dep = platform_job_id(dep)
+        if dep not in dep_ids:
+            dep_ids.append(dep)
+    return ' --dependency=afterok:' + ':'.join(dep_ids)
+
+# job arrays and packed jobs: each line of the task file describes one task
+# sec_key<TAB>override string (possibly empty)
+
+def write_task_file(path, tasks):
+    with open(path, 'w') as fobj:
+        for (sec_key, overrides) in tasks:
+            override_str = ';'.join(
+                '{}={}'.format(key, val)
+                for (key, val) in sorted(overrides.items())) \
+                if overrides else ''
+            fobj.write('{}\t{}\n'.format(sec_key, override_str))
+
+def read_task_file(path):
+    """-> list of (sec_key, override string or None)"""
+    result = []
+    with open(path, 'r') as fobj:
+        for line in fobj:
+            line = line.rstrip('\n')
+            if len(line) == 0:
+                continue
+            sec_key, override_str = line.split('\t')
+            result.append((sec_key, override_str if override_str else None))
+    return result
+
+def read_array_task(path, task_id=None):
+    """-> (sec_key, override string or None) of the current array task"""
+    if task_id is None:
+        try:
+            task_id = os.environ['SLURM_ARRAY_TASK_ID']
+        except KeyError:
+            raise Exception('--make-array must be called within a job array')
+    return read_task_file(path)[int(task_id)]
+
 class Platform(object):
     def __init__(self, name, conf):
         self.name = name
@@ -64,12 +120,57 @@ class Platform(object):
         # -> job id (or None if not scheduled)
         raise NotImplementedError()
 
+    def can_array(self, rule):
+        """True if steps of this rule can be scheduled as a job array"""
+        return False
+
+    def schedule_array(self, recipe, conf, rule, tasks, cli_args, deps=None, corr=None, patches=None):
+        # tasks: list of (sec_key, overrides)
+        # corr: id of an array, each task waits for its corresponding task
+        # -> list of job ids, one for each task
+        raise NotImplementedError()
+
     def post_schedule(self, job_id, recipe, conf, rule, sec_key, output_files, cli_args, deps=None, overrides=None, patches=None):
         pass
 
+    def can_pack(self, rule):
+        """True if steps of this rule can be packed into one job"""
+        return False
+
+    def schedule_pack(self, recipe, conf, resource_class, tasks, cli_args, deps=None, shared_scan=False, patches=None):
+        # tasks: list of (sec_key, overrides), in dependency order
+        # shared_scan: tasks read the same input, which is read only once
+        # -> list of job ids, one for each task
+        raise NotImplementedError()
+
+    def post_schedule_pack(self, job_ids):
+        pass
+
+    def _pack_cmd(self, recipe, conf, resource_class, tasks, shared_scan=False, patches=None):
+        os.makedirs('slurmlogs', exist_ok=True)
+        fd, task_file = tempfile.mkstemp(
+            prefix='{}_pack_{}_'.format(conf.name, resource_class),
+            suffix='.tasks', dir='slurmlogs')
+        os.close(fd)
+        write_task_file(task_file, tasks)
+        return 'python {recipe}.py {conf}.ini --make-packed {task_file}{scan} --platform {platform}{pargs} {patch_str}'.format(
+            recipe=recipe.name, conf=conf.name, task_file=task_file,
+            scan=' --shared-scan' if shared_scan else '',
+            platform=self.name, pargs=passthrough_args(conf),
+            patch_str=patch_conf_string(patches))
+
+    def pack_cores(self):
+        """Number of packed steps to run in parallel"""
+        return 1
+
     def check_job(self, job_id):
         raise NotImplementedError()
 
+    def poll(self, job_ids):
+        """Refreshes cached status of the given jobs,
+        in as few queries as possible"""
+        pass
+
     def resource_class(self, resource_class):
         if 'resource_classes' not in self.conf:
             return ''
@@ -83,6 +184,10 @@ class Platform(object):
     def autolog_for_jobid(self, job_id, conf, sec_key):
         return 'slurmlogs/{}_{}_{}.stdout'.format(conf.name, sec_key, job_id)
 
+    def progress_for(self, conf, sec_key):
+        """Latest progress reported by an external tool"""
+        return 'slurmlogs/{}_{}.progress'.format(conf.name, sec_key)
+
 
 class Local(Platform):
     def __init__(self, *args, **kwargs):
@@ -101,6 +206,22 @@ class Local(Platform):
         """Run immediately, instead of scheduling"""
         r = run(self._cmd(recipe, conf, sec_key, overrides=overrides, patches=patches))
 
+    def can_pack(self, rule):
+        return True
+
+    def schedule_pack(self, recipe, conf, resource_class, tasks, cli_args, deps=None, shared_scan=False, patches=None):
+        self._pack_cmd_pending = self._pack_cmd(
+            recipe, conf, resource_class, tasks,
+            shared_scan=shared_scan, patches=patches)
+        self.job_id += 1
+        return ['{}.{}'.format(self.job_id, i) for i in range(len(tasks))]
+
+    def post_schedule_pack(self, job_ids):
+        """Run immediately, instead of scheduling"""
+        cmd = self._pack_cmd_pending
+        self._pack_cmd_pending = None
+        r = run(cmd)
+
     def check_job(self, job_id):
         return 'local'
 
@@ -133,6 +254,18 @@ class Slurm(Platform):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._job_status = {}
+        # steps of the same rule, resource class and dependencies
+        # are grouped into job arrays, unless disabled in platform conf
+        if 'job_arrays' in self.conf:
+            arr_conf = self.conf['job_arrays']
+            self.use_arrays = arr_conf.getboolean('enabled', True)
+            # MaxArraySize of slurm limits the task ids
+            self.max_array_size = arr_conf.getint('max_size', 1000)
+            self.max_array_running = arr_conf.getint('max_running', 0)
+        else:
+            self.use_arrays = True
+            self.max_array_size = 1000
+            self.max_array_running = 0
 
     def schedule(self, recipe, conf, rule, sec_key, output_files, cli_args, deps=None, overrides=None, patches=None):
         rc_args = self.resource_class(rule.resource_class)
@@ -141,11 +274,8 @@ class Slurm(Platform):
         job_name = '{}:{}'.format(conf.name, sec_key)
         log_str = 'slurmlogs/{}_{}_%j.slurmout'.format(conf.name, sec_key)
         for i in range(rule.chain_schedule):
-            if deps:
-                dep_args = ' --dependency=afterok:' + ':'.join(
-                    str(dep) for dep in deps)
-            else:
-                dep_args = ''
+            dep_args = dependency_string(deps)
+            if not deps:
                 deps = []
             sbatch = 'sbatch --job-name {name} {rc_args}{dep_args} -o {log} --wrap="{cmd}"'.format(
                 name=job_name, cmd=cmd.replace('"', r'\"'), rc_args=rc_args,
@@ -158,9 +288,80 @@ class Slurm(Platform):
             deps.append(job_id)
         return job_id
 
+    def can_array(self, rule):
+        # chain scheduling needs separate jobs to depend on
+        return self.use_arrays and rule.chain_schedule == 1
+
+    def schedule_array(self, recipe, conf, rule, tasks, cli_args, deps=None, corr=None, patches=None):
+        rc_args = self.resource_class(rule.resource_class)
+        assert rc_args != 'make_immediately'
+        # task ids must match when using corr, so no splitting
+        assert corr is None or len(tasks) <= self.max_array_size
+        job_ids = []
+        for start in range(0, len(tasks), self.max_array_size):
+            chunk = tasks[start:(start + self.max_array_size)]
+            os.makedirs('slurmlogs', exist_ok=True)
+            fd, task_file = tempfile.mkstemp(
+                prefix='{}_{}_'.format(conf.name, rule.name),
+                suffix='.tasks', dir='slurmlogs')
+            os.close(fd)
+            write_task_file(task_file, chunk)
+            cmd = 'python {recipe}.py {conf}.ini --make-array {task_file} --platform {platform}{pargs} {patch_str}'.format(
+                recipe=recipe.name, conf=conf.name, task_file=task_file,
+                platform=self.name, pargs=passthrough_args(conf),
+                patch_str=patch_conf_string(patches))
+            job_name = '{}:{}[{}]'.format(conf.name, rule.name, len(chunk))
+            log_str = 'slurmlogs/{}_{}_%A_%a.slurmout'.format(conf.name, rule.name)
+            array_str = '0-{}'.format(len(chunk) - 1)
+            if self.max_array_running > 0:
+                array_str += '%{}'.format(self.max_array_running)
+            if corr is not None:
+                dep_args = ' --dependency=aftercorr:{}'.format(corr)
+            else:
+                dep_args = dependency_string(deps)
+            sbatch = 'sbatch --job-name {name} --array={array} {rc_args}{dep_args} -o {log} --wrap="{cmd}"'.format(
+                name=job_name, array=array_str, cmd=cmd.replace('"', r'\"'),
+                rc_args=rc_args, dep_args=dep_args, log=log_str)
+            r = run(sbatch)
+            try:
+                array_id = str(int(RE_SLURM_SUBMITTED_ID.match(r.std_out).group(1)))
+            except Exception:
+                raise Exception('Unexpected output from slurm: ' + r.describe())
+            # individual tasks are addressed as ARRAYID_TASKID
+            job_ids.extend('{}_{}'.format(array_id, i)
+                           for i in range(len(chunk)))
+        return job_ids
+
+    def can_pack(self, rule):
+        return rule.chain_schedule == 1
+
+    def schedule_pack(self, recipe, conf, resource_class, tasks, cli_args, deps=None, shared_scan=False, patches=None):
+        rc_args = self.resource_class(resource_class)
+        assert rc_args != 'make_immediately'
+        cmd = self._pack_cmd(recipe, conf, resource_class, tasks,
+                             shared_scan=shared_scan, patches=patches)
+        job_name = '{}:pack:{}[{}]'.format(conf.name, resource_class, len(tasks))
+        log_str = 'slurmlogs/{}_pack_{}_%j.slurmout'.format(conf.name, resource_class)
+        sbatch = 'sbatch --job-name {name} {rc_args}{dep_args} -o {log} --wrap="{cmd}"'.format(
+            name=job_name, cmd=cmd.replace('"', r'\"'), rc_args=rc_args,
+            dep_args=dependency_string(deps), log=log_str)
+        r = run(sbatch)
+        try:
+            alloc_id = str(int(RE_SLURM_SUBMITTED_ID.match(r.std_out).group(1)))
+        except Exception:
+            raise Exception('Unexpected output from slurm: ' + r.describe())
+        # packed steps are addressed as ALLOCID.STEP
+        return ['{}.{}'.format(alloc_id, i) for i in range(len(tasks))]
+
+    def pack_cores(self):
+        return int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+
     def check_job(self, job_id):
         if job_id == '-':
             return 'unknown'
+        # packed steps share the status of their allocation,
+        # until they log their own
+        job_id = platform_job_id(job_id)
         if job_id not in self._job_status:
             in_queue = self._parse_squeue(job_id)
         if job_id not in self._job_status:
@@ -172,22 +373,38 @@ class Slurm(Platform):
             return result
         return 'unknown'
 
+    def poll(self, job_ids):
+        # one query each to squeue and sacct, instead of one per job
+        self._job_status = {}
+        job_ids = sorted(set(platform_job_id(job_id) for job_id in job_ids
+                             if job_id != '-'))
+        if len(job_ids) == 0:
+            return
+        self._parse_squeue(','.join(job_ids))
+        finished = [job_id for job_id in job_ids
+                    if job_id not in self._job_status]
+        if len(finished) > 0:
+            self._parse_sacct(','.join(finished))
+
     def _parse_squeue(self, job_id):
+        # job_id can be a comma separated list of job ids
         print('***************** running squeue!', job_id)
-        r = run('squeue -j "{}" -hO jobid,state'.format(job_id), allow_fail=True)
+        # pending array tasks are only listed separately with -r
+        r = run('squeue -r -j "{}" -hO jobarrayid,state'.format(job_id), allow_fail=True)
+        in_queue = False
         for (i, line) in enumerate(r.std_out.split('\n')):
             if len(line.strip()) == 0:
                 continue
             parts = line.split()
             if len(parts) < 2:
-                return False
+                return in_queue
             if parts[0] == 'slurm_load_jobs':
-                return False
+                return in_queue
             elif parts[1] in ('PENDING', 'RUNNING'):
                 status = parts[1]
-                self._job_status[job_id] = ('0:00', '-', status, 'squeue')
-                return True
-            return False
+                self._job_status[parts[0]] = ('0:00', '-', status, 'squeue')
+                in_queue = True
+        return in_queue
 
     def _parse_sacct(self, job_id):
         print('***************** running sacct!', job_id)
@@ -274,7 +491,20 @@ classes = {
 }
 
 class Command(object):
-    def __init__(self, cmd):
+    """Runs a command, streaming its stdout and stderr.
+
+    Both streams are read concurrently by their own threads, so a chatty
+    tool can not deadlock by filling up one of the pipes.
+    If log is given, the lines are appended to it as they arrive and only
+    the last tail_lines of each stream are kept in memory.
+    Otherwise the full output of stdout is kept (for short helper
+    commands like git and sbatch), and subshell output is echoed.
+    progress is a regex (the first group, or the whole match, is used)
+    or a callable returning a string or None for each line.
+    The latest progress is written into progress_file.
+    """
+    def __init__(self, cmd, log=None, timeout=None,
+                 progress=None, progress_file=None, tail_lines=100):
         parts = shlex.split(cmd, posix=True)
         if any(x in parts for x in ('|', '>', '>>', '<')):
             # subshell args should not be split
@@ -283,55 +513,194 @@ class Command(object):
         else:
             self.cmd = parts
             self.subshell = False
+        self.log = log
+        self.timeout = timeout
+        if isinstance(progress, str):
+            progress = re.compile(progress)
+        self.progress = progress
+        self.progress_file = progress_file
+        self.tail_lines = tail_lines
         self.process = None
         self.out = None
         self.err = None
         self.returncode = None
         self.data = None
+        self.timed_out = False
+        self.signaled = None
+        self.terminated = False
+        self._lock = threading.Lock()
+        self._last_progress = 0
 
     def run(self):
-        if self.subshell:
-            self._run_shell()
-        else:
-            self._run_popen()
-        return self.out, self.err
-
-    def _run_shell(self):
-        self.returncode = subprocess.check_call(
-            self.cmd, shell=True)
-        self.out, self.err = None, None
-
-    def _run_popen(self):
-        def target():
+        if self.terminated:
+            raise Exception('Terminated before starting: {}'.format(self.cmd))
+        log_fobj = None
+        if self.log is not None:
+            os.makedirs(os.path.dirname(self.log) or '.', exist_ok=True)
+            log_fobj = open(self.log, 'a', encoding='utf-8')
+        keep_all = self.log is None and not self.subshell
+        echo = self.log is None and self.subshell
+        maxlen = None if keep_all else self.tail_lines
+        if self.progress_file is not None:
+            # progress of a previous attempt is stale
+            try:
+                os.remove(self.progress_file)
+            except OSError:
+                pass
+        out_lines = collections.deque(maxlen=maxlen)
+        err_lines = collections.deque(maxlen=self.tail_lines)
+        try:
             self.process = subprocess.Popen(
                 self.cmd,
-                universal_newlines=True,
                 shell=self.subshell,
                 env=os.environ,
-                stdin=subprocess.PIPE,
+                stdin=subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                bufsize=0,
+                universal_newlines=True,
+                errors='replace',
+                bufsize=1,
+                # own process group, so that the whole pipeline
+                # can be signaled
+                start_new_session=True,
             )
-            self.out, self.err = self.process.communicate(None)
-            # FIXME: this causes deadlocked sleep
-            #with self.process.stderr as lines:
-            #    for line in lines:
-            #        sys.stderr.write(line)
-            #        sys.stderr.flush()
-            #self.process.wait()
-            #self.out = self.process.stdout.read()
-
-        thread = threading.Thread(target=target)
-        thread.start()
-
-        thread.join()
-        if thread.is_alive():
-            self.process.terminate()
-            thread.join()
-        if self.process is None:
-            raise Exception('Running failed: {}'.format(self.cmd))
+        except OSError as e:
+            if log_fobj is not None:
+                log_fobj.close()
+            raise Exception('Running failed: {}: {}'.format(self.cmd, e))
+        readers = [
+            threading.Thread(
+                target=self._read,
+                args=(self.process.stdout, out_lines, log_fobj,
+                      sys.stdout if echo else None)),
+            threading.Thread(
+                target=self._read,
+                args=(self.process.stderr, err_lines, log_fobj,
+                      sys.stderr if echo else None)),
+        ]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        old_handlers = _forward_signals([self])
+        try:
+            try:
+                self.process.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                self.timed_out = True
+                self._kill()
+            for reader in readers:
+                reader.join()
+        finally:
+            _restore_signals(old_handlers)
+            if log_fobj is not None:
+                log_fobj.close()
         self.returncode = self.process.returncode
+        self.out = ''.join(out_lines)
+        self.err = ''.join(err_lines)
+        if self.signaled == signal.SIGINT:
+            raise KeyboardInterrupt()
+        if self.signaled is not None:
+            raise Exception('Terminated by signal {}: {}'.format(
+                self.signaled, self.cmd))
+        if self.timed_out:
+            raise Exception('Timeout after {} seconds: {}'.format(
+                self.timeout, self.cmd))
+        return self.out, self.err
+
+    def _read(self, pipe, lines, log_fobj, echo):
+        for line in iter(pipe.readline, ''):
+            lines.append(line)
+            if log_fobj is not None:
+                with self._lock:
+                    log_fobj.write(line)
+                    log_fobj.flush()
+            if echo is not None:
+                echo.write(line)
+                echo.flush()
+            if self.progress is not None:
+                self._parse_progress(line)
+        pipe.close()
+
+    def _parse_progress(self, line):
+        if callable(self.progress):
+            status = self.progress(line)
+        else:
+            m = self.progress.search(line)
+            if not m:
+                return
+            status = m.group(1) if m.groups() else m.group(0)
+        if status is None or self.progress_file is None:
+            return
+        # at most once per second
+        now = time.time()
+        with self._lock:
+            if now - self._last_progress < 1:
+                return
+            self._last_progress = now
+            write_progress(self.progress_file, status)
+
+    def terminate(self):
+        """Stops a running command and its subprocesses"""
+        self.terminated = True
+        if self.process is not None and self.process.poll() is None:
+            self._kill()
+
+    def _kill(self, grace=10):
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(timeout=grace)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+        except ProcessLookupError:
+            pass
+
+    def send_signal(self, signum):
+        """Forwards a signal to the command and its subprocesses"""
+        self.signaled = signum
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def _forward_signals(commands):
+    # signal handlers can only be set from the main thread
+    if threading.current_thread() is not threading.main_thread():
+        return {}
+
+    def forward(signum, frame):
+        for cmd in commands:
+            cmd.send_signal(signum)
+
+    old_handlers = {}
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        old_handlers[signum] = signal.signal(signum, forward)
+    return old_handlers
+
+def _restore_signals(old_handlers):
+    for signum, handler in old_handlers.items():
+        signal.signal(signum, handler)
+
+
+def write_progress(path, status):
+    """Atomically replaces the contents of a progress file"""
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as fobj:
+        fobj.write(str(status).strip())
+        fobj.write('\n')
+    os.replace(tmp, path)
+
+def read_progress(path):
+    """Returns the contents of a progress file, or None"""
+    try:
+        with open(path, 'r') as fobj:
+            return fobj.read().strip()
+    except OSError:
+        return None
 
 
 class Response(object):
@@ -361,11 +730,14 @@ class Response(object):
 
 
 
-def run(command, allow_fail=False):
+def run(command, allow_fail=False, log=None, timeout=None,
+        progress=None, progress_file=None):
     """Executes given command as subprocess.
-    If pipeing is necessary, uses a subshell."""
+    If pipeing is necessary, uses a subshell.
+    See Command for the streaming options."""
     logger.info(command)
-    cmd = Command(command)
+    cmd = Command(command, log=log, timeout=timeout,
+                  progress=progress, progress_file=progress_file)
     out, err = cmd.run()
 
     r = Response(process=cmd)
@@ -378,7 +750,51 @@ def run(command, allow_fail=False):
     if not allow_fail:
         if r.status_code != 0:
             print(r.std_err)
+            if log is not None:
+                print('full log in {}'.format(log))
             raise Exception('Nonzero status code {} when running {}'.format(
                 r.status_code, r.command))
 
     return r
+
+def run_parallel(commands, log=None):
+    """Executes the given commands as concurrent subprocesses.
+    Signals are forwarded to all of them.
+    If one of them fails, the others are terminated."""
+    cmds = []
+    for command in commands:
+        logger.info(command)
+        cmds.append(Command(command, log=log))
+    errors = {}
+    failed = []
+
+    def target(i):
+        try:
+            cmds[i].run()
+        except Exception as e:
+            errors[i] = e
+        if i in errors or cmds[i].returncode != 0:
+            failed.append(i)
+            for cmd in cmds:
+                cmd.terminate()
+
+    threads = [threading.Thread(target=target, args=(i,))
+               for i in range(len(cmds))]
+    old_handlers = _forward_signals(cmds)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        _restore_signals(old_handlers)
+    if any(cmd.signaled == signal.SIGINT for cmd in cmds):
+        raise KeyboardInterrupt()
+    if failed:
+        # report the first failure, not the terminated ones
+        i = failed[0]
+        if i in errors:
+            raise errors[i]
+        print(cmds[i].err)
+        raise Exception('Nonzero status code {} when running {}'.format(
+            cmds[i].returncode, commands[i]))
@@ -1,4 +1,5 @@
 import collections
+import functools
 import glob
 import itertools
 import logging
@@ -9,6 +10,8 @@ import tempfile
 
 from .utils import *
 from .configuration import GridConfig
+from .platform import read_progress
+from .lineindex import get_line_index
 
 logger = logging.getLogger('textpipes')
 
@@ -55,6 +58,14 @@ NextSteps = collections.namedtuple('NextSteps',
 OptionalDep = collections.namedtuple('OptionalDep',
     ['name', 'binary', 'component'])
 
+# result of Recipe.validate
+# cycles: lists of RecipeFiles forming a circular dependency
+# dangling: (rule, input) pairs, where input is not part of the recipe
+# unbound: outputs added without a rule to build them
+# order: RecipeFile -> position in topological order (inputs first)
+RecipeValidation = collections.namedtuple('RecipeValidation',
+    ['cycles', 'dangling', 'unbound', 'order'])
+
 class UnboundOutput(object):
     def __init__(self):
         self.opt_deps = set()
@@ -99,26 +110,45 @@ class Recipe(object):
         self.conf = self.cli.conf
         self.log = self.cli.log
         self.status_of = FileStatusCache(self.log, self.conf.platform)
+        # cached result of validate, cleared when the DAG changes
+        self._validation = None
+        # (ephemeral RecipeFile, fused Rule) pairs
+        self.fused = []
+        # RecipeFile -> the same RecipeFile object.
+        # Parsing a sec_key gives an equal but generic RecipeFile,
+        # subclasses (e.g. shards) deriving their paths need the original.
+        self._canonical = {}
 
     @classmethod
-    def _make_rf(cls, section, key, loop_index=None, **kwargs):
+    def _make_rf(cls, section, key, loop_index=None, shards=None, **kwargs):
+        if shards is not None:
+            assert loop_index is None
+            return ShardedRecipeFile(section, key, shards, **kwargs)
         if loop_index is None:
             return RecipeFile(section, key, **kwargs)
         else:
             return LoopRecipeFile(section, key, loop_index, **kwargs)
 
-    def add_input(self, section, key, loop_index=None, **kwargs):
+    def add_input(self, section, key, loop_index=None, shards=None, **kwargs):
         if isinstance(section, RecipeFile) and key is None:
             rf = section
         else:
-            rf = self._make_rf(section, key, loop_index=loop_index, **kwargs)
+            rf = self._make_rf(section, key, loop_index=loop_index,
+                               shards=shards, **kwargs)
         rf.atomic = True
         if rf not in self.files:
             self.files[rf] = None
+            self._canonical[rf] = rf
+            self._validation = None
+        if isinstance(rf, ShardedRecipeFile):
+            # the parts can be used separately
+            for part in rf.parts:
+                self.add_input(part, None)
         return rf
 
-    def add_output(self, section, key, loop_index=None, main=False, **kwargs):
-        rf = self._make_rf(section, key, loop_index=loop_index, **kwargs)
+    def add_output(self, section, key, loop_index=None, main=False, shards=None, **kwargs):
+        rf = self._make_rf(section, key, loop_index=loop_index,
+                           shards=shards, **kwargs)
         if rf in self.files:
             if self.files[rf] is None:
                 raise Exception('{} already defined as input. Not adding output.'.format(rf))
@@ -127,6 +157,8 @@ class Recipe(object):
         if main:
             self._main_out.add(rf)
         self.files[rf] = UNBOUND_OUTPUT
+        self._canonical[rf] = rf
+        self._validation = None
         return rf
 
     def use_output(self, section, key, loop_index=None, **kwargs):
@@ -150,6 +182,8 @@ class Recipe(object):
                         'Not adding rule {}. '
                         'There is already a rule for {}'.format(rule, rf))
             self.files[rf] = rule
+            self._canonical[rf] = rf
+        self._validation = None
         # FIXME: do we need to make index of rules?
         # FIXME: inconvenient to return all outputs. Only do main
         return rule.outputs
@@ -170,7 +204,7 @@ class Recipe(object):
                 raise Exception('Cannot parse section:key "{}"'.format(output))
         if check and rf not in self.files:
             raise Exception('No rule to make target {}'.format(output))
-        return rf
+        return self._canonical.get(rf, rf)
 
     def grid_next_steps(self,
                         grid,
@@ -300,88 +334,107 @@ class Recipe(object):
                                         concrete=[inp(self.conf, cli_args)],
                                         overrides=overrides)) for inp in missing))
 
-        # iteratively sort needed
-        while len(needed) > 0:
-            remaining = set()
-            not_yet = {}
-            for cursor in needed:
-                if cursor in known:
-                    if cursor not in seen_done:
-                        job_status = self.status_of(cursor, self.conf, cli_args)
-                        if job_status != 'no file':
-                            print('{} {} has a problem: {}'.format(
-                                cursor.sec_key(), cursor(self.conf, cli_args), job_status))
-                    # don't reschedule
-                    continue
-                rule = self.files[cursor]
-                if any(inp not in known for inp in rule.inputs):
-                    # has inputs that are not yet part of the plan
-                    remaining.add(cursor)
-                    not_yet[cursor] = [inp for inp in rule.inputs
-                                       if inp not in known]
-                    continue
-                known.update(rule.outputs)
-                not_done = tuple(inp for inp in rule.inputs
-                                 if inp not in seen_done)
-                concrete = [rf(self.conf, cli_args) for rf in rule.outputs]
-                if rule.blocks_recursion:
-                    blocked.add(cursor)
-                if any(inp in blocked for inp in rule.inputs):
-                    # this job is blocked from running
-                    blocked.add(cursor)
-                    continue
-                if len(not_done) > 0:
-                    # must wait for some inputs to be built first
-                    delayed.append(JobStatus('delayed',
-                        rule.outputs,
-                        inputs=not_done,
-                        rule=rule,
-                        concrete=concrete,
-                        overrides=overrides))
-                    continue
-                # implicit else: ready for scheduling
-                not_done_outputs = [
-                    out for out in rule.outputs
-                    if self.status_of(out, self.conf, cli_args) != DONE]
-
-                if len(not_done_outputs) == 0:
-                    raise Exception('tried to schedule job '
-                        'even though all outputs exist: {}'.format(rule))
-                available.append(JobStatus('available',
-                    not_done_outputs,
+        # sort needed, so that inputs are planned before the outputs
+        # that depend on them. A single pass suffices.
+        order = self.validate(raise_on_error=True).order
+        # cursor -> inputs that are not part of the plan
+        not_yet = {}
+        for cursor in sorted(needed, key=order.__getitem__):
+            if cursor in known:
+                if cursor not in seen_done:
+                    job_status = self.status_of(cursor, self.conf, cli_args)
+                    if job_status != 'no file':
+                        print('{} {} has a problem: {}'.format(
+                            cursor.sec_key(), cursor(self.conf, cli_args), job_status))
+                # don't reschedule
+                continue
+            rule = self.files[cursor]
+            if any(inp not in known for inp in rule.inputs):
+                # has inputs that can not become part of the plan
+                not_yet[cursor] = [inp for inp in rule.inputs
+                                   if inp not in known]
+                continue
+            known.update(rule.outputs)
+            not_done = tuple(inp for inp in rule.inputs
+                             if inp not in seen_done)
+            concrete = [rf(self.conf, cli_args) for rf in rule.outputs]
+            if rule.blocks_recursion:
+                blocked.add(cursor)
+            if any(inp in blocked for inp in rule.inputs):
+                # this job is blocked from running
+                blocked.add(cursor)
+                continue
+            if len(not_done) > 0:
+                # must wait for some inputs to be built first
+                delayed.append(JobStatus('delayed',
+                    rule.outputs,
+                    inputs=not_done,
                     rule=rule,
                     concrete=concrete,
                     overrides=overrides))
-            if len(remaining) == len(needed):
-                #err_str = '\n'.join(['{} depends on: {}'.format(
-                #    cursor, not_yet[cursor])
-                #    for cursor in remaining])
-                cursor, closure = self._detect_circles(not_yet)
-                if cursor is not None:
-                    err_str = '{} has circular dep:\n{}'.format(
-                        cursor, '\n'.join(str(x) for x in closure))
-                else:
-                    err_str = 'no circular dep found. {}'.format(
-                        '\n'.join(str(x) for x in not_yet))
-                raise Exception('unmet dependencies:\n{}'.format(err_str))
-            needed = remaining
+                continue
+            # implicit else: ready for scheduling
+            not_done_outputs = [
+                out for out in rule.outputs
+                if self.status_of(out, self.conf, cli_args) != DONE]
+
+            if len(not_done_outputs) == 0:
+                raise Exception('tried to schedule job '
+                    'even though all outputs exist: {}'.format(rule))
+            available.append(JobStatus('available',
+                not_done_outputs,
+                rule=rule,
+                concrete=concrete,
+                overrides=overrides))
+        if len(not_yet) > 0:
+            err_str = '\n'.join('{} depends on: {}'.format(cursor, deps)
+                                for (cursor, deps) in sorted(not_yet.items()))
+            raise Exception('unmet dependencies:\n{}'.format(err_str))
 
         delayed = delayed if recursive else []
         return NextSteps(done, waiting, running, available, delayed)
 
-    @staticmethod
-    def _detect_circles(not_yet):
-        closure = collections.defaultdict(set)
-        for cursor, deps in not_yet.items():
-            closure[cursor].update(deps)
-        for _ in range(50):
-            for cursor, deps in list(closure.items()):
-                deps = set(deps)
-                for dep in deps:
-                    closure[cursor].update(closure[dep])
-                    if cursor in closure[cursor]:
-                        return cursor, closure[cursor]
-        return None, set()
+    def validate(self, raise_on_error=False):
+        """Checks the consistency of the DAG.
+
+        Circular dependencies are found as strongly connected components,
+        in time linear in the size of the recipe.
+        Also finds dangling inputs and unbound outputs,
+        and a topological order for planning.
+        The result is cached until the recipe is modified.
+        """
+        if self._validation is None:
+            self._validation = self._validate()
+        if raise_on_error and len(self._validation.cycles) > 0:
+            raise Exception('circular dependencies:\n{}'.format(
+                '\n'.join(' -> '.join(str(rf) for rf in cycle)
+                          for cycle in self._validation.cycles)))
+        return self._validation
+
+    def _validate(self):
+        dangling = []
+        unbound = []
+        for (rf, rule) in sorted(self.files.items()):
+            if rule == UNBOUND_OUTPUT:
+                unbound.append(rf)
+            elif rule is not None:
+                dangling.extend((rule, inp) for inp in rule.inputs
+                                if inp not in self.files)
+
+        def dependencies(rf):
+            rule = self.files.get(rf, None)
+            if rule is None or rule == UNBOUND_OUTPUT:
+                return ()
+            return rule.inputs
+
+        cycles = []
+        order = {}
+        for component in strongly_connected(sorted(self.files), dependencies):
+            if len(component) > 1 or component[0] in dependencies(component[0]):
+                cycles.append(component)
+            for rf in component:
+                order[rf] = len(order)
+        return RecipeValidation(cycles, dangling, unbound, order)
 
     def check_mtime_inversions(self, outputs=None, cli_args=None, dump_paths=False):
         if not outputs:
@@ -451,6 +504,45 @@ class Recipe(object):
 
         return result
 
+    def make_shared_scan(self, outputs, conf=None, cli_args=None):
+        """Makes several outputs, whose Rules read the same main inputs.
+        The inputs are read only once, and the lines fanned out
+        to all the Rules.
+        -> list with the exception raised by each Rule, or None"""
+        if conf is None:
+            conf = self.conf
+        rules = [self.files[self._rf(output)] for output in outputs]
+        scan_key = rules[0].scan_key()
+        if scan_key is None or any(rule.scan_key() != scan_key for rule in rules):
+            raise Exception('Rules do not read the same main inputs: {}'.format(rules))
+        for rule in rules:
+            for out_rf in rule.outputs:
+                filepath = out_rf(conf, cli_args)
+                subdir, _ = os.path.split(filepath)
+                if subdir:
+                    os.makedirs(subdir, exist_ok=True)
+            for in_rf in rule.inputs:
+                in_rf.enter_make(is_input=True, conf=conf, cli_args=cli_args)
+            for out_rf in rule.outputs:
+                out_rf.enter_make(is_input=False, conf=conf, cli_args=cli_args)
+
+        readers, stream = rules[0].open_main_inputs(conf, cli_args)
+        consumers = [functools.partial(rule.make_from_stream,
+                                       conf=conf, cli_args=cli_args)
+                     for rule in rules]
+        errors = fan_out(stream, consumers)
+        for fobj in readers:
+            fobj.close()
+
+        for (rule, error) in zip(rules, errors):
+            for in_rf in rule.inputs:
+                in_rf.exit_make(is_input=True, conf=conf, cli_args=cli_args)
+            if error is not None:
+                continue
+            for out_rf in rule.outputs:
+                out_rf.exit_make(is_input=False, conf=conf, cli_args=cli_args)
+        return errors
+
     def add_main_outputs(self, outputs=None):
         if outputs is None:
             # set all outputs to main
@@ -461,7 +553,46 @@ class Recipe(object):
                 raise Exception('output {} is not a RecipeFile'.format(out))
         self._main_out.update(outputs)
 
+    def fuse_ephemeral(self):
+        """Fuses the producer and the only consumer of each
+        ephemeral file into a single Rule, if the Rules allow it.
+        The lines then stream from one to the other,
+        without writing the intermediate file.
+        The producer is kept for the ephemeral file,
+        so that it can still be made if requested explicitly."""
+        rules = set(rule for rule in self.files.values()
+                    if rule is not None and rule != UNBOUND_OUTPUT)
+        consumers = collections.defaultdict(set)
+        for rule in rules:
+            for inp in rule.inputs:
+                consumers[inp].add(rule)
+        order = self.validate(raise_on_error=True).order
+        ephemerals = [rf for rf in self.files
+                      if rf.ephemeral and rf not in self._main_out]
+        # fuse chains starting from the inputs
+        for rf in sorted(ephemerals, key=order.__getitem__):
+            producer = self.files[rf]
+            if producer is None or producer == UNBOUND_OUTPUT:
+                continue
+            if len(consumers[rf]) != 1:
+                # something else needs the file
+                continue
+            consumer = next(iter(consumers[rf]))
+            fused = producer.fuse(consumer, rf)
+            if fused is None:
+                logger.info('Unable to fuse {} and {}: writing {}'.format(
+                    producer.name, consumer.name, rf.sec_key()))
+                continue
+            for out in consumer.outputs:
+                self.files[out] = fused
+            for inp in fused.inputs:
+                consumers[inp].discard(consumer)
+                consumers[inp].add(fused)
+            self.fused.append((rf, fused))
+        self._validation = None
+
     def main(self):
+        self.fuse_ephemeral()
         self.cli.main()
 
     @property
@@ -499,6 +630,53 @@ class Recipe(object):
         return grouped
 
 
+def strongly_connected(nodes, successors):
+    """Tarjan's algorithm, without recursion.
+
+    Returns the strongly connected components in reverse topological order,
+    i.e. the successors of a node are returned before the node itself.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    result = []
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(root)))]
+        while len(work) > 0:
+            node, succs = work[-1]
+            for succ in succs:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(successors(succ))))
+                    break
+                elif succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                # all successors of node have been visited
+                work.pop()
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    result.append(component)
+    return result
+
+
 class Rule(object):
     """A part of a recipe.
 
@@ -534,11 +712,17 @@ class Rule(object):
     def monitor(self, platform, conf, cli_args=None):
         """Return a short summary of the status of a running job.
 
-        By default this is the line count of the first output file.
+        By default this is the latest progress reported by an external
+        tool (see platform.run), or the line count of the first output file.
         Subclasses can override this, to e.g. show a percentage,
         minibatch number, training loss or whatever is appropriate."""
         if len(self.outputs) == 0:
             return '-'
+        if platform is not None:
+            status = read_progress(
+                platform.progress_for(conf, self.outputs[0].sec_key()))
+            if status is not None:
+                return status
         main_out_path = self.outputs[0](conf, cli_args)
         if not os.path.exists(main_out_path):
             return 'no output'
@@ -555,6 +739,19 @@ class Rule(object):
         # Subclasses with atomic outputs should override this
         return False
 
+    def scan_key(self):
+        """Rules with the same (not None) scan key read the same stream
+        of lines from their main inputs, and can share the reading.
+        They must implement open_main_inputs and make_from_stream."""
+        return None
+
+    def fuse(self, consumer, intermediate):
+        """Returns a single Rule doing the work of both this Rule
+        and the consumer of its (ephemeral) output intermediate,
+        without writing the intermediate.
+        None if not possible: subclasses that can fuse override this."""
+        return None
+
     def add_opt_dep(self, name, binary=False):
         self._opt_deps.add(OptionalDep(name, binary, self.name))
 
@@ -586,7 +783,8 @@ class RecipeFile(object):
     """A RecipeFile is a file template
     that points to a concrete file when given conf and cli_args
     """
-    def __init__(self, section, key, exact_linecount=None, allow_empty=False, use_tmp=False):
+    def __init__(self, section, key, exact_linecount=None, allow_empty=False, use_tmp=False,
+                 ephemeral=False, line_index=False):
         self.section = section
         self.key = key
         # set if exact expected linecount is known
@@ -600,6 +798,11 @@ class RecipeFile(object):
         # tmp location for network io saving transparent tmp
         self.use_tmp = use_tmp
         self._tmp_path = None
+        # intermediate file that need not be written to disk,
+        # if producer and (only) consumer can be fused into one Rule
+        self.ephemeral = ephemeral
+        # maintain a line offset index (see lineindex)
+        self.line_index = line_index
 
     def __call__(self, conf, cli_args=None):
         if self._tmp_path is not None:
@@ -631,12 +834,20 @@ class RecipeFile(object):
     def exists(self, conf, cli_args=None):
         return os.path.exists(self(conf, cli_args))
 
-    def open(self, conf, cli_args=None, mode='r', strip_newlines=True):
+    def open(self, conf, cli_args=None, mode='r', strip_newlines=True,
+             start_line=None, start_offset=None):
+        """start_line or start_offset (in bytes, rounded up to a line start)
+        lets a reader begin in the middle of the file."""
         filepath = self(conf, cli_args)
         if 'w' in mode:
             subdir, _ = os.path.split(filepath)
             os.makedirs(subdir, exist_ok=True)
-        lines = open_text_file(filepath, mode)
+        if start_line is not None or start_offset is not None:
+            assert 'r' in mode, 'Can only start reading in the middle'
+            lines = open_text_file_at(
+                filepath, line=start_line, offset=start_offset)
+        else:
+            lines = open_text_file(filepath, mode)
         if strip_newlines and 'r' in mode:
             lines = (line.rstrip('\n') for line in lines)
         return lines
@@ -661,6 +872,8 @@ class RecipeFile(object):
 
     def exit_make(self, is_input, conf, cli_args):
         if not self.use_tmp:
+            if self.line_index and not is_input:
+                self.build_line_index(conf, cli_args)
             return
         tmp_path = self._tmp_path
         self._tmp_path = None
@@ -673,6 +886,13 @@ class RecipeFile(object):
                 raise Exception('dir tmp outputs not yet supported')
             else:
                 shutil.copyfile(tmp_path, real_path)
+            if self.line_index:
+                self.build_line_index(conf, cli_args)
+
+    def build_line_index(self, conf, cli_args=None):
+        path = self(conf, cli_args)
+        if os.path.isfile(path):
+            get_line_index(path, build=True)
 
     def __eq__(self, other):
         return (self.section, self.key) == (other.section, other.key)
@@ -757,9 +977,9 @@ class WildcardLoopRecipeFile(LoopRecipeFile):
             return matches[0]
         raise Exception('{} matched multiple files:\n{}'.format(self, '\n'.join(matches)))
 
-    def open(self, conf, cli_args=None, mode='r', strip_newlines=True):
+    def open(self, conf, cli_args=None, mode='r', strip_newlines=True, **kwargs):
         assert 'w' not in mode, 'Cannot write into WildcardLoopRecipeFile'
-        return super().open(conf, cli_args=cli_args, mode=mode, strip_newlines=strip_newlines)
+        return super().open(conf, cli_args=cli_args, mode=mode, strip_newlines=strip_newlines, **kwargs)
 
     @staticmethod
     def loop_output(section, key, loop_indices):
@@ -768,6 +988,121 @@ class WildcardLoopRecipeFile(LoopRecipeFile):
                 for loop_index in loop_indices]
 
 
+def shard_path(path, index, n_shards):
+    """Path of one shard of a file. Includes the number of shards,
+    so that shards of a differently split file are never mixed up."""
+    ext = ''
+    for compr in ('.gz', '.bz2', '.xz'):
+        if path.endswith(compr):
+            path, ext = path[:-len(compr)], compr
+    return '{}.shard{}of{}{}'.format(path, index, n_shards, ext)
+
+
+class ShardRecipeFile(RecipeFile):
+    """One shard (a contiguous range of lines) of another RecipeFile.
+    The path is derived from the path of the whole file,
+    so no separate configuration is needed."""
+    def __init__(self, whole, index, n_shards, allow_empty=True, **kwargs):
+        super().__init__(
+            whole.section,
+            '{}.shard{}of{}'.format(whole.key, index, n_shards),
+            allow_empty=allow_empty, **kwargs)
+        self.whole = whole
+        self.index = index
+        self.n_shards = n_shards
+
+    def __call__(self, conf, cli_args=None):
+        if self._tmp_path is not None:
+            return self._tmp_path
+        return shard_path(self.whole(conf, cli_args),
+                          self.index, self.n_shards)
+
+    def __repr__(self):
+        return 'ShardRecipeFile({}, {}, {})'.format(
+            self.whole, self.index, self.n_shards)
+
+
+class ShardedRecipeFile(RecipeFile):
+    """A file consisting of n_shards ordered parts.
+
+    Consumers can read it as one concatenated stream,
+    or process the parts separately (e.g. using shard_pipe).
+    The parts are ShardRecipeFiles, with paths derived from the
+    configured path. Producers write the parts (possibly concurrently),
+    the configured path itself is never written."""
+    def __init__(self, section, key, n_shards, **kwargs):
+        super().__init__(section, key, **kwargs)
+        self.n_shards = n_shards
+        self.parts = [ShardRecipeFile(self, i, n_shards)
+                      for i in range(n_shards)]
+
+    def exists(self, conf, cli_args=None):
+        return all(part.exists(conf, cli_args) for part in self.parts)
+
+    def linecount(self, conf, cli_args=None):
+        return sum(external_linecount(part(conf, cli_args))
+                   for part in self.parts)
+
+    def check_length(self, conf, cli_args=None):
+        # assumes existence has been checked already
+        status = DONE
+        lc = None
+        if not self.allow_empty:
+            if all(os.stat(part(conf, cli_args)).st_size == 0
+                   for part in self.parts):
+                return EMPTY, lc, self.exact_linecount
+        if self.exact_linecount is not None:
+            lc = self.linecount(conf, cli_args)
+            if lc < self.exact_linecount:
+                status = TOO_SHORT
+        return status, lc, self.exact_linecount
+
+    def open(self, conf, cli_args=None, mode='r', strip_newlines=True,
+             start_line=None, start_offset=None):
+        if 'w' in mode or 'a' in mode:
+            raise Exception('Write the parts of {} separately '
+                            '(see open_parts)'.format(self))
+        if start_offset is not None:
+            raise Exception('Use start_line with {}'.format(self))
+        return self._read_parts(conf, cli_args, mode, strip_newlines,
+                                start_line or 0)
+
+    def _read_parts(self, conf, cli_args, mode, strip_newlines, start_line=0):
+        for part in self.parts:
+            start = None
+            if start_line > 0:
+                # skip whole parts before the start
+                lc = external_linecount(part(conf, cli_args))
+                if lc <= start_line:
+                    start_line -= lc
+                    continue
+                start, start_line = start_line, 0
+            lines = part.open(conf, cli_args, mode=mode,
+                              strip_newlines=strip_newlines,
+                              start_line=start)
+            try:
+                yield from lines
+            finally:
+                lines.close()
+
+    def open_parts(self, conf, cli_args=None, mode='r', strip_newlines=True):
+        """One file object for each part, e.g. for concurrent writing"""
+        return [part.open(conf, cli_args, mode=mode,
+                          strip_newlines=strip_newlines)
+                for part in self.parts]
+
+    def enter_make(self, is_input, conf, cli_args):
+        if self.use_tmp:
+            raise Exception('use_tmp not supported for {}'.format(self))
+
+    def exit_make(self, is_input, conf, cli_args):
+        pass
+
+    def __repr__(self):
+        return 'ShardedRecipeFile({}, {}, {})'.format(
+            self.section, self.key, self.n_shards)
+
+
 class IndirectRecipeFile(RecipeFile):
     """A RecipeFile that reads a concrete file name from a separate file
     """
@@ -821,6 +1156,11 @@ class FileStatusCache(object):
     def clear(self):
         self._cache = {}
 
+    def failed(self):
+        """RecipeFiles with an error status, among those checked so far"""
+        return [rf for (rf, status) in self._cache.items()
+                if self.error(status)]
+
     def __call__(self, rf, conf, cli_args=None):
         if rf not in self._cache:
             self._cache[rf] = self._status(rf, conf, cli_args)
@@ -0,0 +1,125 @@
+"""Score files: one score per line (or tuple) of a corpus.
+
+Scores are stored either as text, one score per line (read as float64),
+or in binary as little-endian float32 (files named *.f32),
+which can be memory-mapped when read.
+Reading requires numpy.
+"""
+
+import array
+import os
+import sys
+
+from .utils import open_text_file
+
+BINARY_SUFFIX = '.f32'
+CHUNK_SIZE = 1 << 22
+
+
+def is_binary(path):
+    return path.endswith(BINARY_SUFFIX)
+
+
+class ScoreWriter(object):
+    """Writes scores one at a time, in the format given by the path"""
+    def __init__(self, path):
+        self.path = path
+        self.binary = is_binary(path)
+        subdir, _ = os.path.split(path)
+        if subdir:
+            os.makedirs(subdir, exist_ok=True)
+        if self.binary:
+            self._fobj = open(path, 'wb')
+            self._buffer = array.array('f')
+        else:
+            self._fobj = open_text_file(path, mode='w')
+
+    def write(self, score):
+        if not self.binary:
+            self._fobj.write('{}\n'.format(score))
+            return
+        self._buffer.append(score)
+        if len(self._buffer) >= CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if sys.byteorder == 'big':
+            self._buffer.byteswap()
+        self._buffer.tofile(self._fobj)
+        self._buffer = array.array('f')
+
+    def close(self):
+        if self.binary:
+            self._flush()
+        self._fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_scores(path):
+    """All scores as an array: binary scores as float32, memory-mapped,
+    text scores as float64 (like float()), read into memory."""
+    import numpy as np
+    if is_binary(path):
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype='<f4')
+        return np.memmap(path, dtype='<f4', mode='r')
+    with open_text_file(path, mode='r') as fobj:
+        return np.fromiter((float(line) for line in fobj), dtype='f8')
+
+
+def iter_scores(scores):
+    """The scores in an array as Python floats"""
+    for start in range(0, len(scores), CHUNK_SIZE):
+        yield from scores[start:start + CHUNK_SIZE].tolist()
+
+
+def kth_smallest(scores, k):
+    """The kth smallest (counting from 0) of an array of scores.
+
+    Float32 scores are selected by radix selection in two passes over
+    the array: first on the high, then on the low 16 bits of an
+    order-preserving integer key. This needs no sorting, and no copy
+    of the (possibly memory-mapped) array.
+    Other arrays are in memory already, and are partitioned.
+    """
+    import numpy as np
+    if not 0 <= k < len(scores):
+        raise Exception('Can not select score {} of {}'.format(k, len(scores)))
+    if scores.dtype != np.dtype('<f4'):
+        return float(np.partition(scores, k)[k])
+    counts = np.zeros(1 << 16, dtype='i8')
+    for keys in _key_chunks(scores):
+        counts += np.bincount(keys >> 16, minlength=1 << 16)
+    cumulative = np.cumsum(counts)
+    high = int(np.searchsorted(cumulative, k, side='right'))
+    below = int(cumulative[high - 1]) if high > 0 else 0
+    counts = np.zeros(1 << 16, dtype='i8')
+    for keys in _key_chunks(scores):
+        keys = keys[(keys >> 16) == high]
+        counts += np.bincount(keys & 0xffff, minlength=1 << 16)
+    low = int(np.searchsorted(np.cumsum(counts), k - below, side='right'))
+    return _from_key((high << 16) | low)
+
+
+def _key_chunks(scores):
+    """Float32 bit patterns mapped to unsigned integers in the same order"""
+    import numpy as np
+    for start in range(0, len(scores), CHUNK_SIZE):
+        bits = np.ascontiguousarray(
+            scores[start:start + CHUNK_SIZE], dtype='<f4').view('<u4')
+        negative = (bits >> 31).astype(bool)
+        yield np.where(negative, ~bits, bits | np.uint32(1 << 31))
+
+
+def _from_key(key):
+    import numpy as np
+    if key & (1 << 31):
+        bits = key & ~(1 << 31)
+    else:
+        bits = ~key & 0xffffffff
+    return float(np.array([bits], dtype='<u4').view('<f4')[0])
@@ -1,12 +1,15 @@
 import bz2
 import codecs
 import gzip
+import io
 import itertools
 import logging
 import lzma
 import os
+import queue
 import re
 import subprocess
+import threading
 from multiprocessing import Pool
 
 logger = logging.getLogger('textpipes')
@@ -52,6 +55,51 @@ def open_text_file(file_path, mode='r', encoding='utf-8'):
     return file_obj
 
 
+def open_text_file_at(file_path, line=None, offset=None, build_index=True):
+    """Open a file for reading, starting at the given line (counting from 0),
+    or at the first line starting at or after the given byte offset
+    (of the uncompressed data).
+    Gzip files are indexed for random access (see gzindex),
+    unless build_index is False and there is no index yet."""
+    if file_path.endswith('.gz'):
+        from .gzindex import open_gzip_at
+        return open_gzip_at(file_path, line=line, offset=offset,
+                            build=build_index)
+    if file_path.endswith('.bz2'):
+        # no random access: decompress up to the start
+        fobj = bz2.open(file_path, 'rb')
+    elif file_path.endswith('.xz'):
+        fobj = lzma.open(file_path, 'rb')
+    else:
+        fobj = open(file_path, 'rb')
+    if offset is not None:
+        _skip_to_line_start(fobj, offset)
+    for _ in range(line or 0):
+        if not fobj.readline():
+            break
+    return io.TextIOWrapper(fobj, encoding='utf-8')
+
+
+def _skip_to_line_start(fobj, offset):
+    if offset <= 0:
+        return
+    if fobj.seekable():
+        fobj.seek(offset - 1)
+    else:
+        _read_bytes(fobj, offset - 1)
+    # the previous byte tells if offset is at a line start
+    if fobj.read(1) != b'\n':
+        fobj.readline()
+
+
+def _read_bytes(fobj, n_bytes):
+    while n_bytes > 0:
+        data = fobj.read(min(n_bytes, COPY_BLOCK_SIZE))
+        if not data:
+            break
+        n_bytes -= len(data)
+
+
 def external_linecount(file_path):
     if file_path.endswith('.gz'):
         ext_lc = subprocess.check_output(
@@ -90,6 +138,55 @@ def progress(iterable, rule, conf, out_file, total='conf'):
     return tqdm(iterable, desc=description, total=total, unit_scale=True)
 
 
+def fan_out(stream, consumers, block_size=1000, max_blocks=16):
+    """Feeds the items of one stream to several consumers,
+    each running in its own thread.
+    Items are passed in blocks, through bounded queues,
+    so the stream is read only once, and never fully in memory.
+    -> list with the exception raised by each consumer, or None
+    """
+    queues = [queue.Queue(maxsize=max_blocks) for _ in consumers]
+    errors = [None] * len(consumers)
+
+    def blocks_from(q, finished):
+        while True:
+            block = q.get()
+            if block is None:
+                finished.append(True)
+                return
+            yield from block
+
+    def target(i, consumer):
+        finished = []
+        try:
+            consumer(blocks_from(queues[i], finished))
+        except Exception as e:
+            logger.exception('consumer {} failed'.format(i))
+            errors[i] = e
+        # the reader must not block on a consumer that has stopped
+        while not finished:
+            if queues[i].get() is None:
+                finished.append(True)
+
+    threads = [threading.Thread(target=target, args=(i, consumer))
+               for (i, consumer) in enumerate(consumers)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            block = list(itertools.islice(stream, block_size))
+            if len(block) == 0:
+                break
+            for q in queues:
+                q.put(block)
+    finally:
+        for q in queues:
+            q.put(None)
+        for thread in threads:
+            thread.join()
+    return errors
+
+
 class LazyPool(object):
     def __init__(self, processes, chunksize=1000):
         self.processes = processes
@@ -108,7 +205,7 @@ class LazyPool(object):
             yield item
 
     def close(self):
-        if self.pool is None:
+        if self.pool is not None:
             self.pool.close()
 
 
@@ -157,3 +254,47 @@ def find_highest_file(path_template, wildcard):
 
 def dir_is_empty(path):
     return all(f.startswith('.') for f in os.listdir(path))
+
+
+COPY_BLOCK_SIZE = 1 << 20
+
+def copy_bytes(fin, fout):
+    """Copies the rest of binary file fin into fout without going
+    through Python buffers where possible: copy_file_range
+    (may share extents on CoW filesystems), then sendfile.
+    Returns the number of bytes copied."""
+    fout.flush()
+    in_fd, out_fd = fin.fileno(), fout.fileno()
+    total = 0
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while True:
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(in_fd, out_fd, COPY_BLOCK_SIZE)
+                else:
+                    n = os.sendfile(out_fd, in_fd, None, COPY_BLOCK_SIZE)
+                if n == 0:
+                    return total
+                total += n
+        except OSError:
+            # e.g. cross-device on old kernels: continue where it stopped
+            continue
+    while True:
+        buf = fin.read(COPY_BLOCK_SIZE)
+        if not buf:
+            return total
+        fout.write(buf)
+        total += len(buf)
+
+FICLONE = 0x40049409    # from linux/fs.h
+
+def reflink(fin, fout):
+    """Makes fout a copy-on-write clone of fin. Returns success."""
+    try:
+        import fcntl
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        return True
+    except (ImportError, OSError):
+        return False
@@ -1,11 +1,24 @@
+import array
+import collections
+import hashlib
+import heapq
 import logging
+import os
+import re
+import shutil
+import struct
+import tempfile
 
 from .core.recipe import Rule
-from .components.core import ParallelPipe
-from .components.filtering import Filter, ParallelFilter
+from .core.utils import safe_zip, LazyPool, NoPool
+from .components.filtering import Filter
 
 logger = logging.getLogger('textpipes')
 
+INDEX = struct.Struct('<Q')
+N_TOP_GROUPS = 20
+RE_NONWORD = re.compile(r'[\W_]+')
+
 try:
     from pybloom import BloomFilter
 except ImportError:
@@ -15,35 +28,228 @@ except ImportError:
 
 
 class Deduplicate(Rule):
+    """Exact deduplication, keeping the first occurrence.
+
+    Lines (or tuples of parallel lines) are compared by a hash of their
+    key. The hashes are partitioned to disk, and the duplicates
+    found one partition at a time, so memory use is bounded
+    by the size of a partition (about 100 bytes per line)
+    times the number of processes. The duplicate indices of each
+    partition are sorted and kept on disk, and merged when filtering.
+
+    key: 'line' (exact), 'normalized' (case, punctuation and
+        whitespace insensitive), or a callable from line to key.
+    truncate: compare only this many initial characters of the key.
+    columns: indices of the parallel columns used as the key,
+        e.g. [0] to deduplicate on the source side only.
+        By default all columns.
+    hash_bits: 64 or 128. With 64 bits, a false duplicate
+        is expected once in about 10^19 / lines^2.
+    stats_file: optional output for duplicate statistics.
+    """
     def __init__(self,
                  inputs, outputs,
-                 dup_proportion=.1,
-                 truncate=30,
+                 key='line',
+                 truncate=None,
+                 columns=None,
+                 hash_bits=128,
+                 partitions=64,
+                 processes=1,
+                 stats_file=None,
+                 dup_proportion=None,
                  **kwargs):
+        # dup_proportion sized the old Bloom filters, no longer used
+        if stats_file is not None:
+            outputs = list(outputs) + [stats_file]
         super().__init__(inputs, outputs, **kwargs)
-        # capacity ratio of bloom filters
-        self.dup_proportion = dup_proportion
-        # if this many initial chars match, consider it a dup
+        self.main_outputs = [out for out in self.outputs
+                             if out is not stats_file]
+        if len(self.main_outputs) != len(self.inputs):
+            raise Exception('Deduplicate needs one output per input')
+        if key not in ('line', 'normalized') and not callable(key):
+            raise Exception('Unknown dedup key {}'.format(key))
+        if hash_bits not in (64, 128):
+            raise Exception('hash_bits must be 64 or 128')
+        self.key = key
         self.truncate = truncate
-        self.add_opt_dep('pybloom', binary=False)
-
-    def make(self, conf, cli_args):
-        estimated_lines = 1.2 * conf.conf['exp'].getint('n_lines', 500000000)
-        # first pass: collect collisions
-        pipes = [inp.open(conf, cli_args, mode='r')
-                 for inp in self.inputs]
-        filters = [DedupFilter(pipe,
-                               estimated_lines=estimated_lines,
-                               dup_proportion=self.dup_proportion,
-                               truncate=self.truncate)
-                   for pipe in pipes]
-        # second pass: filter
-        pp = ParallelPipe(
-            [ParallelFilter(filters)],
-            self.inputs, self.outputs)
-        pp.make(conf, cli_args)
+        self.columns = columns
+        self.hash_bits = hash_bits
+        self.partitions = partitions
+        self.processes = processes
+        self.stats_file = stats_file
+
+    def make(self, conf, cli_args=None):
+        out_path = self.main_outputs[0](conf, cli_args)
+        tmpdir = tempfile.mkdtemp(
+            prefix='.dedup.', dir=os.path.dirname(out_path) or '.')
+        try:
+            n_lines, part_files = self._scatter(conf, cli_args, tmpdir)
+            dups, groups = self._find_duplicates(part_files)
+            n_dups = self._filter(conf, cli_args, dups, groups)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self._report(conf, cli_args, n_lines, n_dups, groups)
+
+    def _records(self, conf, cli_args):
+        readers = [inp.open(conf, cli_args, mode='r')
+                   for inp in self.inputs]
+        return readers, safe_zip(*readers)
+
+    def _key_func(self):
+        key = self.key
+        if key == 'line':
+            key = None
+        elif key == 'normalized':
+            key = normalize_key
+        columns = self.columns
+        truncate = self.truncate
+
+        def key_func(tpl):
+            if columns is not None:
+                tpl = [tpl[i] for i in columns]
+            if key is not None:
+                tpl = [key(line) for line in tpl]
+            if truncate is not None:
+                tpl = [line[:truncate] for line in tpl]
+            # lines contain no newlines: the columns stay distinct
+            return '\n'.join(tpl).encode('utf-8')
+        return key_func
+
+    def _scatter(self, conf, cli_args, tmpdir):
+        """First pass: (hash, line index) records into partitions"""
+        key_func = self._key_func()
+        digest_size = self.hash_bits // 8
+        n_parts = self.partitions
+        part_files = [os.path.join(tmpdir, str(i)) for i in range(n_parts)]
+        writers = [open(path, 'wb') for path in part_files]
+        readers, records = self._records(conf, cli_args)
+        i = -1
+        for (i, tpl) in enumerate(records):
+            digest = hashlib.blake2b(
+                key_func(tpl), digest_size=digest_size).digest()
+            part = int.from_bytes(digest[-4:], 'little') % n_parts
+            writers[part].write(digest)
+            writers[part].write(INDEX.pack(i))
+        for fobj in readers + writers:
+            fobj.close()
+        return i + 1, [(path, digest_size) for path in part_files]
+
+    def _find_duplicates(self, part_files):
+        """Second pass: indices of the lines that are not
+        the first occurrence of their key, one partition at a time.
+        The sorted indices of each partition are written to disk."""
+        if self.processes > 1:
+            pool = LazyPool(self.processes, chunksize=1)
+        else:
+            pool = NoPool()
+        dup_files = []
+        n_dups = 0
+        # (first index, number of occurrences) of the largest groups
+        groups = []
+        for (dup_file, part_n_dups, part_groups) in pool.imap(
+                _partition_dups, part_files):
+            dup_files.append(dup_file)
+            n_dups += part_n_dups
+            groups = heapq.nlargest(
+                N_TOP_GROUPS, groups + part_groups, key=lambda x: x[1])
+        pool.close()
+        return (dup_files, n_dups), groups
+
+    def _filter(self, conf, cli_args, dups, groups):
+        """Third pass: write everything except the duplicates"""
+        dup_files, n_dups = dups
+        # the partitions are merged into one sorted stream
+        dups = heapq.merge(*[_read_indices(path) for path in dup_files])
+        next_dup = next(dups, None)
+        top_first = {first: None for (first, _) in groups}
+        readers, records = self._records(conf, cli_args)
+        writers = [out.open(conf, cli_args, mode='w')
+                   for out in self.main_outputs]
+        for (i, tpl) in enumerate(records):
+            if next_dup == i:
+                next_dup = next(dups, None)
+                continue
+            if i in top_first:
+                top_first[i] = tpl
+            for (writer, line) in zip(writers, tpl):
+                writer.write(line)
+                writer.write('\n')
+        for fobj in readers + writers:
+            fobj.close()
+        self._top_lines = [(count, top_first[first])
+                           for (first, count) in groups]
+        return n_dups
+
+    def _report(self, conf, cli_args, n_lines, n_dups, groups):
+        ratio = n_dups / n_lines if n_lines else 0.
+        lines = [
+            'lines\t{}'.format(n_lines),
+            'kept\t{}'.format(n_lines - n_dups),
+            'duplicates\t{}'.format(n_dups),
+            'duplicate_ratio\t{:.4f}'.format(ratio),
+        ]
+        logger.info('Deduplicate: {} of {} lines were duplicates ({:.1%})'.format(
+            n_dups, n_lines, ratio))
+        if self.stats_file is None:
+            return
+        with self.stats_file.open(conf, cli_args, mode='w') as fobj:
+            for line in lines:
+                fobj.write(line)
+                fobj.write('\n')
+            fobj.write('# most repeated\n')
+            for (count, tpl) in self._top_lines:
+                if tpl is None:
+                    continue
+                fobj.write('{}\t{}\n'.format(count, ' ||| '.join(tpl)))
+
+
+def _partition_dups(part_file):
+    path, digest_size = part_file
+    first = {}
+    counts = collections.Counter()
+    dups = array.array('Q')
+    rec_size = digest_size + INDEX.size
+    with open(path, 'rb') as fobj:
+        data = fobj.read()
+    for pos in range(0, len(data), rec_size):
+        digest = data[pos:pos + digest_size]
+        i = INDEX.unpack_from(data, pos + digest_size)[0]
+        if digest in first:
+            dups.append(i)
+            counts[digest] += 1
+        else:
+            first[digest] = i
+    groups = [(first[digest], count + 1)
+              for (digest, count) in counts.most_common(N_TOP_GROUPS)]
+    del first
+    dup_file = path + '.dups'
+    with open(dup_file, 'wb') as fobj:
+        array.array('Q', sorted(dups)).tofile(fobj)
+    return dup_file, len(dups), groups
+
+
+def _read_indices(path, chunk_size=1 << 16):
+    """Streams the line indices written by _partition_dups"""
+    with open(path, 'rb') as fobj:
+        while True:
+            chunk = array.array('Q')
+            try:
+                chunk.fromfile(fobj, chunk_size)
+            except EOFError:
+                # the last, partial chunk was read
+                pass
+            if len(chunk) == 0:
+                return
+            yield from chunk
+
+
+def normalize_key(line):
+    """Case, punctuation and whitespace insensitive key"""
+    line = RE_NONWORD.sub(' ', line.casefold())
+    return ' '.join(line.split())
 
 
+# Legacy Bloom filter based deduplication
 class DedupFilter(Filter):
     def __init__(self, lines, estimated_lines, dup_proportion, truncate):
         super().__init__()
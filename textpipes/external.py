@@ -1,9 +1,16 @@
+import bz2
+import gzip
+import lzma
 import os
+import shutil
 import subprocess
+import tempfile
 
 from .core.recipe import Rule, RecipeFile
-from .core.platform import run
-from .core.utils import safe_zip
+from .core.platform import run, run_parallel
+from .core.utils import safe_zip, open_text_file, external_linecount
+from .core.utils import copy_bytes, reflink, COPY_BLOCK_SIZE
+from .typecache import segment_by_type, cache_signature, type_cache_path
 
 # FIXME: use package resources instead
 WRAPPER_DIR = os.path.join(
@@ -24,8 +31,73 @@ def maybe_gz_out(outfile):
     else:
         return 'tee', outfile
 
-def simple_external(name, inputs, outputs, template, autolog_stdout=True, mapping=None):
-    """Helper to make integrating external tools easier"""
+def split_lines(infile, shard_files, vertical=False):
+    """Splits infile into contiguous ranges of roughly equal line counts.
+
+    If vertical, shards are only cut after a blank line,
+    which separates sentences in vertical (one token per line) formats.
+    Returns the line counts of the shards that were written."""
+    total = external_linecount(infile)
+    n_shards = max(1, min(len(shard_files), total))
+    per_shard = -(-total // n_shards)
+    counts = [0]
+    prev_blank = False
+    fout = open(shard_files[0], 'w', encoding='utf-8')
+    with open_text_file(infile, 'r') as fin:
+        for line in fin:
+            if counts[-1] >= per_shard \
+                    and len(counts) < n_shards \
+                    and (prev_blank or not vertical):
+                fout.close()
+                fout = open(shard_files[len(counts)], 'w', encoding='utf-8')
+                counts.append(0)
+            fout.write(line)
+            counts[-1] += 1
+            prev_blank = line.strip() == ''
+    fout.close()
+    return counts
+
+def run_sharded(make_cmd, infile, outfile, shards, vertical=False, log=None):
+    """Runs a line-independent command in parallel on shards of infile.
+
+    make_cmd(shard_in, shard_out) returns the command for one shard.
+    The shard outputs are concatenated in order into outfile,
+    after checking that each has as many lines as its input."""
+    tmpdir = tempfile.mkdtemp(
+        prefix='.shards.', dir=os.path.dirname(outfile) or '.')
+    try:
+        shard_ins = [os.path.join(tmpdir, 'in.{}'.format(i))
+                     for i in range(shards)]
+        counts = split_lines(infile, shard_ins, vertical=vertical)
+        shard_ins = shard_ins[:len(counts)]
+        shard_outs = [os.path.join(tmpdir, 'out.{}'.format(i))
+                      for i in range(len(counts))]
+        run_parallel([make_cmd(shard_in, shard_out)
+                      for (shard_in, shard_out)
+                      in safe_zip(shard_ins, shard_outs)],
+                     log=log)
+        with open_text_file(outfile, 'w') as fout:
+            for (i, shard_out) in enumerate(shard_outs):
+                n_lines = 0
+                with open(shard_out, 'r', encoding='utf-8') as fin:
+                    for line in fin:
+                        fout.write(line)
+                        n_lines += 1
+                if n_lines != counts[i]:
+                    raise Exception(
+                        'shard {} of {}: {} lines in, {} lines out'.format(
+                            i, outfile, counts[i], n_lines))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def simple_external(name, inputs, outputs, template, autolog_stdout=True, mapping=None, progress=None, vertical=False):
+    """Helper to make integrating external tools easier
+
+    Output is streamed into the autolog, unless autolog_stdout is False.
+    progress: regex or callable picking the progress from output lines,
+    shown by Rule.monitor (see platform.run).
+    vertical: input uses blank lines to separate sentences,
+    shards must not split sentences."""
     uses_argstr = '{argstr}' in template
     for inp_name in inputs:
         if '{' + inp_name + '}' not in template:
@@ -37,13 +109,11 @@ def simple_external(name, inputs, outputs, template, autolog_stdout=True, mappin
     if autolog_stdout and '>' in template:
         print('turning off autolog_stdout for {}'.format(name))
         autolog_stdout = False
-    if autolog_stdout:
-        template += ' >> {autolog} 2>&1'
     mapping = {} if mapping is None else mapping
     # FIXME: handle forbidding of .gz . fail in --check
 
     class SimpleExternalRule(Rule):
-        def __init__(self, input_rfs, output_rfs, argstr='', extra_in=None, extra_out=None, **kwargs):
+        def __init__(self, input_rfs, output_rfs, argstr='', extra_in=None, extra_out=None, shards=1, **kwargs):
             if isinstance(output_rfs, RecipeFile):
                 output_rfs = [output_rfs]
             extra_in = [] if extra_in is None else extra_in
@@ -57,26 +127,44 @@ def simple_external(name, inputs, outputs, template, autolog_stdout=True, mappin
             assert len(self.inputs) == len(inputs) + len(extra_in), \
                 'got {} expecting {}'.format(len(self.inputs), len(inputs))
             assert len(self.outputs) == len(outputs) + len(extra_out)
+            # sharding splits the first input and joins the first output
+            self.shards = shards
+            if shards > 1 and len(self.outputs) != 1:
+                raise Exception('{}: shards requires a single output'.format(name))
             self.add_opt_dep(program, binary=True)
 
         def make(self, conf, cli_args):
-            template_values = {}
+            paths = {}
             # had to go back to unsafe zip due to extra_in
             for inp_name, inp in zip(inputs, self.inputs):
-                val = inp(conf, cli_args)
-                if inp_name in mapping:
-                    val = mapping[inp_name](val)
-                template_values[inp_name] = val
+                paths[inp_name] = inp(conf, cli_args)
             # had to go back to unsafe zip due to extra_out
             for out_name, out in zip(outputs, self.outputs):
-                val = out(conf, cli_args)
-                if out_name in mapping:
-                    val = mapping[out_name](val)
-                template_values[out_name] = val
+                paths[out_name] = out(conf, cli_args)
+            log = conf.current_autolog_path if autolog_stdout else None
+            if self.shards > 1:
+                def make_cmd(shard_in, shard_out):
+                    shard_paths = dict(paths)
+                    shard_paths[inputs[0]] = shard_in
+                    shard_paths[outputs[0]] = shard_out
+                    return self._command(shard_paths)
+                run_sharded(make_cmd,
+                            paths[inputs[0]], paths[outputs[0]],
+                            self.shards, vertical=vertical, log=log)
+                return
+            run(self._command(paths),
+                log=log,
+                progress=progress,
+                progress_file=conf.current_progress_path)
+
+        def _command(self, paths):
+            template_values = {}
+            for key, val in paths.items():
+                if key in mapping:
+                    val = mapping[key](val)
+                template_values[key] = val
             template_values['argstr'] = self.argstr
-            if autolog_stdout:
-                template_values['autolog'] = conf.current_autolog_path
-            run(template.format(**template_values))
+            return template.format(**template_values)
 
         @property
         def name(self):
@@ -84,9 +172,6 @@ def simple_external(name, inputs, outputs, template, autolog_stdout=True, mappin
 
     return SimpleExternalRule
 
-Copy = simple_external('Copy', ['inp'], ['out'],
-                       'cp --no-clobber {inp} {out}',  autolog_stdout=False)
-
 def ReEncode(infile, outfile, from_encoding='utf-8', to_encoding='utf-8//IGNORE'):
     argstr = '-f {from_encoding} -t {to_encoding}'.format(
         from_encoding=from_encoding, to_encoding=to_encoding)
@@ -96,46 +181,137 @@ def ReEncode(infile, outfile, from_encoding='utf-8', to_encoding='utf-8//IGNORE'
         autolog_stdout=False)
     return ReEncode(infile, outfile, argstr=argstr)
 
+def codec(path):
+    """Compression of a file, as indicated by its extension"""
+    for ext in ('.gz', '.bz2', '.xz'):
+        if path.endswith(ext):
+            return ext
+    return None
+
+def _open_binary(path, mode):
+    ext = codec(path)
+    if ext == '.gz':
+        # same as the gzip command line default
+        return gzip.open(path, mode + 'b', compresslevel=6)
+    if ext == '.bz2':
+        return bz2.open(path, mode + 'b')
+    if ext == '.xz':
+        return lzma.open(path, mode + 'b')
+    return open(path, mode + 'b')
+
+def _ends_with_newline(fobj):
+    fobj.seek(0, os.SEEK_END)
+    if fobj.tell() == 0:
+        return True
+    fobj.seek(-1, os.SEEK_END)
+    last = fobj.read(1)
+    fobj.seek(0)
+    return last == b'\n'
+
+def _transcode(infile, fout):
+    """Streams decompressed contents of infile into fout,
+    terminating the last line."""
+    last = b'\n'
+    with _open_binary(infile, 'r') as fin:
+        while True:
+            buf = fin.read(COPY_BLOCK_SIZE)
+            if not buf:
+                break
+            fout.write(buf)
+            last = buf[-1:]
+    if last != b'\n':
+        fout.write(b'\n')
+
+
 class Concatenate(Rule):
+    """Concatenates the inputs into the output.
+
+    If all inputs have the same compression as the output,
+    the bytes are copied as is: concatenated gzip (bz2, xz) members
+    form a valid file. Only mixed compressions need to be transcoded."""
     def __init__(self, *args, resource_class='make_immediately', **kwargs):
         super().__init__(*args, resource_class=resource_class, **kwargs)
 
     def make(self, conf, cli_args):
         infiles = [inp(conf, cli_args) for inp in self.inputs]
-        if all(infile.endswith('.gz') for infile in infiles):
-            catcmd = 'zcat'
-        elif all(not infile.endswith('.gz') for infile in infiles):
-            catcmd = 'cat'
-        else:
-            print('SLOW: concatenating gzipped and plain files')
-            self._mixed_concat(conf, cli_args)
+        outfile = self.outputs[0](conf, cli_args)
+        out_codec = codec(outfile)
+        if all(codec(infile) == out_codec for infile in infiles):
+            with open(outfile, 'wb') as fout:
+                for infile in infiles:
+                    with open(infile, 'rb') as fin:
+                        missing_newline = out_codec is None \
+                            and not _ends_with_newline(fin)
+                        copy_bytes(fin, fout)
+                    if missing_newline:
+                        fout.write(b'\n')
             return
-        zipcmd, outfile = maybe_gz_out(self.outputs[0](conf, cli_args))
-        run('{catcmd} {infiles} | {zipcmd} > {outfile}'.format(
-                catcmd=catcmd,
-                infiles=' '.join(infiles),
-                zipcmd=zipcmd,
-                outfile=outfile)
-            )
-    
-    def _mixed_concat(self, conf, cli_args):
-        with self.outputs[0].open(conf, cli_args, mode='w') as fobj:
-            for inp in self.inputs:
-                reader = inp.open(conf, cli_args, mode='r')
-                for line in reader:
-                    fobj.write(line)
-                    fobj.write('\n')
-                reader.close()
+        print('transcoding: concatenating files with mixed compressions')
+        with _open_binary(outfile, 'w') as fout:
+            for infile in infiles:
+                _transcode(infile, fout)
+
+
+class Copy(Rule):
+    """Copies a file, using a copy-on-write clone if the filesystem
+    supports it, otherwise an in-kernel copy.
+    Recompresses if the extensions differ.
+
+    link=True tries a hardlink first. Only safe if neither file
+    is ever rewritten in place, as they share the contents."""
+    def __init__(self, inp, out, link=False,
+                 resource_class='make_immediately', **kwargs):
+        if isinstance(inp, list):
+            assert len(inp) == 1
+            inp = inp[0]
+        if isinstance(out, list):
+            assert len(out) == 1
+            out = out[0]
+        super().__init__([inp], [out], resource_class=resource_class, **kwargs)
+        self.link = link
+
+    def make(self, conf, cli_args):
+        infile = self.inputs[0](conf, cli_args)
+        outfile = self.outputs[0](conf, cli_args)
+        if os.path.exists(outfile):
+            # same as cp --no-clobber
+            print('not overwriting existing {}'.format(outfile))
+            return
+        if codec(infile) != codec(outfile):
+            with _open_binary(outfile, 'w') as fout:
+                _transcode(infile, fout)
+            return
+        if self.link:
+            try:
+                os.link(infile, outfile)
+                return
+            except OSError:
+                pass
+        with open(infile, 'rb') as fin, open(outfile, 'wb') as fout:
+            if not reflink(fin, fout):
+                copy_bytes(fin, fout)
+        shutil.copymode(infile, outfile)
+
 
 class MosesTokenize(Rule):
-    def __init__(self, *args, lang, **kwargs):
+    def __init__(self, *args, lang, shards=1, **kwargs):
         super().__init__(*args, **kwargs)
         self.lang = lang
+        self.shards = shards
 
     def make(self, conf, cli_args):
-        catcmd, infile = maybe_gz_in(self.inputs[0](conf, cli_args))
-        zipcmd, outfile = maybe_gz_out(self.outputs[0](conf, cli_args))
-        run('{catcmd} {infile}'
+        infile = self.inputs[0](conf, cli_args)
+        outfile = self.outputs[0](conf, cli_args)
+        if self.shards > 1:
+            run_sharded(lambda inp, out: self._command(conf, inp, out),
+                        infile, outfile, self.shards)
+        else:
+            run(self._command(conf, infile, outfile))
+
+    def _command(self, conf, infile, outfile):
+        catcmd, infile = maybe_gz_in(infile)
+        zipcmd, outfile = maybe_gz_out(outfile)
+        return ('{catcmd} {infile}'
             ' | {moses_dir}/tokenizer.perl -l {lang} -threads 2'
             ' | {zipcmd} > {outfile}'.format(
                 catcmd=catcmd,
@@ -170,9 +346,14 @@ class LearnBPE(Rule):
                 ))
 
 class ApplyBPE(Rule):
-    def __init__(self, *args, bnd_marker='@@', **kwargs):
+    def __init__(self, *args, bnd_marker='@@', shards=1,
+                 by_type=False, type_cache=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.sep = bnd_marker
+        self.shards = shards
+        # segment each word type only once, see typecache
+        self.by_type = by_type
+        self.type_cache = type_cache
 
     def make(self, conf, cli_args):
         infile = self.inputs[0](conf, cli_args)
@@ -182,7 +363,24 @@ class ApplyBPE(Rule):
         assert not infile.endswith('.gz')
         assert not codes.endswith('.gz')
         assert not outfile.endswith('.gz')
-        run('python {prog} --input {infile} --codes {codes} --output {outfile}'
+        if self.by_type:
+            segment_by_type(
+                lambda inp, out: self._run(inp, codes, out),
+                infile, outfile,
+                cache_signature(self._command('-', codes, '-'), codes),
+                cache=type_cache_path(self.type_cache, conf, cli_args))
+        else:
+            self._run(infile, codes, outfile)
+
+    def _run(self, infile, codes, outfile):
+        if self.shards > 1:
+            run_sharded(lambda inp, out: self._command(inp, codes, out),
+                        infile, outfile, self.shards)
+        else:
+            run(self._command(infile, codes, outfile))
+
+    def _command(self, infile, codes, outfile):
+        return ('python {prog} --input {infile} --codes {codes} --output {outfile}'
             ' --separator "{sep}"'.format(
                 prog=os.path.join(WRAPPER_DIR, 'apply_bpe.py'),
                 infile=infile,
@@ -5,6 +5,7 @@ import re
 from .core import utils
 from .core.recipe import Rule
 from .core.platform import run
+from .external import run_sharded
 from .components.core import MonoPipeComponent, SingleCellComponent
 
 # flatten sentences into single-column (surface) tabular representation
@@ -18,8 +19,9 @@ class SingleSurfaceColumn(MonoPipeComponent):
             yield ''
 
 class Finnpos(Rule):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, shards=1, **kwargs):
         super().__init__(*args, **kwargs)
+        self.shards = shards
         self.add_opt_dep('ftb-label', binary=True)
 
     def make(self, conf, cli_args):
@@ -28,11 +30,17 @@ class Finnpos(Rule):
         # FIXME: would be much better if this would fail in --check
         assert not infile.endswith('.gz')
         assert not outfile.endswith('.gz')
-        subprocess.check_call(
-            ['ftb-label < {infile} > {outfile}'.format(
-                infile=infile,
-                outfile=outfile)
-            ], shell=True)
+        if self.shards > 1:
+            # vertical format: don't split sentences
+            run_sharded(self._command, infile, outfile, self.shards,
+                        vertical=True)
+        else:
+            subprocess.check_call([self._command(infile, outfile)], shell=True)
+
+    def _command(self, infile, outfile):
+        return 'ftb-label < {infile} > {outfile}'.format(
+            infile=infile,
+            outfile=outfile)
 
 # deterministic lemma modification
 class ModifyLemmas(SingleCellComponent):
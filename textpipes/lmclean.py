@@ -30,14 +30,13 @@ class TrainLmclean(Rule):
     def make(self, conf, cli_args):
         model_base, _, _ = self.models[0](conf, cli_args).rsplit('.', 2)
         run('lmclean-train'
-            ' {model_base} {train_file} {dev_file} --save-every {save_every} {argstr}'
-            ' >> {pipe_file} 2>&1'.format(
+            ' {model_base} {train_file} {dev_file} --save-every {save_every} {argstr}'.format(
                 model_base=model_base,
                 train_file=self.train_file(conf, cli_args),
                 dev_file=self.dev_file(conf, cli_args),
                 save_every=self.save_every,
-                argstr=self.argstr,
-                pipe_file=self.pipe_file(conf, cli_args)))
+                argstr=self.argstr),
+            log=self.pipe_file(conf, cli_args))
 
     def is_atomic(self, output):
         # all loop outputs are atomic
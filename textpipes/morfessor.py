@@ -5,7 +5,8 @@ from .core.recipe import Rule
 from .core.platform import run
 from .core.utils import FOURDOT, FIVEDOT
 from .components.core import MonoPipeComponent, MonoPipe
-from .external import simple_external
+from .external import simple_external, run_sharded
+from .typecache import segment_by_type, cache_signature, type_cache_path
 
 TrainMorfessor = simple_external(
     'TrainMorfessor', ['infile'], ['model', 'params', 'lexicon'],
@@ -42,10 +43,16 @@ class ApplyMorfessor(Rule):
     def __init__(self, *args,
                  sep=FIVEDOT + ' ', fmt='{analysis}',
                  no_space_ok=False,
+                 shards=1,
+                 by_type=False,
+                 type_cache=None,
                  **kwargs):
         super().__init__(*args, **kwargs)
         self.sep = sep
         self.fmt = fmt
+        self.shards = shards
+        self.by_type = by_type
+        self.type_cache = type_cache
         assert no_space_ok or ' ' in self.sep
         self.add_opt_dep('morfessor-segment', binary=True)
 
@@ -53,7 +60,24 @@ class ApplyMorfessor(Rule):
         infile = self.inputs[0](conf, cli_args)
         model = self.inputs[1](conf, cli_args)
         outfile = self.outputs[0](conf, cli_args)
-        run('{prog} {infile} --load-segmentation {model} --output {outfile}'
+        if self.by_type:
+            segment_by_type(
+                lambda inp, out: self._run(inp, model, out),
+                infile, outfile,
+                cache_signature(self._command('-', model, '-'), model),
+                cache=type_cache_path(self.type_cache, conf, cli_args))
+        else:
+            self._run(infile, model, outfile)
+
+    def _run(self, infile, model, outfile):
+        if self.shards > 1:
+            run_sharded(lambda inp, out: self._command(inp, model, out),
+                        infile, outfile, self.shards)
+        else:
+            run(self._command(infile, model, outfile))
+
+    def _command(self, infile, model, outfile):
+        return ('{prog} {infile} --load-segmentation {model} --output {outfile}'
             ' --output-format-separator "{sep}" --output-format "{fmt}" --output-newlines'.format(
                 prog='morfessor-segment',
                 infile=infile,
@@ -67,12 +91,18 @@ class ApplyFlatcat(Rule):
     def __init__(self, *args,
                  sep=FIVEDOT + ' ', fmt='{analysis}', catsep=FOURDOT, argstr='',
                  no_space_ok=False,
+                 shards=1,
+                 by_type=False,
+                 type_cache=None,
                  **kwargs):
         super().__init__(*args, **kwargs)
         self.sep = sep
         self.fmt = fmt
         self.catsep = catsep
         self.argstr = argstr
+        self.shards = shards
+        self.by_type = by_type
+        self.type_cache = type_cache
         assert no_space_ok or ' ' in self.sep
         self.add_opt_dep('flatcat-segment', binary=True)
 
@@ -80,7 +110,24 @@ class ApplyFlatcat(Rule):
         infile = self.inputs[0](conf, cli_args)
         model = self.inputs[1](conf, cli_args)
         outfile = self.outputs[0](conf, cli_args)
-        run('{prog} {model} {infile} --output {outfile}'
+        if self.by_type:
+            segment_by_type(
+                lambda inp, out: self._run(inp, model, out),
+                infile, outfile,
+                cache_signature(self._command('-', model, '-'), model),
+                cache=type_cache_path(self.type_cache, conf, cli_args))
+        else:
+            self._run(infile, model, outfile)
+
+    def _run(self, infile, model, outfile):
+        if self.shards > 1:
+            run_sharded(lambda inp, out: self._command(inp, model, out),
+                        infile, outfile, self.shards)
+        else:
+            run(self._command(infile, model, outfile))
+
+    def _command(self, infile, model, outfile):
+        return ('{prog} {model} {infile} --output {outfile}'
             ' --output-construction-separator "{sep}" --output-format "{fmt}"'
             ' --output-newlines {argstr} --category-separator {catsep}'.format(
                 prog='flatcat-segment',
@@ -10,11 +10,12 @@ except ImportError:
     pass
 
 from .components.core import SingleCellComponent, apply_component
-from .components.filtering import FILTER_ALPHA, Filter
+from .components.filtering import alpha_only, Filter
 from .components.preprocessing import TruncateWords
 from .tabular import PasteColumns
 from .core.platform import run
 from .core.recipe import Rule
+from .core.scores import ScoreWriter
 from .core.utils import safe_zip, progress, FIVEDOT
 
 # Rule, not Component (input pairs not synchronous)
@@ -47,11 +48,11 @@ class TriangulateParallel(Rule):
 
         map_a = {}
         for (pivot, a) in safe_zip(pivot_a, inp_a):
-            pivot_lc = ''.join([x for x in pivot.lower() if x in FILTER_ALPHA])
+            pivot_lc = alpha_only(pivot)
             map_a[pivot_lc] = a
 
         for (pivot, b) in safe_zip(pivot_b, inp_b):
-            pivot_lc = ''.join([x for x in pivot.lower() if x in FILTER_ALPHA])
+            pivot_lc = alpha_only(pivot)
             a = map_a.get(pivot_lc, None)
             if a is None:
                 # no match
@@ -79,11 +80,15 @@ class FastAlign(Rule):
     def make(self, conf, cli_args):
         corpus_file = self.inputs[0](conf, cli_args)
         align_file = self.outputs[0](conf, cli_args)
+        # -v prints the iterations to stderr
         run('fast_align -i {corpus_file} {argstr}'
             ' > {align_file}'.format(
                 corpus_file=corpus_file,
                 align_file=align_file,
-                argstr=self.argstr))
+                argstr=self.argstr),
+            log=conf.current_autolog_path,
+            progress=r'ITERATION \d+',
+            progress_file=conf.current_progress_path)
 
 
 class Symmetrize(Rule):
@@ -259,8 +264,8 @@ class LexicalMatchScore(Rule):
         # Make a tuple of generators that reads from main_inputs
         readers = [self.inp_src.open(conf, cli_args, mode='r'),
                    self.inp_trg.open(conf, cli_args, mode='r')]
-        # writer for scores
-        fobj = self.outputs[0].open(conf, cli_args, mode='w')
+        # writer for scores: text, or binary if named *.f32
+        fobj = ScoreWriter(self.outputs[0](conf, cli_args))
         # read one line from each and yield it as a tuple
         stream = safe_zip(*readers)
 
@@ -290,7 +295,7 @@ class LexicalMatchScore(Rule):
             # negated for compatibility with
             # components.filtering.FilterUsingLmScore
             score = -hits / total
-            fobj.write('{}\n'.format(score))
+            fobj.write(score)
         for reader in readers:
             reader.close()
         fobj.close()
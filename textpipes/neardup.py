@@ -0,0 +1,292 @@
+"""Near-duplicate detection with MinHash and banded LSH.
+
+Produces a filter mask (1 = remove), to be applied with FilterUsingMask
+(possibly after CombineFilterMasks), like the other delayed filters.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import zlib
+
+from .core.recipe import Rule
+from .core.utils import safe_zip, LazyPool, NoPool
+
+logger = logging.getLogger('textpipes')
+
+BAND_RECORD = [('band', '<u2'), ('hash', '<u8'), ('line', '<u8')]
+# candidate pairs verified, and lines merged, at a time
+VERIFY_CHUNK = 1 << 16
+
+
+class NearDuplicateMask(Rule):
+    """Marks near-duplicate lines (tuples), keeping the first line
+    of each cluster of similar lines.
+
+    The lines are split into shingles (character or word n-grams),
+    and summarized by MinHash signatures of bands * rows hashes.
+    Lines with an identical band become candidates, which are verified
+    by the Jaccard similarity estimated from the signatures.
+    Memory use is bounded: signatures, band hashes and the clusters
+    (a union-find forest) are kept on disk, and the candidates
+    found and verified one hash partition at a time.
+
+    inputs: mono or parallel inputs.
+    output: the mask, one line of 1 (near-duplicate) or 0 per input line.
+    columns: indices of the parallel columns compared (default: all).
+    threshold: minimum estimated Jaccard similarity of the shingle sets.
+    """
+    def __init__(self, inputs, output,
+                 columns=None,
+                 threshold=0.8,
+                 shingle='char',
+                 ngram=5,
+                 bands=20,
+                 rows=5,
+                 partitions=64,
+                 processes=1,
+                 chunk_size=10000,
+                 seed=1,
+                 **kwargs):
+        super().__init__(inputs, [output], **kwargs)
+        if shingle not in ('char', 'word'):
+            raise Exception('Unknown shingle type {}'.format(shingle))
+        self.columns = columns
+        self.threshold = threshold
+        self.shingle = shingle
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = rows
+        self.partitions = partitions
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.add_opt_dep('numpy', binary=False)
+
+    def make(self, conf, cli_args=None):
+        out_path = self.outputs[0](conf, cli_args)
+        tmpdir = tempfile.mkdtemp(
+            prefix='.neardup.', dir=os.path.dirname(out_path) or '.')
+        if self.processes > 1:
+            pool = LazyPool(self.processes, chunksize=1)
+        else:
+            pool = NoPool()
+        try:
+            n_lines, sig_path, part_paths = self._signatures(
+                conf, cli_args, tmpdir, pool)
+            n_perm = self.bands * self.rows
+            jobs = [(path, sig_path, n_lines, n_perm, self.threshold)
+                    for path in part_paths]
+            parent = _parent_array(os.path.join(tmpdir, 'parent'), n_lines)
+            # the pairs of one partition at a time are merged into clusters
+            for pairs in pool.imap(_verified_pairs, jobs):
+                _union(parent, pairs)
+            n_drop = self._write_mask(conf, cli_args, parent, n_lines)
+            del parent
+        finally:
+            pool.close()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        logger.info('NearDuplicateMask: {} of {} lines are near-duplicates'.format(
+            n_drop, n_lines))
+
+    def _write_mask(self, conf, cli_args, parent, n_lines):
+        """Lines that are not the representative (root) of their cluster
+        are marked as near-duplicates"""
+        import numpy as np
+        n_drop = 0
+        with self.outputs[0].open(conf, cli_args, mode='w') as fobj:
+            for start in range(0, n_lines, self.chunk_size):
+                end = min(start + self.chunk_size, n_lines)
+                drop = parent[start:end] != np.arange(start, end, dtype='u8')
+                n_drop += int(drop.sum())
+                fobj.write(''.join(['1\n' if x else '0\n'
+                                    for x in drop.tolist()]))
+        return n_drop
+
+    def _params(self):
+        import numpy as np
+        rng = np.random.RandomState(self.seed)
+        n_perm = self.bands * self.rows
+        # multiply-shift hashing: odd a, arithmetic mod 2**64
+        a = _random_u64(rng, n_perm) | 1
+        b = _random_u64(rng, n_perm)
+        # combines the rows of a band into a band hash
+        mix = _random_u64(rng, self.rows) | 1
+        return (self.shingle, self.ngram, self.bands, self.rows, a, b, mix)
+
+    def _signatures(self, conf, cli_args, tmpdir, pool):
+        """First pass: signatures into one file,
+        band hashes scattered into partitions"""
+        import numpy as np
+        params = self._params()
+        sig_path = os.path.join(tmpdir, 'signatures')
+        part_paths = [os.path.join(tmpdir, str(i))
+                      for i in range(self.partitions)]
+        readers = [inp.open(conf, cli_args, mode='r')
+                   for inp in self.inputs]
+        columns = self.columns
+
+        def chunks():
+            chunk = []
+            start = 0
+            for tpl in safe_zip(*readers):
+                if columns is not None:
+                    tpl = [tpl[i] for i in columns]
+                chunk.append(' '.join(tpl))
+                if len(chunk) >= self.chunk_size:
+                    yield (start, chunk, params)
+                    start += len(chunk)
+                    chunk = []
+            if chunk:
+                yield (start, chunk, params)
+
+        n_lines = 0
+        sig_file = open(sig_path, 'wb')
+        part_files = [open(path, 'wb') for path in part_paths]
+        for (sigs, records) in pool.imap(_chunk_signatures, chunks()):
+            sigs.tofile(sig_file)
+            n_lines += len(sigs)
+            parts = records['hash'] % self.partitions
+            order = np.argsort(parts, kind='stable')
+            bounds = np.searchsorted(parts[order],
+                                     np.arange(self.partitions + 1))
+            for p in range(self.partitions):
+                records[order[bounds[p]:bounds[p + 1]]].tofile(part_files[p])
+        for fobj in readers + part_files + [sig_file]:
+            fobj.close()
+        return n_lines, sig_path, part_paths
+
+
+def shingle_units(line, shingle='char'):
+    """The normalized line as a sequence of integers
+    (code points or word hashes), shingles are n-grams of these"""
+    if shingle == 'word':
+        return [zlib.crc32(word.encode('utf-8'))
+                for word in line.casefold().split()]
+    line = ' '.join(line.casefold().split())
+    return [ord(char) for char in line]
+
+
+def _chunk_signatures(job):
+    import numpy as np
+    start, lines, (shingle, ngram, bands, rows, a, b, mix) = job
+    # also an empty line has one shingle, made of padding only
+    pad = [0] * ngram
+    units = []
+    shingle_starts = []
+    lengths = []
+    for line in lines:
+        line_units = shingle_units(line, shingle)
+        pos = len(units)
+        # a line shorter than n is a single (padded) shingle
+        n_shingles = max(len(line_units) - ngram + 1, 1)
+        shingle_starts.append(np.arange(pos, pos + n_shingles))
+        lengths.append(n_shingles)
+        units.extend(line_units)
+        units.extend(pad)
+    units = np.array(units + pad, dtype='u8')
+    shingle_starts = np.concatenate(shingle_starts)
+    # hash of each n-gram, mod 2**64
+    hashes = np.zeros(len(shingle_starts), dtype='u8')
+    for j in range(ngram):
+        hashes *= np.uint64(1000003)
+        hashes += units[shingle_starts + j]
+    offsets = np.zeros(len(lines), dtype='i8')
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    # MinHash with multiply-shift hash functions
+    sigs = np.empty((len(lines), bands * rows), dtype='u4')
+    permuted = np.empty_like(hashes)
+    for k in range(bands * rows):
+        np.multiply(hashes, a[k], out=permuted)
+        permuted += b[k]
+        permuted >>= np.uint64(32)
+        sigs[:, k] = np.minimum.reduceat(permuted, offsets)
+    # band hashes: rows combined by multiplication and addition mod 2**64
+    banded = sigs.reshape(len(lines), bands, rows).astype('u8')
+    band_hashes = (banded * mix[None, None, :]).sum(axis=2)
+    records = np.empty(len(lines) * bands, dtype=BAND_RECORD)
+    records['band'] = np.tile(np.arange(bands, dtype='u2'), len(lines))
+    records['hash'] = band_hashes.reshape(-1)
+    records['line'] = np.repeat(np.arange(start, start + len(lines),
+                                          dtype='u8'), bands)
+    return sigs, records
+
+
+def _random_u64(rng, size):
+    high = rng.randint(0, 1 << 32, size=size).astype('u8')
+    low = rng.randint(0, 1 << 32, size=size).astype('u8')
+    return (high << 32) | low
+
+
+def _verified_pairs(job):
+    """Candidate pairs (first line of the bucket, other line)
+    sharing a band, whose signatures agree at least threshold"""
+    import numpy as np
+    path, sig_path, n_lines, n_perm, threshold = job
+    records = np.fromfile(path, dtype=BAND_RECORD)
+    if len(records) == 0 or n_lines == 0:
+        return np.zeros((0, 2), dtype='u8')
+    order = np.lexsort((records['line'], records['hash'], records['band']))
+    records = records[order]
+    same = (records['band'][1:] == records['band'][:-1]) \
+        & (records['hash'][1:] == records['hash'][:-1])
+    starts = np.concatenate(([True], ~same))
+    # the first (smallest) line of each bucket
+    first = records['line'][np.maximum.accumulate(
+        np.where(starts, np.arange(len(records)), 0))]
+    pairs = np.stack([first, records['line']], axis=1)[~starts]
+    if len(pairs) == 0:
+        return pairs
+    pairs = np.unique(pairs, axis=0)
+    sigs = np.memmap(sig_path, dtype='u4', mode='r', shape=(n_lines, n_perm))
+    # signatures of a bounded number of pairs at a time
+    verified = []
+    for start in range(0, len(pairs), VERIFY_CHUNK):
+        chunk = pairs[start:start + VERIFY_CHUNK]
+        agreement = (sigs[chunk[:, 0]] == sigs[chunk[:, 1]]).mean(axis=1)
+        verified.append(chunk[agreement >= threshold])
+    return np.concatenate(verified)
+
+
+def _parent_array(path, n_lines):
+    """Union-find forest on disk: each line is its own cluster"""
+    import numpy as np
+    parent = np.memmap(path, dtype='u8', mode='w+', shape=(max(n_lines, 1),))
+    for start in range(0, n_lines, VERIFY_CHUNK):
+        end = min(start + VERIFY_CHUNK, n_lines)
+        parent[start:end] = np.arange(start, end, dtype='u8')
+    return parent
+
+
+def _roots(parent, lines):
+    """The representatives of the clusters of the lines"""
+    roots = parent[lines]
+    while True:
+        above = parent[roots]
+        if (above == roots).all():
+            break
+        roots = above
+    # path compression
+    parent[lines] = roots
+    return roots
+
+
+def _union(parent, pairs):
+    """Merges the clusters of the pairs of lines.
+    The smallest line of a cluster is its representative."""
+    import numpy as np
+    for start in range(0, len(pairs), VERIFY_CHUNK):
+        left = pairs[start:start + VERIFY_CHUNK, 0]
+        right = pairs[start:start + VERIFY_CHUNK, 1]
+        while len(left) > 0:
+            left_roots = _roots(parent, left)
+            right_roots = _roots(parent, right)
+            differ = left_roots != right_roots
+            left, right = left[differ], right[differ]
+            left_roots, right_roots = left_roots[differ], right_roots[differ]
+            # several pairs may link the same root: the smallest wins,
+            # the others are linked on the next round
+            np.minimum.at(parent,
+                          np.maximum(left_roots, right_roots),
+                          np.minimum(left_roots, right_roots))
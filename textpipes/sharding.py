@@ -0,0 +1,128 @@
+"""Splitting line-wise work into shards, that run as separate jobs"""
+
+from .core.recipe import Rule, RecipeFile, ShardRecipeFile, ShardedRecipeFile
+from .core.utils import external_linecount
+from .external import Concatenate
+
+
+class SplitShards(Rule):
+    """Splits (parallel) inputs into contiguous ranges of lines.
+
+    shard_outputs is either a ShardedRecipeFile for each input,
+    or for each shard a list of files, one for each input.
+    The line count is only checked when the rule is made,
+    so the shards stay balanced even if the data changes."""
+    def __init__(self, inputs, shard_outputs, **kwargs):
+        if isinstance(inputs, RecipeFile):
+            inputs = [inputs]
+        if isinstance(shard_outputs, ShardedRecipeFile):
+            shard_outputs = [shard_outputs]
+        wholes = []
+        if all(isinstance(out, ShardedRecipeFile) for out in shard_outputs):
+            wholes = list(shard_outputs)
+            shard_outputs = [list(parts) for parts
+                             in zip(*(whole.parts for whole in wholes))]
+        outputs = [out for shard in shard_outputs for out in shard]
+        super().__init__(inputs, outputs + wholes, **kwargs)
+        self.shard_outputs = shard_outputs
+
+    def make(self, conf, cli_args=None):
+        total = external_linecount(self.inputs[0](conf, cli_args))
+        n_shards = len(self.shard_outputs)
+        per_shard = -(-total // n_shards)
+        readers = [inp.open(conf, cli_args, mode='r', strip_newlines=False)
+                   for inp in self.inputs]
+        for shard in self.shard_outputs:
+            writers = [out.open(conf, cli_args, mode='w') for out in shard]
+            for _ in range(per_shard):
+                lines = [next(reader, None) for reader in readers]
+                if all(line is None for line in lines):
+                    break
+                if any(line is None for line in lines):
+                    raise Exception('inputs of {} have different lengths'.format(
+                        self.name))
+                for (writer, line) in zip(writers, lines):
+                    writer.write(line)
+            for writer in writers:
+                writer.close()
+        for reader in readers:
+            if next(reader, None) is not None:
+                raise Exception('inputs of {} have different lengths'.format(
+                    self.name))
+            reader.close()
+
+
+class GatherShards(Rule):
+    """Makes the parts of a ShardedRecipeFile available as a whole.
+    Nothing is copied: the file is done when all the parts are."""
+    def __init__(self, whole, resource_class='make_immediately', **kwargs):
+        super().__init__(whole.parts, [whole],
+                         resource_class=resource_class, **kwargs)
+
+    def make(self, conf, cli_args=None):
+        missing = [part for part in self.inputs
+                   if not part.exists(conf, cli_args)]
+        if missing:
+            raise Exception('missing parts: {}'.format(missing))
+
+    def is_atomic(self, output):
+        return True
+
+
+def shard_pipe(recipe, pipe, inputs, outputs, shards,
+               split_resource_class='default',
+               merge_resource_class='default'):
+    """Fans a line-wise Pipe out into separate jobs for each shard.
+
+    pipe is a callable making the Pipe from lists of inputs and outputs,
+    e.g. the Rule returned by apply_component.
+    Adds a rule splitting the inputs, one Pipe for each shard,
+    and rules concatenating the shards of each output in order.
+    The shard paths are derived from the input and output paths.
+    The shard jobs depend on the split job, and the merge jobs on them,
+    so on the cluster the shards run in parallel (as a job array,
+    if enabled).
+    Inputs and outputs that are ShardedRecipeFiles are passed through
+    as is: their parts are used instead of splitting and merging.
+    Returns the per-shard Pipes."""
+    if isinstance(inputs, RecipeFile):
+        inputs = [inputs]
+    if isinstance(outputs, RecipeFile):
+        outputs = [outputs]
+    sharded = [isinstance(inp, ShardedRecipeFile) for inp in inputs]
+    if any(sharded) and not all(sharded):
+        # the parts would not be aligned with the split
+        raise Exception('Either all or none of the inputs must be sharded')
+    for rf in inputs + outputs:
+        if isinstance(rf, ShardedRecipeFile) and rf.n_shards != shards:
+            raise Exception('{} has {} shards, expecting {}'.format(
+                rf, rf.n_shards, shards))
+    if all(sharded):
+        shard_inputs = [[inp.parts[i] for inp in inputs]
+                        for i in range(shards)]
+    else:
+        shard_inputs = [[ShardRecipeFile(inp, i, shards) for inp in inputs]
+                        for i in range(shards)]
+        recipe.add_rule(SplitShards(inputs, shard_inputs,
+                                    resource_class=split_resource_class))
+    shard_outputs = [[out.parts[i] if isinstance(out, ShardedRecipeFile)
+                      else ShardRecipeFile(out, i, shards)
+                      for out in outputs]
+                     for i in range(shards)]
+    rules = []
+    for i in range(shards):
+        rule = pipe(shard_inputs[i], shard_outputs[i])
+        if tuple(rule.outputs) != tuple(shard_outputs[i]):
+            # each shard would write the same side output
+            raise Exception('Cannot shard {}: side outputs are not '
+                            'supported'.format(rule.name))
+        recipe.add_rule(rule)
+        rules.append(rule)
+    for (j, out) in enumerate(outputs):
+        if isinstance(out, ShardedRecipeFile):
+            recipe.add_rule(GatherShards(out))
+            continue
+        recipe.add_rule(Concatenate(
+            [shard[j] for shard in shard_outputs], [out],
+            resource_class=merge_resource_class))
+    return rules
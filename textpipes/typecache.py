@@ -0,0 +1,115 @@
+"""Type-level memoization of token-level external segmenters.
+
+A large corpus has few word types compared to tokens.
+Instead of running the segmenter over the whole corpus,
+it is run once per type, and the corpus is mapped token by token.
+This is exact for tools segmenting each token independently of
+its context, with output tokens separated by single spaces.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+
+from .core.utils import open_text_file
+from .counting import CountTokensComponent
+
+CACHE_HEADER = '#signature'
+
+
+def cache_signature(command, model):
+    """Changes if the segmenter command or the model changes"""
+    stat = os.stat(model)
+    key = '{}\t{}\t{}\t{}'.format(
+        command, os.path.abspath(model), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def type_cache_path(type_cache, conf, cli_args=None):
+    """The cache can be given as a path, or as a RecipeFile
+    (not an input or output of the rule, as it is mutable)."""
+    if type_cache is None or isinstance(type_cache, str):
+        return type_cache
+    return type_cache(conf, cli_args)
+
+
+def load_cache(path, signature):
+    """Returns the cached segmentations, if made with the same signature"""
+    mapping = {}
+    if path is None or not os.path.exists(path):
+        return mapping
+    with open(path, 'r', encoding='utf-8') as fobj:
+        header = fobj.readline().rstrip('\n')
+        if header != '{}\t{}'.format(CACHE_HEADER, signature):
+            print('discarding stale type cache {}'.format(path))
+            return mapping
+        for line in fobj:
+            wtype, seg = line.rstrip('\n').split('\t', 1)
+            mapping[wtype] = seg
+    return mapping
+
+
+def extend_cache(path, signature, new_items):
+    """Appends new segmentations to the cache,
+    or starts a new one if the signature has changed."""
+    with open(path, 'a+', encoding='utf-8') as fobj:
+        # concurrent jobs may share a cache
+        fcntl.flock(fobj, fcntl.LOCK_EX)
+        fobj.seek(0)
+        header = fobj.readline().rstrip('\n')
+        if header != '{}\t{}'.format(CACHE_HEADER, signature):
+            fobj.seek(0)
+            fobj.truncate()
+            fobj.write('{}\t{}\n'.format(CACHE_HEADER, signature))
+        fobj.seek(0, os.SEEK_END)
+        for wtype, seg in new_items:
+            fobj.write('{}\t{}\n'.format(wtype, seg))
+        fobj.flush()
+        fcntl.flock(fobj, fcntl.LOCK_UN)
+
+
+def segment_by_type(run_types, infile, outfile, signature, cache=None):
+    """Segments infile into outfile, running the tool only on unseen types.
+
+    run_types(types_in, types_out) runs the segmenter on a file
+    with one type per line.
+    cache: path of a persistent type cache, shared across runs.
+    """
+    counter = CountTokensComponent(None)
+    with open_text_file(infile, 'r') as fobj:
+        for line in fobj:
+            counter.single_cell(line)
+    mapping = load_cache(cache, signature)
+    unseen = sorted(wtype for wtype in counter.counts
+                    if wtype not in mapping)
+    print('{} types, {} not in cache'.format(len(counter.counts), len(unseen)))
+    del counter
+    if len(unseen) > 0:
+        tmpdir = tempfile.mkdtemp(
+            prefix='.types.', dir=os.path.dirname(outfile) or '.')
+        try:
+            types_in = os.path.join(tmpdir, 'types')
+            types_out = os.path.join(tmpdir, 'segmented')
+            with open(types_in, 'w', encoding='utf-8') as fobj:
+                for wtype in unseen:
+                    fobj.write(wtype)
+                    fobj.write('\n')
+            run_types(types_in, types_out)
+            with open(types_out, 'r', encoding='utf-8') as fobj:
+                segs = [line.rstrip('\n') for line in fobj]
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        if len(segs) != len(unseen):
+            raise Exception('segmenting types: {} lines in, {} lines out'.format(
+                len(unseen), len(segs)))
+        new_items = list(zip(unseen, segs))
+        mapping.update(new_items)
+        if cache is not None:
+            extend_cache(cache, signature, new_items)
+    with open_text_file(infile, 'r') as fin, \
+            open_text_file(outfile, 'w') as fout:
+        for line in fin:
+            fout.write(' '.join(mapping[token] for token in line.split()))
+            fout.write('\n')